@@ -0,0 +1,157 @@
+"""
+Benchmark the message pipelines against the Apptoto and REDCap emulators, for synthetic cohorts.
+
+For each cohort size the participants are run through generate_messages,
+get_conversations (after replies are simulated for every message),
+update_times (after every participant's sleep time changes) and delete_messages.
+Each pipeline reports wall time, apptoto requests, REDCap exports, peak traced memory
+and the time spent blocked on the apptoto rate limit. The emulators keep virtual time,
+so the rate limit wait is what the pipeline would wait against apptoto, without waiting for it.
+
+Run from the repository root:
+    python -m benchmarks.pipelines [--sizes 1 50 500] [--save-baseline]
+
+Results are compared with benchmarks/baseline.json when it exists;
+--save-baseline replaces it with this run's results.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+from src.apptoto import Apptoto, RateLimiter
+from src.constants import DOWNLOAD_DIR
+from src.event_generator import EventGenerator
+from tests.apptoto_emulator import ApptotoEmulator
+from tests.redcap_emulator import RedcapEmulator, synthetic_records, participant_ids
+
+INSTANCE_PATH = Path(__file__).resolve().parent.parent / 'instance'
+BASELINE = Path(__file__).resolve().parent / 'baseline.json'
+SIZES = (1, 50, 500)
+METRICS = ('wall_s', 'requests', 'redcap_exports', 'peak_mb', 'limiter_wait_s')
+
+
+class CohortBenchmark:
+    def __init__(self, n, instance_path, seed=0, reply_rate=0.5):
+        """
+        Create a CohortBenchmark.
+
+        :param n: Number of participants
+        :param instance_path: Instance directory with the message file, where events.json is written
+        :param seed: Seed for the cohort, message times and replies
+        :param reply_rate: Chance that a participant replies to a message
+        """
+        self.instance_path = instance_path
+        self.participant_ids = participant_ids(n)
+        self.seed = seed
+        self.reply_rate = reply_rate
+        self.redcap = RedcapEmulator(synthetic_records(n, seed=seed))
+        self.apptoto = ApptotoEmulator(seed=seed)
+        # one limiter for all generators, as Apptoto.limiter is shared in the app
+        self.limiter = RateLimiter(Apptoto.REQUEST_LIMIT, clock=self.apptoto.clock)
+        self.config = {'apptoto_api_token': 'token', 'apptoto_user': 'user',
+                       'apptoto_calendar': 'ASH Messages', 'redcap_api_token': 'token',
+                       'message_file': 'messages.csv'}
+
+    def generator(self, participant_id):
+        eg = EventGenerator(participant_id, self.config, self.instance_path)
+        eg.apptoto.limiter = self.limiter
+        self.apptoto.connect(eg.apptoto._session)
+        return eg
+
+    def measure(self, job):
+        """
+        Run `job` for every participant.
+
+        :param job: Function of an EventGenerator
+        :return: dict of metrics
+        """
+        requests = sum(self.apptoto.requests.values())
+        exports = self.redcap.exports
+        waited = self.limiter.waited
+
+        tracemalloc.start()
+        start = time.perf_counter()
+        for pid in self.participant_ids:
+            job(self.generator(pid))
+        wall = time.perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        return {'wall_s': wall,
+                'requests': sum(self.apptoto.requests.values()) - requests,
+                'redcap_exports': self.redcap.exports - exports,
+                'peak_mb': peak / 2 ** 20,
+                'limiter_wait_s': self.limiter.waited - waited}
+
+    def run(self):
+        results = {}
+        with self.redcap.installed():
+            results['generate_messages'] = self.measure(lambda eg: eg.generate_messages())
+            results['generate_messages']['events'] = len(self.apptoto.events)
+
+            messages = self.apptoto.simulate_conversations(reply_rate=self.reply_rate)
+            results['get_conversations'] = self.measure(lambda eg: eg.get_conversations())
+            results['get_conversations']['conversation_events'] = messages
+
+            for pid in self.participant_ids:
+                self.redcap.set_field(pid, 'sleeptime', '20:30')
+            results['update_times'] = self.measure(lambda eg: asyncio.run(eg.update_times()))
+
+            results['delete_messages'] = self.measure(lambda eg: eg.delete_messages())
+        return results
+
+
+def compare(value, baseline):
+    if not baseline:
+        return ''
+    return f'{100 * (value - baseline) / baseline:+7.1f}%'
+
+
+def report(results, baseline):
+    print(f'{"pipeline":<20}{"n":>5}' + ''.join(f'{m:>22}' for m in METRICS))
+    for size, pipelines in results.items():
+        for name, metrics in pipelines.items():
+            before = baseline.get(size, {}).get(name, {})
+            cells = [f'{metrics[m]:>12.2f} {compare(metrics[m], before.get(m)):>9}' for m in METRICS]
+            print(f'{name:<20}{size:>5}' + ''.join(cells))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the message pipelines against emulated services')
+    parser.add_argument('--sizes', type=int, nargs='+', default=SIZES, help='cohort sizes')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--save-baseline', action='store_true', help=f'save results to {BASELINE.name}')
+    args = parser.parse_args()
+
+    logging.disable(logging.INFO)
+    baseline = json.loads(BASELINE.read_text()) if BASELINE.exists() else {}
+
+    results = {}
+    cwd = os.getcwd()
+    for size in args.sizes:
+        # the store, dashboard and csv files are written relative to the working directory,
+        # and events.json to the instance directory, so both are a temporary directory
+        with tempfile.TemporaryDirectory() as workdir:
+            shutil.copy(INSTANCE_PATH / 'messages.csv', workdir)
+            os.chdir(workdir)
+            Path(DOWNLOAD_DIR).mkdir()
+            try:
+                results[str(size)] = CohortBenchmark(size, Path(workdir), seed=args.seed).run()
+            finally:
+                os.chdir(cwd)
+
+    report(results, baseline)
+    if args.save_baseline:
+        BASELINE.write_text(json.dumps(results, indent=2))
+        print(f'Baseline saved to {BASELINE}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,50 @@
+"""
+Compare request body encoding of jsonpickle (the previous path) with encode_json.
+
+Run from the repository root:
+    python -m benchmarks.serialize [number_of_events]
+"""
+import sys
+import timeit
+from datetime import datetime, timedelta
+
+import jsonpickle
+
+from src.apptoto import ApptotoEvent, ApptotoParticipant, encode_json, orjson, Apptoto
+
+
+def make_events(n):
+    participants = [ApptotoParticipant('AB', '+15415550100', 'ab@example.com')]
+    start = datetime(2022, 1, 1, 9, 0)
+    return [ApptotoEvent(calendar='ASH Messages',
+                         title='ASH SMS',
+                         start_time=start + timedelta(minutes=17 * i),
+                         content=f'UO: Message number {i} about smoking and your values.',
+                         participants=participants,
+                         time_zone='PT') for i in range(n)]
+
+
+def encode_batches(encode, events):
+    for i in range(0, len(events), Apptoto.MAX_POST):
+        encode({'events': events[i:i + Apptoto.MAX_POST], 'prevent_calendar_creation': True})
+
+
+def main(n=10000, repeat=5):
+    create = min(timeit.repeat(lambda: make_events(n), number=1, repeat=repeat))
+    events = make_events(n)
+
+    def old(data):
+        return jsonpickle.encode(data, unpicklable=False)
+
+    old_time = min(timeit.repeat(lambda: encode_batches(old, events), number=1, repeat=repeat))
+    new_time = min(timeit.repeat(lambda: encode_batches(encode_json, events), number=1, repeat=repeat))
+
+    print(f'{n} events, best of {repeat}')
+    print(f'create events:       {create * 1000:8.1f} ms')
+    print(f'jsonpickle encode:   {old_time * 1000:8.1f} ms')
+    print(f'encode_json ({"orjson" if orjson else "json"}): {new_time * 1000:8.1f} ms')
+    print(f'speedup:             {old_time / new_time:8.1f}x')
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 10000)
@@ -0,0 +1,85 @@
+"""
+Benchmark how long a worker takes to start: importing src.flask_app and running create_app.
+
+Each run starts a new interpreter, as gunicorn does for each worker, so nothing is already imported.
+The slowest imports are listed from `python -X importtime`.
+
+Run from the repository root:
+    python -m benchmarks.startup [--runs 5] [--top 15]
+
+LOGIN_PASS_HASH and USER_DB_URI are taken from the environment (or .env) when set,
+so their effect on create_app can be compared.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+
+WORKER = '''
+import json, time
+start = time.perf_counter()
+from src.flask_app import create_app
+imported = time.perf_counter()
+app = create_app({'AUTOMATIONCONFIG': {}})
+created = time.perf_counter()
+import sys
+print(json.dumps({'import_s': imported - start, 'create_app_s': created - imported,
+                  'pandas_loaded': 'pandas' in sys.modules}))
+'''
+
+
+def start_worker():
+    env = dict(os.environ)
+    env.setdefault('LOGIN_EMAIL', 'benchmark@example.com')
+    env.setdefault('LOGIN_PASS', 'benchmark')
+    result = subprocess.run([sys.executable, '-c', WORKER], cwd=ROOT, env=env,
+                            capture_output=True, text=True, check=True)
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def slowest_imports(top):
+    """
+    :param top: Number of modules to list
+    :return: (cumulative microseconds, module) of the modules imported by src.flask_app
+        and its imports, slowest first
+    """
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import src.flask_app'],
+                            cwd=ROOT, capture_output=True, text=True, check=True)
+    imports = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line.split('|')
+        # the first three levels of imports, deeper ones are counted in these
+        if len(name) - len(name.lstrip()) <= 5:
+            imports.append((int(cumulative), name.strip()))
+    return sorted(imports, reverse=True)[:top]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark worker startup')
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--top', type=int, default=15, help='number of slowest imports listed')
+    args = parser.parse_args()
+
+    runs = [start_worker() for _ in range(args.runs)]
+    for key in ('import_s', 'create_app_s'):
+        times = [run[key] for run in runs]
+        print(f'{key:<14} median {statistics.median(times):.3f}  min {min(times):.3f}  max {max(times):.3f}')
+    total = statistics.median(run['import_s'] + run['create_app_s'] for run in runs)
+    print(f'{"startup_s":<14} median {total:.3f}')
+    if any(run['pandas_loaded'] for run in runs):
+        print('pandas was imported during startup')
+
+    print(f'\n{"cumulative ms":>14}  module')
+    for cumulative, name in slowest_imports(args.top):
+        print(f'{cumulative / 1000:>14.1f}  {name}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,220 @@
+from pathlib import Path
+import numpy as np
+import pandas as pd
+
+from src.constants import SMS_TITLE, CIGS_TITLE, APPTOTO_TZ
+from src.conversation import split_conversations
+from src.enums import Condition
+from src.participant import REDCAP_EVENTS
+
+MESSAGE_TYPES = {'sms': SMS_TITLE, 'cigs': CIGS_TITLE, 'booster': 'Booster', 'diary': 'Daily Diary'}
+NUMBER_WORDS = {'zero': 0, 'none': 0, 'no': 0, 'nothing': 0, 'one': 1, 'two': 2, 'three': 3, 'four': 4,
+                'five': 5, 'six': 6, 'seven': 7, 'eight': 8, 'nine': 9, 'ten': 10, 'eleven': 11,
+                'twelve': 12, 'fifteen': 15, 'twenty': 20}
+GROUPINGS = {'participant': ['participant_id'],
+             'condition': ['condition'],
+             'week': ['week'],
+             'message_type': ['message_type']}
+
+
+def message_type(titles: pd.Series) -> pd.Series:
+    """
+    Classify events by title.
+
+    :param titles: Event titles
+    :return: Series of 'sms', 'cigs', 'booster', 'diary' or 'other'
+    """
+    titles = titles.fillna('')
+    conditions = [titles.str.contains(t, regex=False) for t in MESSAGE_TYPES.values()]
+    return pd.Series(np.select(conditions, list(MESSAGE_TYPES), default='other'), index=titles.index)
+
+
+def parse_cigarettes(replies: pd.Series) -> pd.Series:
+    """
+    Get the number of cigarettes from replies to the daily cigarette message.
+
+    The first number in the reply is used, e.g. '3' or 'about 5 today',
+    otherwise the first number word, e.g. 'none' or 'two'.
+
+    :param replies: Reply text
+    :return: Series of cigarette counts, NaN where no number was found
+    """
+    replies = replies.astype('string').str.lower()
+    counts = replies.str.extract(r'(\d+(?:\.\d+)?)', expand=False).astype(float)
+    words = replies.str.extract(r'\b(' + '|'.join(NUMBER_WORDS) + r')\b', expand=False)
+    return counts.fillna(words.map(NUMBER_WORDS).astype(float))
+
+
+def cohort_from_redcap(records: pd.DataFrame) -> pd.DataFrame:
+    """
+    Get the condition and quit date of every participant from a REDCap export.
+
+    :param records: Records from participant.export_records
+    :return: DataFrame with participant_id, condition and quit_date columns
+    """
+    session1 = next(k for k, v in REDCAP_EVENTS.items() if v == 's1')
+    s1 = records.xs(session1, level=1)[['condition', 'quitdate']].dropna(subset=['condition'])
+    return pd.DataFrame({'participant_id': s1.index,
+                         'condition': [Condition(int(c)).name for c in s1.condition],
+                         'quit_date': pd.to_datetime(s1.quitdate).values})
+
+
+def load_conversation_csvs(csv_path) -> pd.DataFrame:
+    """
+    Read the *_sms_conversations.csv and *_cig_conversations.csv files of all participants.
+
+    :param csv_path: Directory containing the files, usually DOWNLOAD_DIR
+    :return: DataFrame of conversations with participant_id and title_sent columns
+    """
+    frames = []
+    for kind, title in (('sms', SMS_TITLE), ('cig', CIGS_TITLE)):
+        for f in sorted(Path(csv_path).glob(f'*_{kind}_conversations.csv')):
+            df = pd.read_csv(f, dtype={'UO_ID': str, 'message': str, 'reply': str})
+            df['participant_id'] = f.name.split('_')[0]
+            df['title_sent'] = title
+            frames.append(df)
+
+    if not frames:
+        return pd.DataFrame(columns=['participant_id', 'title_sent', 'at_sent', 'UO_ID',
+                                     'content_sent', 'at_rec', 'content_rec'])
+
+    conversations = pd.concat(frames, ignore_index=True)
+    conversations = conversations.rename(columns={'sent_at': 'at_sent', 'message': 'content_sent',
+                                                  'replied_at': 'at_rec', 'reply': 'content_rec'})
+    for column in ['at_sent', 'at_rec']:
+        conversations[column] = pd.to_datetime(conversations[column], format='%x %X')
+    return conversations
+
+
+def load_conversations(store, csv_path) -> pd.DataFrame:
+    """
+    Get the conversations of all participants from the store, plus those
+    of participants that only have conversation files from before the store existed.
+
+    The store keeps every sent message, so only the intervention and cigarette messages
+    are used, the ones the conversation files hold. Times are wall clock times
+    in the apptoto account's time zone, as in the conversation files.
+
+    :param store: Store with a conversations table
+    :param csv_path: Directory containing the conversation files, usually DOWNLOAD_DIR
+    :return: DataFrame of conversations with participant_id and title_sent columns
+    """
+    stored = store.read('conversations')
+    legacy = load_conversation_csvs(csv_path)
+    if stored.empty:
+        return legacy
+
+    stored = pd.concat(split_conversations(stored), ignore_index=True)
+    for column in ['at_sent', 'at_rec']:
+        stored[column] = pd.to_datetime(stored[column], utc=True).dt.tz_convert(APPTOTO_TZ).dt.tz_localize(None)
+    legacy = legacy[~legacy.participant_id.isin(stored.participant_id)]
+    return pd.concat([stored, legacy], ignore_index=True)
+
+
+def prepare(conversations: pd.DataFrame, cohort: pd.DataFrame = None) -> pd.DataFrame:
+    """
+    Add the columns used by the cohort analyses to conversation rows.
+
+    Adds message_type, responded, date, week (week of the study, counted from the quit date,
+    or from the participant's first message when the quit date is unknown), condition
+    and cigarettes (parsed from replies to the cigarette message).
+
+    :param conversations: One row per sent message for any number of participants, with
+        participant_id, title_sent, at_sent and content_rec columns
+    :param cohort: Optional DataFrame with participant_id, condition and quit_date columns
+    :return: New DataFrame
+    """
+    df = conversations.copy()
+    df['message_type'] = message_type(df.title_sent)
+    df['responded'] = df.content_rec.notna()
+    df['date'] = pd.to_datetime(df.at_sent).dt.tz_localize(None).dt.normalize()
+
+    if cohort is not None:
+        df = df.merge(cohort[['participant_id', 'condition', 'quit_date']], on='participant_id', how='left')
+    else:
+        df['condition'] = np.nan
+        df['quit_date'] = pd.NaT
+
+    start = pd.to_datetime(df.quit_date).fillna(df.groupby('participant_id').date.transform('min'))
+    df['week'] = (df.date - start).dt.days // 7 + 1
+    df['condition'] = df.condition.fillna('unknown')
+
+    df['cigarettes'] = np.nan
+    cigs = df.message_type == 'cigs'
+    df.loc[cigs, 'cigarettes'] = parse_cigarettes(df.loc[cigs, 'content_rec']).values
+    return df.drop(columns='quit_date')
+
+
+def response_rates(prepared: pd.DataFrame, by) -> pd.DataFrame:
+    """
+    Get the response rate of each group of sent messages.
+
+    :param prepared: Output of prepare
+    :param by: Column or list of columns to group by
+    :return: DataFrame of the group columns plus sent, replied and response_rate (percent)
+    """
+    grouped = prepared.groupby(by, observed=True).responded.agg(sent='size', replied='sum').reset_index()
+    grouped['response_rate'] = 100 * grouped.replied / grouped.sent
+    return grouped
+
+
+def cigarette_series(prepared: pd.DataFrame) -> pd.DataFrame:
+    """
+    Get the daily number of cigarettes reported by each participant.
+
+    :param prepared: Output of prepare
+    :return: DataFrame with participant_id, date and cigarettes, one row per participant per day
+    """
+    cigs = prepared[(prepared.message_type == 'cigs') & prepared.cigarettes.notna()]
+    return (cigs.sort_values('at_sent')
+                .groupby(['participant_id', 'date'], as_index=False)
+                .cigarettes.first())
+
+
+def tidy_table(prepared: pd.DataFrame) -> pd.DataFrame:
+    """
+    Summarize a cohort in one long table.
+
+    There is one row for every combination of participant, condition, week and message type,
+    plus one row for each value of each grouping alone (with the grouping in the 'level'
+    column and the other group columns empty), so any response rate can be read off directly.
+
+    :param prepared: Output of prepare
+    :return: DataFrame with level, participant_id, condition, week, message_type,
+        sent, replied, response_rate and mean_cigarettes columns
+    """
+    columns = ['participant_id', 'condition', 'week', 'message_type']
+    tables = []
+    for level, by in [('all', columns)] + list(GROUPINGS.items()):
+        table = response_rates(prepared, by)
+        cigarettes = prepared.groupby(by, observed=True).cigarettes.mean().rename('mean_cigarettes')
+        table = table.merge(cigarettes.reset_index(), on=by, how='left')
+        table.insert(0, 'level', level)
+        tables.append(table)
+    return pd.concat(tables, ignore_index=True)[['level'] + columns + ['sent', 'replied', 'response_rate',
+                                                                       'mean_cigarettes']]
+
+
+def write_cohort_summary(csv_path, cohort: pd.DataFrame = None, store=None):
+    """
+    Write the cohort response rates and daily cigarette counts from all conversations.
+
+    :param csv_path: Directory for the summary files, and containing older conversation files
+    :param cohort: Optional DataFrame with participant_id, condition and quit_date columns
+    :param store: Store with a conversations table (default = only read conversation files)
+    :return: Status message
+    """
+    csv_path = Path(csv_path)
+    if store is not None:
+        conversations = load_conversations(store, csv_path)
+    else:
+        conversations = load_conversation_csvs(csv_path)
+    if conversations.empty:
+        return 'No conversation files found.'
+
+    prepared = prepare(conversations, cohort)
+    tidy_table(prepared).to_csv(csv_path / 'cohort_response_rates.csv', index=False)
+    cigarette_series(prepared).to_csv(csv_path / 'cohort_cigarettes.csv', index=False, date_format='%x')
+
+    n = prepared.participant_id.nunique()
+    return f'Cohort summary for {n} participants written to cohort_response_rates.csv and cohort_cigarettes.csv'
@@ -1,20 +1,43 @@
+from collections import Counter, deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import contextvars
 from datetime import datetime
+from functools import lru_cache
+import heapq
+import itertools
+import json
+import threading
 import time
 from typing import List
-import logging.config
+import logging
 import zoneinfo
-import jsonpickle
 import requests
 from requests.auth import HTTPBasicAuth
 
-from src.mylogging import DEFAULT_LOGGING
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 from src.constants import TZ_CODES
+from src.enums import Priority
+from src.metrics import APPTOTO_REQUEST_SECONDS, APPTOTO_RESPONSES, APPTOTO_RETRIES, APPTOTO_LIMITER_WAIT_SECONDS
+from src.metrics import APPTOTO_LIMITER_QUEUE
+from src.breaker import CircuitBreaker
+from src.singleflight import SingleFlight
 
-logging.config.dictConfig(DEFAULT_LOGGING)
 logger = logging.getLogger(__name__)
 
 
+@lru_cache(maxsize=None)
+def _tzinfo(time_zone: str):
+    return zoneinfo.ZoneInfo(TZ_CODES[time_zone])
+
+
 class ApptotoParticipant:
+    __slots__ = ('name', 'phone', 'email', 'contact_id', 'contact_external_id')
+
     def __init__(self, name=None, phone=None, email=None, apptoto_id=None, external_id=None):
         """
         Create an ApptotoParticipant.
@@ -33,8 +56,14 @@ class ApptotoParticipant:
         self.contact_id = apptoto_id
         self.contact_external_id = external_id
 
+    def to_dict(self):
+        return {'name': self.name, 'phone': self.phone, 'email': self.email,
+                'contact_id': self.contact_id, 'contact_external_id': self.contact_external_id}
+
 
 class ApptotoEvent:
+    __slots__ = ('calendar', 'title', 'start_time', 'end_time', 'content', 'participants', 'external_id')
+
     def __init__(self, calendar: str, title: str, start_time: datetime,
                  content: str, participants: List[ApptotoParticipant],
                  end_time: datetime = None, external_id=None, time_zone='PT'):
@@ -43,6 +72,8 @@ class ApptotoEvent:
 
         An ApptotoEvent represents a single event.
         Messages will be sent at `start_time` to all `participants`.
+        Events for the same participant should share one `participants` list,
+        it is not copied.
 
         :param str calendar: Calendar name
         :param str title: Event title
@@ -54,7 +85,7 @@ class ApptotoEvent:
         """
         self.calendar = calendar
         self.title = title
-        tzinfo = zoneinfo.ZoneInfo(TZ_CODES[time_zone])
+        tzinfo = _tzinfo(time_zone)
         self.start_time = (start_time.replace(tzinfo=tzinfo)).isoformat()
         if not end_time:
             self.end_time = self.start_time
@@ -64,6 +95,74 @@ class ApptotoEvent:
         self.participants = participants
         self.external_id = external_id
 
+    def to_dict(self):
+        return {'calendar': self.calendar, 'title': self.title,
+                'start_time': self.start_time, 'end_time': self.end_time,
+                'content': self.content, 'participants': self.participants,
+                'external_id': self.external_id}
+
+
+ExternalId = namedtuple('ExternalId', ['participant_id', 'event_type', 'slot', 'uo_id'])
+
+
+def make_external_id(participant_id: str, event_type: str, slot: int, uo_id=None):
+    """
+    Make an event external id that identifies a scheduled message,
+    e.g. 'ASH001:sms:12:345' for the 13th intervention message, UO_ID 345.
+
+    :param participant_id: Participant id
+    :param event_type: Type of event, e.g. 'sms'
+    :param slot: Position of the event among events of this type
+    :param uo_id: UO_ID of the message content, if it came from the message bank
+    :return: External id string
+    """
+    parts = [participant_id, event_type, str(slot)]
+    if uo_id is not None:
+        parts.append(str(uo_id))
+    return ':'.join(parts)
+
+
+def parse_external_id(external_id):
+    """
+    Parse an external id made by make_external_id.
+
+    :param external_id: External id of an event
+    :return: ExternalId, or None if the event has no external id in this form
+    """
+    if not isinstance(external_id, str):
+        return None
+    parts = external_id.split(':')
+    if len(parts) not in (3, 4) or not parts[2].isdigit():
+        return None
+    return ExternalId(parts[0], parts[1], int(parts[2]), parts[3] if len(parts) == 4 else None)
+
+
+def _json_default(obj):
+    if isinstance(obj, (ApptotoEvent, ApptotoParticipant)):
+        return obj.to_dict()
+    if hasattr(obj, 'isoformat'):
+        return obj.isoformat()
+    if hasattr(obj, 'item'):
+        # numpy scalars from DataFrame records
+        return obj.item()
+    raise TypeError(f'Object of type {type(obj).__name__} is not JSON serializable')
+
+
+def encode_json(data) -> bytes:
+    """
+    Encode an apptoto request body.
+
+    ApptotoEvent and ApptotoParticipant objects are encoded as plain objects,
+    and datetimes as ISO 8601 strings. Uses orjson if it is installed.
+
+    :param data: Request data
+    :return: JSON encoded request body
+    """
+    if orjson is not None:
+        return orjson.dumps(data, default=_json_default,
+                            option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS)
+    return json.dumps(data, default=_json_default).encode('utf-8')
+
 
 class ApptotoError(Exception):
     def __init__(self, message):
@@ -75,27 +174,262 @@ class ApptotoError(Exception):
         self.message = message
 
 
+class Clock:
+    """Wall clock used by RateLimiter, replaced by a virtual clock when emulating apptoto."""
+
+    def monotonic(self):
+        return time.monotonic()
+
+    def sleep_until(self, t):
+        delay = t - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+
+# priority of the apptoto requests made in a context, see request_priority
+priority = contextvars.ContextVar('priority', default=Priority.UPLOAD)
+
+
+@contextmanager
+def request_priority(value: Priority):
+    """
+    Send the apptoto requests made in the context with priority `value`, e.g.
+    `with request_priority(Priority.DELETE):`
+    Threads started with a copy of the context, as pages of a listing are, keep the priority.
+    """
+    token = priority.set(value)
+    try:
+        yield
+    finally:
+        priority.reset(token)
+
+
+class RateLimiter:
+    AGING = 30  # seconds of waiting that raise a request's priority by one level
+
+    def __init__(self, interval: float, clock: Clock = None):
+        """
+        Create a RateLimiter.
+
+        A RateLimiter spaces requests at least `interval` seconds apart,
+        even when they are made from several threads at once.
+        Each slot goes to the waiting request with the highest priority (see request_priority),
+        so a delete waits for at most the request being sent, not for every upload queued before it.
+        Waiting requests rise one priority level every AGING seconds, so crawls are never starved.
+
+        :param interval: Minimum number of seconds between requests
+        :param clock: Clock to read and sleep on (default = wall clock)
+        """
+        self.interval = interval
+        self.clock = clock or Clock()
+        self.waited = 0.0  # total seconds callers have spent blocked
+        self._cond = threading.Condition()
+        self._next_slot = 0.0
+        self._waiting = []  # heap of (rank, arrival, priority)
+        self._arrivals = itertools.count()
+
+    def queue_depth(self):
+        """
+        :return: dict of Priority to the number of requests waiting
+        """
+        with self._cond:
+            return Counter(Priority(level) for _, _, level in self._waiting)
+
+    def wait(self, level: Priority = None):
+        """
+        Block until the caller's request slot.
+
+        :param level: Priority of the request (default = priority in the caller's context)
+        :return: Seconds spent waiting
+        """
+        level = priority.get() if level is None else level
+        name = Priority(level).name.lower()
+        start = self.clock.monotonic()
+        # rising a level every AGING seconds keeps the waiting order, so it is fixed on arrival
+        entry = (level * self.AGING + start, next(self._arrivals), level)
+
+        with self._cond:
+            heapq.heappush(self._waiting, entry)
+            APPTOTO_LIMITER_QUEUE.inc(name)
+            try:
+                while True:
+                    if self._waiting[0] is not entry:
+                        self._cond.wait()
+                        continue
+                    now = self.clock.monotonic()
+                    if now >= self._next_slot:
+                        self._next_slot = now + self.interval
+                        break
+                    # sleep until the slot, then check that no request with a higher priority came first
+                    slot = self._next_slot
+                    self._cond.release()
+                    try:
+                        self.clock.sleep_until(slot)
+                    finally:
+                        self._cond.acquire()
+            finally:
+                self._waiting.remove(entry)
+                heapq.heapify(self._waiting)
+                APPTOTO_LIMITER_QUEUE.dec(name)
+                self._cond.notify_all()
+            waited = self.clock.monotonic() - start
+            self.waited += waited
+
+        APPTOTO_LIMITER_WAIT_SECONDS.observe(waited, name)
+        return waited
+
+
 class Apptoto:
     MAX_EVENTS = 200  # Max number of events to retrieve at one time
     MAX_POST = 15  # Max number of events to post at one time
-    TIMEOUT = 240
+    # seconds to connect and to wait for a response, larger for pages of events with conversations
+    TIMEOUT = (5, 60)
+    CONVERSATIONS_TIMEOUT = (5, 180)
+    PROBE_TIMEOUT = (5, 10)
     # seconds between requests for apptoto burst rate limit, 100 requests per minute
     # minimum = 0.6
     REQUEST_LIMIT = 0.6
     ENDPOINT = 'https://api.apptoto.com/v1'
     HEADERS = {'Content-Type': 'application/json'}
     RETRY = 5  # number of times to retry request
-
-    def __init__(self, api_token: str, user: str):
+    PREFETCH = 3  # max number of pages of a listing requested at one time
+
+    # the burst rate limit applies to the apptoto account, so it is shared by all instances
+    limiter = RateLimiter(REQUEST_LIMIT)
+    # after 5 requests in a row get no response or a 503, requests fail fast (or wait,
+    # see breaker.parked) until a health probe finds apptoto up again
+    breaker = CircuitBreaker('apptoto')
+    # jobs for the same participant running together share contact lookups and event crawls
+    contacts = SingleFlight('apptoto_contact')
+    event_crawls = SingleFlight('apptoto_events_by_contact')
+
+    def __init__(self, api_token: str, user: str, endpoint: str = None):
         """
         Create an Apptoto instance.
 
         :param api_token: Apptoto API token
         :param user: Apptoto user name
+        :param endpoint: API endpoint (default = ENDPOINT, the apptoto API)
         """
         self._api_token = api_token
         self._user = user
-        self._last_request_time = time.time()
+        if endpoint:
+            self.ENDPOINT = endpoint
+        self._session = requests.Session()
+        self._session.headers.update(self.HEADERS)
+        self._session.auth = HTTPBasicAuth(username=self._user, password=self._api_token)
+
+    def _probe(self):
+        # a small request, to see if apptoto is up again
+        self.limiter.wait()
+        r = self._session.get(f'{self.ENDPOINT}/address_books', timeout=self.PROBE_TIMEOUT)
+        return r.status_code != requests.codes.service_unavailable
+
+    def _request(self, method: str, path: str, cancel: threading.Event = None, timeout=None, **kwargs):
+        """
+        Send a request to the apptoto API once a slot in the rate limit is available.
+
+        :param method: HTTP method
+        :param path: API path after the endpoint, e.g. 'events'
+        :param cancel: If set while waiting for a slot, the request is not sent
+        :param timeout: (connect, read) seconds (default = TIMEOUT)
+        :return: Response, or None if the request was cancelled
+        :raises CircuitOpenError: if apptoto is down
+        """
+        self.limiter.wait()
+        if cancel is not None and cancel.is_set():
+            return None
+        self.breaker.before(probe=self._probe)
+
+        start = time.perf_counter()
+        status = 'error'
+        try:
+            r = self._session.request(method, f'{self.ENDPOINT}/{path}', timeout=timeout or self.TIMEOUT, **kwargs)
+        except (requests.ConnectionError, requests.Timeout):
+            self.breaker.failed()
+            raise
+        except requests.RequestException:
+            # a request that could not be made, not a sign that apptoto is down
+            self.breaker.succeeded()
+            raise
+        else:
+            status = str(r.status_code)
+            # other errors, e.g. the 502 for a batch of events that is too large, are caused by the request
+            if r.status_code == requests.codes.service_unavailable:
+                self.breaker.failed()
+            else:
+                self.breaker.succeeded()
+            return r
+        finally:
+            APPTOTO_REQUEST_SECONDS.observe(time.perf_counter() - start, method, path)
+            APPTOTO_RESPONSES.inc(method, path, status)
+
+    def _get_page(self, path: str, params: dict, cancel: threading.Event):
+        r = None
+        attempts = 0
+
+        while not r and attempts < self.RETRY:
+            if attempts:
+                APPTOTO_RETRIES.inc('GET', path)
+            timeout = self.CONVERSATIONS_TIMEOUT if params.get('include_conversations') else None
+            r = self._request('GET', path, cancel=cancel, timeout=timeout, params=params)
+            if cancel.is_set():
+                return None
+            attempts = attempts + 1
+
+        return r
+
+    def _paginate(self, path: str, key: str, params: dict, max_to_retrieve=None):
+        """
+        Get a paginated apptoto listing, yielding the records of each page in order.
+
+        While one page is read, the following pages are requested concurrently.
+        The listing ends at the first page shorter than the page size, or once
+        `max_to_retrieve` records are read; pages requested past that point are cancelled.
+
+        :param path: API path of the listing, e.g. 'events'
+        :param key: Key of the records in each response, e.g. 'events'
+        :param params: Query parameters, including page_size
+        :param max_to_retrieve: Stop after this many records (default = no limit)
+        """
+        page_size = params['page_size']
+        cancel = threading.Event()
+        pool = ThreadPoolExecutor(max_workers=self.PREFETCH)
+        pending = deque()
+        next_page = 1
+        retrieved = 0
+
+        def request_next_page():
+            nonlocal next_page
+            # run in a copy of the caller's context, so log records keep its participant, job and phase
+            context = contextvars.copy_context()
+            pending.append(pool.submit(context.run, self._get_page, path, dict(params, page=next_page), cancel))
+            next_page += 1
+
+        try:
+            request_next_page()
+            while pending:
+                r = pending.popleft().result()
+
+                if r.status_code != requests.codes.ok:
+                    raise ApptotoError('Failed to get {}: {}'.format(key, r.status_code))
+
+                records = r.json()[key]
+                retrieved += len(records)
+                if records:
+                    yield records
+
+                if len(records) < page_size or (max_to_retrieve and retrieved >= max_to_retrieve):
+                    break
+
+                # the first page was full, so keep PREFETCH pages in flight from here on
+                while len(pending) < self.PREFETCH:
+                    request_next_page()
+        finally:
+            cancel.set()
+            for f in pending:
+                f.cancel()
+            pool.shutdown(wait=False)
 
     def post_events(self, events: list):
         """
@@ -103,141 +437,102 @@ class Apptoto:
 
         :param events: List of events to create
         """
-        url = f'{self.ENDPOINT}/events'
-
         # Post num_events events at a time because Apptoto's API can't handle all events at once.
         # Too many events results in "bad gateway" error
         num_events = self.MAX_POST
         posted_events = []
         for i in range(0, len(events), num_events):
             events_slice = events[i:i + num_events]
-            request_data = jsonpickle.encode({'events': events_slice, 'prevent_calendar_creation': True},
-                                             unpicklable=False)
             logger.info('Posting events {} through {} of {} to apptoto'.format(i + 1, i + len(events_slice),
                                                                                len(events)))
-            attempts = 0
-
-            while attempts < self.RETRY:
-
-                while (time.time() - self._last_request_time) < self.REQUEST_LIMIT:
-                    time.sleep(0.1)
+            posted_events.extend(self._send_events('POST', events_slice))
 
-                print(f'lrt diff: {time.time() - self._last_request_time}')
+        return posted_events
 
-                self._last_request_time = time.time()
-                r = requests.post(url=url,
-                                  data=request_data,
-                                  headers=self.HEADERS,
-                                  timeout=self.TIMEOUT,
-                                  auth=HTTPBasicAuth(username=self._user, password=self._api_token))
+    def _send_events(self, method: str, events: list):
+        """
+        Send a batch of events to the /v1/events API, trying again if it fails.
 
-                if r.status_code == requests.codes.ok:
-                    break
-                else:
-                    attempts = attempts + 1
+        Apptoto answers a batch that is too large with 502 (bad gateway), so such a batch
+        is sent again in two halves, rather than as it was.
 
-            if r.status_code != requests.codes.ok:
-                # logger.info('Failed to post events {} through {}, starting at {}'.format(i+1, len(events_slice),
-                # events[i].start_time))
-                logger.error(f'Failed to post events - {str(r.status_code)} - {str(r.content)}')
-                raise ApptotoError('Failed to post events: {}'.format(r.status_code))
+        :param method: 'POST' to create the events, 'PUT' to update them
+        :param events: Events to send
+        :return: Events in apptoto's response
+        """
+        request_data = encode_json({'events': events, 'prevent_calendar_creation': True})
+        for attempt in range(self.RETRY):
+            if attempt:
+                APPTOTO_RETRIES.inc(method, 'events')
+            r = self._request(method, 'events', data=request_data)
+            self.event_crawls.forget()
 
-            posted_events.extend(r.json()['events'])
+            if r.status_code == requests.codes.ok:
+                return r.json()['events']
+            if r.status_code == requests.codes.bad_gateway and len(events) > 1:
+                half = len(events) // 2
+                logger.info(f'Apptoto could not take {len(events)} events at once, sending them in two halves')
+                return self._send_events(method, events[:half]) + self._send_events(method, events[half:])
+            logger.info(f'Failed to send events - {r.status_code}, trying {self.RETRY - attempt - 1} more times')
 
-        return posted_events
+        action = 'post' if method == 'POST' else 'update'
+        logger.error(f'Failed to {action} events - {str(r.status_code)} - {str(r.content)}')
+        raise ApptotoError(f'Failed to {action} events: {r.status_code}')
 
     def delete_event(self, event_id: int):
-        url = f'{self.ENDPOINT}/events'
         params = {'id': event_id}
 
-        while (time.time() - self._last_request_time) < self.REQUEST_LIMIT:
-            time.sleep(0.1)
-
-        r = requests.delete(url=url,
-                            params=params,
-                            headers=self.HEADERS,
-                            timeout=self.TIMEOUT,
-                            auth=HTTPBasicAuth(username=self._user, password=self._api_token))
-
-        self._last_request_time = time.time()
+        r = self._request('DELETE', 'events', params=params)
+        self.event_crawls.forget()
 
         if not r.status_code == requests.codes.ok:
             raise ApptotoError('Failed to delete event {}: error {}'.format(event_id, r.status_code))
 
     def get_event(self, event_id, include_conversations=False):
-        url = f'{self.ENDPOINT}/event'
-
         params = {'id': event_id, 'include_conversations': include_conversations}
 
-        while (time.time() - self._last_request_time) < self.REQUEST_LIMIT:
-            time.sleep(0.1)
-        r = requests.get(url=url,
-                         params=params,
-                         headers=self.HEADERS,
-                         timeout=self.TIMEOUT,
-                         auth=HTTPBasicAuth(username=self._user, password=self._api_token))
+        r = self._request('GET', 'event', params=params)
 
-        self._last_request_time = time.time()
         if r.status_code == requests.codes.ok:
             return r.json()
 
     # max_to_retrieve
     # this is just for while I'm working on things -- change max to a big number when not testing
     # otherwise sometimes I mess up and retrieve EVERYTHING from all users and it's a pain
-    def get_events(self, max_to_retrieve=9999, **kwargs):
-        url = f'{self.ENDPOINT}/events'
+    def iter_events(self, max_to_retrieve=9999, **kwargs):
+        """
+        Get events from the /v1/events API, yielding each event as its page arrives.
 
-        events = []
-        page = 0
+        :param max_to_retrieve: Stop after this many events
+        :param kwargs: Query parameters, e.g. begin, end, phone_number
+        """
+        found = 0
 
         kwargs['page_size'] = self.MAX_EVENTS
 
-        while True:
-            page += 1
-            kwargs['page'] = page
-
-            r = None
-            attempts = 0
-
-            while not r and attempts < self.RETRY:
-                while (time.time() - self._last_request_time) < self.REQUEST_LIMIT:
-                    time.sleep(0.1)
-
-                r = requests.get(url=url,
-                                 params=kwargs,
-                                 headers=self.HEADERS,
-                                 timeout=self.TIMEOUT,
-                                 auth=HTTPBasicAuth(username=self._user, password=self._api_token))
-
-                self._last_request_time = time.time()
-                attempts = attempts + 1
-
-            if r.status_code == requests.codes.ok:
-                new_events = r.json()['events']
-
-            else:
-                raise ApptotoError('Failed to get events: {}'.format(r.status_code))
-
-            if new_events:
-                events.extend(new_events)
-                logger.info('Found {} events'.format(len(events)))
-            else:
-                break
+        for new_events in self._paginate('events', 'events', kwargs, max_to_retrieve):
+            found += len(new_events)
+            logger.info('Found {} events'.format(found))
+            yield from new_events
 
-            if len(events) > max_to_retrieve:
-                break
+    def get_events(self, max_to_retrieve=9999, **kwargs):
+        return list(self.iter_events(max_to_retrieve, **kwargs))
 
-        return events
+    def _flight_key(self, *args, **kwargs):
+        return (self.ENDPOINT, self._user, *args, *sorted(kwargs.items()))
 
     # ex: get_contact(external_id='TAG999')
     def get_contact(self, **kwargs):
-        url = f'{self.ENDPOINT}/contact'
+        """
+        Get a contact from the /v1/contact API.
+        Concurrent lookups of the same contact share one request.
+
+        :param kwargs: Query parameters, e.g. external_id
+        """
+        return self.contacts.do(self._flight_key(**kwargs), self._get_contact, **kwargs)
 
-        r = requests.get(url=url,
-                         params=kwargs,
-                         headers=self.HEADERS,
-                         timeout=self.TIMEOUT,
-                         auth=HTTPBasicAuth(username=self._user, password=self._api_token))
+    def _get_contact(self, **kwargs):
+        r = self._request('GET', 'contact', params=kwargs)
 
         if r.status_code == requests.codes.ok:
             return r.json()
@@ -251,21 +546,11 @@ class Apptoto:
         :contact must include name, address_book
         :see apptoto api docs for full info
         """
-        url = f'{self.ENDPOINT}/contacts'
-
-        request_data = jsonpickle.encode({'contacts': [contact]}, unpicklable=False)
+        request_data = encode_json({'contacts': [contact]})
         logger.info(f"Posting contact {contact['name']} to apptoto")
 
-        while (time.time() - self._last_request_time) < self.REQUEST_LIMIT:
-            time.sleep(0.1)
-
-        r = requests.post(url=url,
-                          data=request_data,
-                          headers=self.HEADERS,
-                          timeout=self.TIMEOUT,
-                          auth=HTTPBasicAuth(username=self._user, password=self._api_token))
-
-        self._last_request_time = time.time()
+        r = self._request('POST', 'contacts', data=request_data)
+        self.contacts.forget()
 
         if r.status_code != requests.codes.ok:
             logger.error(f'Failed to post contact - {str(r.status_code)} - {str(r.content)}')
@@ -278,51 +563,69 @@ class Apptoto:
         must include id or external_id to update existing contact
         see apptoto api docs for full info
         """
-        url = f'{self.ENDPOINT}/contacts'
-
-        request_data = jsonpickle.encode({'contacts': [contact]}, unpicklable=False)
+        request_data = encode_json({'contacts': [contact]})
 
         if not isinstance(contact['name'], str):
-            print('contact has no name')
-            print(contact)
+            logger.warning(f'Contact has no name: {contact}')
             return
 
         logger.info('Updating contact {} in apptoto'.format(contact['name']))
 
-        while (time.time() - self._last_request_time) < self.REQUEST_LIMIT:
-            time.sleep(0.1)
-
-        r = requests.put(url=url,
-                         data=request_data,
-                         headers=self.HEADERS,
-                         timeout=self.TIMEOUT,
-                         auth=HTTPBasicAuth(username=self._user, password=self._api_token))
-
-        self._last_request_time = time.time()
+        r = self._request('PUT', 'contacts', data=request_data)
+        self.contacts.forget()
 
         if r.status_code != requests.codes.ok:
             logger.error(f'Failed to post contact - {str(r.status_code)} - {str(r.content)}')
             raise ApptotoError('Failed to post contact: {}'.format(r.status_code))
 
-    def get_events_by_contact(self, begin: datetime, external_id: str, include_email=False,
-                              calendar_id=None, include_conversations=False):
+    def iter_events_by_contact(self, begin: datetime, external_id: str, include_email=False,
+                               calendar_id=None, include_conversations=False, end: datetime = None):
+        """
+        Get events for every phone number (and optionally email address) of a contact,
+        yielding each event as its page arrives.
+
+        Each address is queried with the same begin/end window and calendar, and the
+        results are merged as they arrive, keeping the first copy of each event id.
+
+        :param begin: Earliest event start time
+        :param external_id: Contact external id, e.g. 'ASH001'
+        :param include_email: Also search the contact's email addresses
+        :param calendar_id: Only return events on this calendar
+        :param include_conversations: Include conversation messages in the events
+        :param end: Latest event start time (default = no bound)
+        """
         contact = self.get_contact(external_id=external_id)
-        phone_numbers = [p.get('normalized') for p in contact.get('phone_numbers')]
-        email_addresses = [e.get('address') for e in contact.get('email_addresses')]
-        events = []
-
-        for phone in phone_numbers:
-            events.extend(self.get_events(begin=begin.isoformat(), phone_number=phone,
-                                          include_conversations=include_conversations))
+        queries = [{'phone_number': p.get('normalized')} for p in contact.get('phone_numbers')]
         if include_email:
-            for email in email_addresses:
-                events.extend(self.get_events(begin=begin.isoformat(), email_address=email,
-                                              include_conversations=include_conversations))
+            queries.extend({'email_address': e.get('address')} for e in contact.get('email_addresses'))
 
+        params = {'begin': begin.isoformat(), 'include_conversations': include_conversations}
+        if end:
+            params['end'] = end.isoformat()
         if calendar_id:
-            events = [e for e in events if e.get('calendar_id') == calendar_id]
+            params['calendar_id'] = calendar_id
+
+        seen = set()
+        for query in queries:
+            for e in self.iter_events(**params, **query):
+                if e['id'] in seen:
+                    continue
+                seen.add(e['id'])
+                # the calendar is also filtered by apptoto, this guards against it being ignored
+                if calendar_id and e.get('calendar_id') != calendar_id:
+                    continue
+                yield e
 
-        return events
+    def get_events_by_contact(self, begin: datetime, external_id: str, include_email=False,
+                              calendar_id=None, include_conversations=False, end: datetime = None):
+        """
+        Get events for every phone number (and optionally email address) of a contact,
+        see iter_events_by_contact. Concurrent identical crawls share one crawl.
+        """
+        kwargs = dict(include_email=include_email, calendar_id=calendar_id,
+                      include_conversations=include_conversations, end=end)
+        return self.event_crawls.do(self._flight_key(begin, external_id, **kwargs),
+                                    lambda: list(self.iter_events_by_contact(begin, external_id, **kwargs)))
 
     def put_events(self, events: list):
         """
@@ -330,59 +633,26 @@ class Apptoto:
 
         :param events: List of events to update
         """
-        url = f'{self.ENDPOINT}/events'
-
         # Post num_events events at a time because Apptoto's API can't handle all events at once.
         # Too many events results in "bad gateway" error
         num_events = self.MAX_POST
         for i in range(0, len(events), num_events):
             events_slice = events[i:i + num_events]
-            request_data = jsonpickle.encode({'events': events_slice, 'prevent_calendar_creation': True},
-                                             unpicklable=False)
             logger.info('Posting events {} through {} of {} to apptoto'.format(i + 1, i + len(events_slice),
                                                                                len(events)))
+            self._send_events('PUT', events_slice)
 
-            # just try again if it doesn't work
-            max_attempts = 5
-            remaining_attempts = max_attempts
-            success = False
-            while remaining_attempts and not success:
-                while (time.time() - self._last_request_time) < self.REQUEST_LIMIT:
-                    time.sleep(0.1)
-
-                r = requests.put(url=url,
-                                 data=request_data,
-                                 headers=self.HEADERS,
-                                 timeout=self.TIMEOUT,
-                                 auth=HTTPBasicAuth(username=self._user, password=self._api_token))
-
-                self._last_request_time = time.time()
-
-                if r.status_code != requests.codes.ok:
-                    remaining_attempts = remaining_attempts - 1
-                    s = 's' if remaining_attempts else ''
-                    logger.info(f'Failed to post, trying {remaining_attempts} more time{s}')
-                else:
-                    success = True
-
-            if r.status_code != requests.codes.ok:
-                # logger.info('Failed to post events {} through {}, starting at {}'.format(i+1, len(events_slice),
-                #                                                                             events[i].start_time))
-
-                logger.error(f'Failed to update events - {str(r.status_code)} - {str(r.content)}')
-                raise ApptotoError('Failed to update events: {}'.format(r.status_code))
+    def iter_contacts(self, address_book_name=None):
+        """
+        Get contacts from the /v1/contacts API, yielding each contact as its page arrives.
 
-    def get_all_contacts(self, address_book_name=None):
+        :param address_book_name: Only yield contacts in this address book
+        """
         params = {'page_size': self.MAX_EVENTS}
         book_id = None
 
         if address_book_name:
-            url = f'{self.ENDPOINT}/address_books'
-
-            r = requests.get(url=url,
-                             headers=self.HEADERS,
-                             timeout=self.TIMEOUT,
-                             auth=HTTPBasicAuth(username=self._user, password=self._api_token))
+            r = self._request('GET', 'address_books')
 
             if r.status_code != requests.codes.ok:
                 raise ApptotoError('Failed to get apptoto address books: {}'.format(r.status_code))
@@ -391,47 +661,18 @@ class Apptoto:
             params['address_book_id'] = book_id
             # unfortunately address_book_id appears to be broken so this doesn't actually work
 
-        url = f'{self.ENDPOINT}/contacts'
+        found = 0
 
-        contacts = []
-        page = 0
+        for new_contacts in self._paginate('contacts', 'contacts', params):
+            found += len(new_contacts)
+            logger.info('Found {} contacts'.format(found))
 
-        while True:
-            page += 1
-            params['page'] = page
+            if book_id:
+                new_contacts = [x for x in new_contacts if x['address_book_id'] == book_id]
+            yield from new_contacts
 
-            r = None
-            attempts = 0
-
-            while not r and attempts < 5:
-                while (time.time() - self._last_request_time) < self.REQUEST_LIMIT:
-                    time.sleep(0.1)
-
-                r = requests.get(url=url,
-                                 params=params,
-                                 headers=self.HEADERS,
-                                 timeout=self.TIMEOUT,
-                                 auth=HTTPBasicAuth(username=self._user, password=self._api_token))
-
-                self._last_request_time = time.time()
-                attempts = attempts + 1
-
-            if r.status_code == requests.codes.ok:
-                new_contacts = r.json()['contacts']
-
-            else:
-                raise ApptotoError('Failed to get contacts: {}'.format(r.status_code))
-
-            if new_contacts:
-                contacts.extend(new_contacts)
-                logger.info('Found {} contacts'.format(len(contacts)))
-            else:
-                break
-
-        if book_id:
-            contacts = [x for x in contacts if x['address_book_id'] == book_id]
-
-        return contacts
+    def get_all_contacts(self, address_book_name=None):
+        return list(self.iter_contacts(address_book_name))
 
     def delete_contact(self, apptoto_id):
         """
@@ -439,21 +680,9 @@ class Apptoto:
         :param apptoto_id: contact to delete
         see apptoto api docs for full info
         """
-        url = f'{self.ENDPOINT}/contacts'
-
-        request_data = jsonpickle.encode({'id': apptoto_id}, unpicklable=False)
-
-        # slowed this down because I was hitting burst rate limits
-        while (time.time() - self._last_request_time) < self.REQUEST_LIMIT:
-            time.sleep(0.3)
-
-        r = requests.delete(url=url,
-                            data=request_data,
-                            headers=self.HEADERS,
-                            timeout=self.TIMEOUT,
-                            auth=HTTPBasicAuth(username=self._user, password=self._api_token))
+        request_data = encode_json({'id': apptoto_id})
 
-        self._last_request_time = time.time()
+        r = self._request('DELETE', 'contacts', data=request_data)
 
         if r.status_code != requests.codes.ok:
             logger.error(f'Failed to delete contact - {str(r.status_code)} - {str(r.content)}')
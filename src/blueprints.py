@@ -1,15 +1,22 @@
+import hmac
+import io
 from pathlib import Path
-import logging.config
+import logging
+import uuid
 import zipfile
 from datetime import date
 
 import flask
 
-from src.participant import RedcapParticipant
-from src.mylogging import DEFAULT_LOGGING
+from src.participant import RedcapParticipant, export_records
+from src.mylogging import DEFAULT_LOGGING, log_context
 from src.executor import executor
+from src.breaker import parked
 from src.constants import DOWNLOAD_DIR
-from src.event_generator import EventGenerator
+from src.enums import Priority
+from src.dashboard import Dashboard
+from src import metrics
+from src.profiling import profiled
 
 from flask_security import auth_required
 
@@ -18,9 +25,13 @@ auto_bp = flask.Blueprint('auto_bp', __name__)
 if not Path(DOWNLOAD_DIR).exists():
     Path(DOWNLOAD_DIR).mkdir()
 
-logging.config.dictConfig(DEFAULT_LOGGING)
 logger = logging.getLogger(__name__)
 
+# priority of each job's apptoto requests, other jobs upload (see apptoto.RateLimiter)
+JOB_PRIORITIES = {'delete_messages': Priority.DELETE,
+                  'update_contact': Priority.CONTACT,
+                  'get_conversations': Priority.CRAWL}
+
 
 def done(fn):
     if fn.cancelled():
@@ -35,6 +46,68 @@ def done(fn):
                 logger.info(result)
 
 
+def profiling_requested(job):
+    """
+    Jobs are profiled when the form has profile checked, or when
+    the profile_jobs config is True or a list of job names including this one.
+    """
+    if flask.request.form.get('profile'):
+        return True
+    setting = flask.current_app.config['AUTOMATIONCONFIG'].get('profile_jobs', False)
+    return setting is True or (isinstance(setting, (list, tuple)) and job in setting)
+
+
+def submit_job(fn, subject=None, *args):
+    """
+    Run a job in the executor, profiling it if requested.
+
+    :param fn: Job, e.g. eg.generate_messages
+    :param subject: Participant id the job is for, if any
+    :param args: Arguments of the job
+    :return: Future of the job's result
+    """
+    if profiling_requested(fn.__name__):
+        fn = profiled(fn, subject)
+
+    job_id = uuid.uuid4().hex[:8]
+    priority = JOB_PRIORITIES.get(fn.__name__, Priority.UPLOAD)
+    # jobs fail at once while apptoto or REDCap is down, unless configured to wait for it,
+    # which keeps an executor thread for as long as they wait
+    park = 60 * flask.current_app.config['AUTOMATIONCONFIG'].get('park_minutes', 0)
+
+    def run(*job_args):
+        from src.apptoto import request_priority
+
+        # runs in the executor's thread, so the context is set there, with no phase left by its last job
+        with log_context(participant_id=subject, job=fn.__name__, job_id=job_id, phase=None), \
+                request_priority(priority), \
+                parked(park):
+            return fn(*job_args)
+
+    future_response = executor.submit(run, *args)
+    future_response.add_done_callback(done)
+    return future_response
+
+
+def job_log_context(job, subject):
+    """
+    Log context for a job run in the request, rather than in the executor.
+
+    :param job: Job name, e.g. 'daily_diary_one'
+    :param subject: Participant id the job is for
+    """
+    return log_context(participant_id=subject, job=job, job_id=uuid.uuid4().hex[:8], phase=None)
+
+
+def event_generator(subject):
+    # imported here rather than at the top, so workers start without loading pandas
+    from src.event_generator import EventGenerator
+
+    return EventGenerator(config=flask.current_app.config['AUTOMATIONCONFIG'],
+                          participant_id=subject,
+                          instance_path=Path(flask.current_app.instance_path))
+
+
 # get subject object from id in form
 def get_subject():
     subject_id = flask.request.form['participant']
@@ -51,17 +124,16 @@ def diary1():
     if not subject:
         return 'none'
 
-    try:
-        eg = EventGenerator(config=flask.current_app.config['AUTOMATIONCONFIG'],
-                            participant_id=subject,
-                            instance_path=Path(flask.current_app.instance_path))
-        m = eg.daily_diary_one()
+    with job_log_context('daily_diary_one', subject):
+        try:
+            eg = event_generator(subject)
+            m = eg.daily_diary_one()
 
-    except Exception as err:
-        logger.error(str(err))
-        return str(err)
+        except Exception as err:
+            logger.error(str(err))
+            return str(err)
 
-    logger.info(m)
+        logger.info(m)
     return 'success'
 
 
@@ -72,17 +144,16 @@ def diary2():
     if not subject:
         return 'none'
 
-    try:
-        eg = EventGenerator(config=flask.current_app.config['AUTOMATIONCONFIG'],
-                            participant_id=subject,
-                            instance_path=Path(flask.current_app.instance_path))
-        m = eg.daily_diary_three()
+    with job_log_context('daily_diary_three', subject):
+        try:
+            eg = event_generator(subject)
+            m = eg.daily_diary_three()
 
-    except Exception as err:
-        logger.error(str(err))
-        return str(err)
+        except Exception as err:
+            logger.error(str(err))
+            return str(err)
 
-    logger.info(m)
+        logger.info(m)
     return 'success'
 
 
@@ -94,11 +165,8 @@ def generate_messages():
         return 'none'
 
     try:
-        eg = EventGenerator(config=flask.current_app.config['AUTOMATIONCONFIG'],
-                            participant_id=subject,
-                            instance_path=Path(flask.current_app.instance_path))
-        future_response = executor.submit(eg.generate_messages)
-        future_response.add_done_callback(done)
+        eg = event_generator(subject)
+        submit_job(eg.generate_messages, subject)
     except Exception as err:
         logger.error(str(err))
         return str(err)
@@ -117,11 +185,8 @@ def delete_events():
         return 'none'
 
     try:
-        eg = EventGenerator(config=flask.current_app.config['AUTOMATIONCONFIG'],
-                            participant_id=subject,
-                            instance_path=Path(flask.current_app.instance_path))
-        future_response = executor.submit(eg.delete_messages)
-        future_response.add_done_callback(done)
+        eg = event_generator(subject)
+        submit_job(eg.delete_messages, subject)
     except ValueError as err:
         logger.error(str(err))
         return str(err)
@@ -139,18 +204,26 @@ def task():
     if not subject:
         return 'none'
 
-    try:
-        eg = EventGenerator(config=flask.current_app.config['AUTOMATIONCONFIG'],
-                            participant_id=subject,
-                            instance_path=Path(flask.current_app.instance_path))
-        m = eg.generate_task_files()
+    with job_log_context('generate_task_files', subject):
+        try:
+            eg = event_generator(subject)
+            if flask.request.form.get('zip'):
+                # send the files as a zip without writing them to the download directory
+                archive = io.BytesIO()
+                with zipfile.ZipFile(archive, mode='w') as zf:
+                    m = eg.generate_task_files(archive=zf)
+                logger.info(m)
+                archive.seek(0)
+                return flask.send_file(archive, mimetype='application/zip', as_attachment=True,
+                                       download_name=f'{subject}_task.zip')
+            m = eg.generate_task_files()
 
-    except Exception as err:
-        logger.error(str(err))
-        return str(err)
+        except Exception as err:
+            logger.error(str(err))
+            return str(err)
 
-    logger.info(m)
-    return m
+        logger.info(m)
+        return m
 
 
 @bp.route('/responses', methods=['POST'])
@@ -160,11 +233,8 @@ def responses():
     if not subject:
         return 'none'
     try:
-        eg = EventGenerator(config=flask.current_app.config['AUTOMATIONCONFIG'],
-                            participant_id=subject,
-                            instance_path=Path(flask.current_app.instance_path))
-        future_response = executor.submit(eg.get_conversations)
-        future_response.add_done_callback(done)
+        eg = event_generator(subject)
+        submit_job(eg.get_conversations, subject)
 
     except ValueError as err:
         logger.error(str(err))
@@ -175,6 +245,28 @@ def responses():
     return status
 
 
+def summarize_cohort(redcap_token):
+    from src import analytics
+    from src.store import Store
+
+    cohort = analytics.cohort_from_redcap(export_records(redcap_token))
+    return analytics.write_cohort_summary(DOWNLOAD_DIR, cohort, store=Store())
+
+
+@bp.route('/cohort', methods=['POST'])
+@auth_required()
+def cohort():
+    try:
+        submit_job(summarize_cohort, None, flask.current_app.config['AUTOMATIONCONFIG']['redcap_api_token'])
+    except ValueError as err:
+        logger.error(str(err))
+        return str(err)
+
+    status = 'Summarizing cohort responses'
+    logger.info(status)
+    return status
+
+
 def isisoformat(item):
     try:
         date.fromisoformat(item)
@@ -196,6 +288,72 @@ def progress():
     return flask.render_template('progress.html', messages=daily_messages)
 
 
+@bp.route('/dashboard', methods=['GET'])
+@auth_required()
+def dashboard():
+    return flask.render_template('dashboard.html', summary=Dashboard().summary())
+
+
+@bp.route('/upcoming', methods=['GET'])
+@auth_required()
+def upcoming():
+    # e.g. /upcoming?hours=2&type=sms or /upcoming?begin=2022-01-01T00:00&end=2022-01-02T00:00&participant=ASH001
+    from src.upcoming import ScheduleIndex
+
+    args = flask.request.args
+    index = ScheduleIndex()
+    filters = dict(participant_id=args.get('participant'), event_type=args.get('type'))
+    try:
+        if 'begin' in args or 'end' in args:
+            sends = index.sends(args.get('begin'), args.get('end'), **filters)
+        else:
+            sends = index.next_hours(float(args.get('hours', 2)), **filters)
+    except ValueError as err:
+        return flask.jsonify(error=str(err)), 400
+
+    sends = sends.assign(start_time=sends.start_time.map(lambda t: t.isoformat()))
+    return flask.jsonify(sends.astype(object).where(sends.notna(), None).to_dict(orient='records'))
+
+
+@bp.route('/upcoming/none', methods=['GET'])
+@auth_required()
+def no_upcoming():
+    from src.upcoming import ScheduleIndex
+
+    return flask.jsonify(ScheduleIndex().without_future_sends())
+
+
+@bp.route('/inbound', methods=['POST'])
+def inbound():
+    # apptoto reply and delivery notifications, authenticated with a bearer token instead of the login
+    token = flask.current_app.config['AUTOMATIONCONFIG'].get('inbound_token')
+    if not token:
+        flask.abort(404)
+    sent_token = flask.request.headers.get('Authorization', '').removeprefix('Bearer ')
+    if not hmac.compare_digest(sent_token.encode(), token.encode()):
+        return flask.jsonify(error='invalid token'), 401
+
+    body = flask.request.get_json(silent=True)
+    events = body.get('events') if isinstance(body, dict) else None
+    if not isinstance(events, list) or not all(isinstance(event, dict) for event in events):
+        return flask.jsonify(error='expected {"events": [...]}'), 400
+
+    from src.inbound import record_notifications
+
+    counts = record_notifications(events)
+    if counts.get(None):
+        logger.warning(f'{counts[None]} pushed messages not from a participant event were ignored')
+    received = sum(n for pid, n in counts.items() if pid)
+    return flask.jsonify(received=received), 202
+
+
+@bp.route('/metrics', methods=['GET'])
+@auth_required('session', 'basic')
+def prometheus_metrics():
+    # Prometheus can scrape with basic auth using the login user
+    return flask.Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
 @bp.route('/')
 @auth_required()
 def index():
@@ -231,6 +389,12 @@ def download_files():
     subject = get_subject()
     if not subject:
         return 'none'
+    try:
+        eg = event_generator(subject)
+        logger.info(eg.export_files())
+    except Exception as err:
+        logger.error(str(err))
+
     csv_path = Path(DOWNLOAD_DIR)
     files = csv_path.glob(f'*{subject}*.*')
     compression = zipfile.ZIP_STORED
@@ -248,11 +412,8 @@ def update():
     if not subject:
         return 'none'
     try:
-        eg = EventGenerator(config=flask.current_app.config['AUTOMATIONCONFIG'],
-                            participant_id=subject,
-                            instance_path=Path(flask.current_app.instance_path))
-        future_response = executor.submit(eg.update_contact, True)
-        future_response.add_done_callback(done)
+        eg = event_generator(subject)
+        submit_job(eg.update_contact, subject, True)
 
     except ValueError as err:
         logger.error(str(err))
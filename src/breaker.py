@@ -0,0 +1,188 @@
+import contextvars
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+from src.metrics import CIRCUIT_STATE, CIRCUIT_OPENED
+
+logger = logging.getLogger(__name__)
+
+CLOSED, HALF_OPEN, OPEN = 'closed', 'half_open', 'open'
+STATES = (CLOSED, HALF_OPEN, OPEN)
+
+# seconds a caller waits for an open circuit to close before failing, see parked
+park_seconds = contextvars.ContextVar('park_seconds', default=0)
+
+
+@contextmanager
+def parked(seconds):
+    """
+    Wait up to `seconds` for a backend that is down to recover, instead of failing at once,
+    in the context, e.g. `with parked(600):` around a background job.
+    """
+    token = park_seconds.set(seconds)
+    try:
+        yield
+    finally:
+        park_seconds.reset(token)
+
+
+class CircuitOpenError(Exception):
+    def __init__(self, message):
+        """
+        An exception for calls not made because their backend is down.
+
+        :param message: A string describing the error
+        """
+        super().__init__(message)
+        self.message = message
+
+
+class CircuitBreaker:
+    def __init__(self, name, failures=5, reset_timeout=30, max_reset_timeout=300, clock=None):
+        """
+        Create a CircuitBreaker.
+
+        A CircuitBreaker stops calls to a backend that is down. After `failures` failed calls
+        in a row the circuit opens, and calls fail at once with CircuitOpenError, or wait
+        if they are parked (see parked). After `reset_timeout` seconds one caller checks
+        the backend, with a health probe if there is one, otherwise with its own call
+        (the circuit is half open). If the check succeeds the circuit closes and waiting
+        callers go on; if it fails the circuit opens again for twice as long,
+        up to `max_reset_timeout`.
+
+        :param name: Backend name, the backend label of the circuit metrics
+        :param failures: Failed calls in a row that open the circuit
+        :param reset_timeout: Seconds the circuit first stays open
+        :param max_reset_timeout: Most seconds the circuit stays open
+        :param clock: Clock to read and sleep on, as apptoto.Clock (default = wall clock)
+        """
+        self.name = name
+        self.failures = failures
+        self.reset_timeout = reset_timeout
+        self.max_reset_timeout = max_reset_timeout
+        self.clock = clock
+        self._cond = threading.Condition()
+        self._state = CLOSED
+        self._failed = 0
+        self._open_for = reset_timeout
+        self._opened_until = 0.0
+        self._checking = False
+        CIRCUIT_STATE.set(STATES.index(CLOSED), name)
+
+    @property
+    def state(self):
+        return self._state
+
+    def _now(self):
+        return self.clock.monotonic() if self.clock else time.monotonic()
+
+    def _sleep_until(self, t):
+        if self.clock:
+            self.clock.sleep_until(t)
+        else:
+            time.sleep(max(0.0, t - time.monotonic()))
+
+    def _set_state(self, state):
+        if state != self._state:
+            log = logger.warning if state == OPEN else logger.info
+            log(f'{self.name} circuit {state.replace("_", " ")}')
+            if state == OPEN:
+                CIRCUIT_OPENED.inc(self.name)
+        self._state = state
+        CIRCUIT_STATE.set(STATES.index(state), self.name)
+
+    def _open(self):
+        self._opened_until = self._now() + self._open_for
+        self._set_state(OPEN)
+
+    def before(self, probe=None):
+        """
+        Wait until a call may be made, or raise CircuitOpenError.
+        A call allowed by before must report its outcome with succeeded or failed.
+
+        :param probe: Function returning True if the backend is up, used to check it
+            while the circuit is open (default = let this call check it)
+        """
+        deadline = self._now() + park_seconds.get()
+        while True:
+            with self._cond:
+                if self._state == CLOSED:
+                    return
+                now = self._now()
+                check = now >= self._opened_until and not self._checking
+                if check:
+                    self._checking = True
+                    self._set_state(HALF_OPEN)
+                    if probe is None:
+                        return
+                elif now >= deadline:
+                    raise CircuitOpenError(f'{self.name} is not responding, try again later')
+                elif self._checking:
+                    # another caller is checking the backend
+                    self._cond.wait(timeout=None if self.clock else deadline - now)
+                    continue
+                else:
+                    wake = min(self._opened_until, deadline)
+
+            if check:
+                self._check(probe)
+            else:
+                self._sleep_until(wake)
+
+    def _check(self, probe):
+        try:
+            up = bool(probe())
+        except Exception as err:
+            logger.info(f'{self.name} health probe failed: {err}')
+            up = False
+        if up:
+            self.succeeded()
+        else:
+            self.failed()
+
+    def succeeded(self):
+        """Record a call that got a response."""
+        with self._cond:
+            self._failed = 0
+            if self._state == HALF_OPEN:
+                self._checking = False
+                self._open_for = self.reset_timeout
+                self._set_state(CLOSED)
+                self._cond.notify_all()
+
+    def failed(self):
+        """Record a call that found the backend down, e.g. one that got no response."""
+        with self._cond:
+            if self._state == HALF_OPEN:
+                self._checking = False
+                self._open_for = min(self._open_for * 2, self.max_reset_timeout)
+                self._open()
+                self._cond.notify_all()
+            elif self._state == CLOSED:
+                self._failed += 1
+                if self._failed >= self.failures:
+                    self._open()
+
+    def call(self, fn, *args, probe=None, is_failure=None, **kwargs):
+        """
+        Call fn(*args, **kwargs) through the circuit.
+
+        :param fn: Function calling the backend
+        :param probe: Health probe, see before
+        :param is_failure: Function of an exception raised by fn, True if it means the backend is down
+            (default = every exception)
+        :return: Result of fn
+        """
+        self.before(probe)
+        try:
+            result = fn(*args, **kwargs)
+        except Exception as err:
+            if is_failure is None or is_failure(err):
+                self.failed()
+            else:
+                self.succeeded()
+            raise
+        self.succeeded()
+        return result
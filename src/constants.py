@@ -3,6 +3,12 @@ MESSAGES_PER_DAY_2 = 4
 DAYS_1 = 28
 DAYS_2 = 28
 ASH_CALENDAR_ID = 1000026606  # Numeric calendar identifier for ASH Messages
+STUDY_DAYS_BEFORE_QUIT = 1  # Study messages start this many days before the quit date
+STUDY_DAYS_AFTER_QUIT = 60  # and end this many days after it
 DOWNLOAD_DIR = 'csvfiles'
+STORE_DIR = 'store'  # Parquet tables of schedules, posted events, conversations and message assignments
 TZ_CODES = {'PT': 'US/Pacific', 'MT': 'US/Mountain', 'CT': 'US/Central', 'ET': 'US/Eastern',
             'AZ': 'US/Arizona', 'HI': 'US/Hawaii'}
+APPTOTO_TZ = 'US/Pacific'  # Time zone of the apptoto account, which apptoto reports times in
+SMS_TITLE = 'ASH SMS'
+CIGS_TITLE = 'ASH CIGS'
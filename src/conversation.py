@@ -0,0 +1,196 @@
+from datetime import timedelta
+from typing import Iterable, Iterator
+import numpy as np
+import pandas as pd
+
+from src.apptoto import parse_external_id
+from src.constants import SMS_TITLE, CIGS_TITLE
+from src.enums import EventType
+from src.message import normalize_message
+
+REPLY_WINDOW = timedelta(hours=24)  # replies later than this after the last sent message are not attributed
+
+# columns of attributed conversations kept in the store, with the apptoto ids of the sent message
+# and of its replies (separated by spaces), so pushed copies of them are not counted again
+STORE_COLUMNS = ['event_id', 'title_sent', 'at_sent', 'UO_ID', 'content_sent',
+                 'at_rec', 'content_rec', 'replies', 'reply_latency', 'message_id', 'reply_ids']
+# columns of the _sms_conversations.csv and _cig_conversations.csv files, and their headers
+CSV_COLUMNS = ['at_sent', 'UO_ID', 'content_sent', 'at_rec', 'content_rec', 'replies', 'reply_minutes']
+CSV_HEADER = ['sent_at', 'UO_ID', 'message', 'replied_at', 'reply', 'replies', 'reply_minutes']
+
+
+def conversation_rows(events: Iterable[dict]) -> Iterator[dict]:
+    """
+    Flatten apptoto events into one row per conversation message.
+
+    Events are read one at a time, so only the rows are kept in memory, not the events.
+    Each row has the message fields (id, at, event_type, content, ...) plus the
+    event's title, start_time, calendar_id and external_id and the participant's
+    event id under 'participants.event_id', the same columns as
+    pd.json_normalize(events, record_path=['participants', 'conversations', 'messages'], ...)
+
+    :param events: Events retrieved with include_conversations=True
+    :return: Iterator of conversation message rows
+    """
+    for event in events:
+        for participant in event.get('participants') or []:
+            for conversation in participant.get('conversations') or []:
+                for message in conversation.get('messages') or []:
+                    row = dict(message)
+                    row['title'] = event.get('title')
+                    row['start_time'] = event.get('start_time')
+                    row['calendar_id'] = event.get('calendar_id')
+                    row['external_id'] = event.get('external_id')
+                    row['participants.event_id'] = participant.get('event_id')
+                    yield row
+
+
+def sent_message_ids(conversations: pd.DataFrame, index, assignment: pd.DataFrame = None) -> pd.Series:
+    """
+    Get the UO_ID of each sent message in a conversations frame.
+
+    Events posted with a UO_ID in their external id are attributed directly, and intervention
+    messages with only a slot are attributed from the participant's assignment.
+    Other sent messages without a type in their external id are looked up by normalized content
+    in the message bank index. Received messages have no UO_ID.
+
+    :param conversations: Conversation rows with event_type, content and external_id
+    :param index: Index from normalized message text to UO_ID, see message.message_index,
+        or a function returning one, called only if there are messages to look up
+    :param assignment: Participant's message assignment with slot and UO_ID columns
+    :return: Series of UO_ID, aligned with conversations
+    """
+    sent = conversations.event_type == 'sent'
+    uo_ids = pd.Series(None, index=conversations.index, dtype=object)
+    lookup = sent
+
+    if 'external_id' in conversations.columns:
+        external_ids = conversations.loc[sent, 'external_id'].map(parse_external_id)
+        uo_ids[sent] = external_ids.map(lambda x: x.uo_id if x else None)
+        if assignment is not None and not assignment.empty:
+            slots = external_ids.map(lambda x: x.slot if x and x.event_type == EventType.SMS.value else None)
+            by_slot = assignment.set_index('slot').UO_ID
+            uo_ids[sent] = uo_ids[sent].fillna(slots.map(by_slot))
+        # cigarette, booster and diary messages are not from the message bank
+        other_types = external_ids.map(lambda x: x is not None and x.event_type != EventType.SMS.value)
+        lookup = sent & ~other_types.reindex(conversations.index, fill_value=False)
+
+    missing = lookup & uo_ids.isna()
+    if missing.any():
+        index = index() if callable(index) else index
+        uo_ids[missing] = conversations.loc[missing, 'content'].map(lambda c: index.get(normalize_message(c)))
+    return uo_ids
+
+
+def join_ids(ids: Iterable) -> str:
+    """Join message ids into the space separated form of the reply_ids column."""
+    return ' '.join(str(i) for i in ids)
+
+
+def split_ids(joined: pd.Series) -> set:
+    """Get the set of message ids in a reply_ids column."""
+    return {int(i) for ids in joined.dropna() for i in str(ids).split()}
+
+
+def reply_targets(sent: pd.DataFrame, replies: pd.DataFrame, window: timedelta = REPLY_WINDOW,
+                  by=None, event=None) -> pd.Series:
+    """
+    Find the sent message each reply answers.
+
+    A reply answers the most recent message sent on its own event within `window` before it.
+    Replies with no such message answer the most recent message sent on any event within
+    `window` before them. Both frames are sorted once and joined as-of, so the cost grows
+    with the number of messages, not with the number of pairs.
+
+    :param sent: Sent messages with an at column
+    :param replies: Replies with an at column
+    :param window: Longest time between a sent message and a reply to it
+    :param by: Column (or list of columns) both frames must match on, e.g. a participant id
+    :param event: Column of the event id in both frames (default = match by time only)
+    :return: Series aligned with replies of the position in sent of the message each
+        reply answers, NaN for replies not attributed
+    """
+    by = [by] if isinstance(by, str) else list(by or [])
+    events = [event] if event else []
+    tolerance = pd.Timedelta(window)
+    targets = np.full(len(replies), np.nan)
+
+    sent = sent[['at'] + by + events].rename(columns={'at': 'at_sent'}).assign(_sent=np.arange(len(sent)))
+    sent = sent.dropna(subset=['at_sent']).sort_values('at_sent', kind='stable')
+    left = replies[['at'] + by + events].assign(_reply=np.arange(len(replies)))
+    left = left.dropna(subset=['at']).sort_values('at', kind='stable')
+
+    if event:
+        on_event = pd.merge_asof(left.dropna(subset=[event]).astype({event: 'int64'}),
+                                 sent.dropna(subset=[event]).astype({event: 'int64'}),
+                                 left_on='at', right_on='at_sent', by=by + [event],
+                                 direction='backward', tolerance=tolerance)
+        targets[on_event._reply.to_numpy()] = on_event._sent.to_numpy()
+        left = left[np.isnan(targets[left._reply.to_numpy()])]
+
+    on_time = pd.merge_asof(left.drop(columns=events), sent.drop(columns=events),
+                            left_on='at', right_on='at_sent', by=by or None,
+                            direction='backward', tolerance=tolerance)
+    targets[on_time._reply.to_numpy()] = on_time._sent.to_numpy()
+    return pd.Series(targets, index=replies.index)
+
+
+def attribute_replies(sent: pd.DataFrame, received: pd.DataFrame, window: timedelta = REPLY_WINDOW,
+                      by=None, event='participants.event_id') -> pd.DataFrame:
+    """
+    Attribute each reply to the message it answers, see reply_targets.
+
+    :param sent: Sent conversation rows with at, content and title columns
+    :param received: Received conversation rows with at and content columns
+    :param window: Longest time between a sent message and a reply to it
+    :param by: Column (or list of columns) both frames must match on, e.g. a participant id
+    :param event: Column of the event id, used if both frames have it
+    :return: One row per sent message, with the sent columns renamed at_sent, content_sent,
+        title_sent and message_id (from id), plus at_rec and content_rec of the first reply,
+        the number of replies, reply_latency, the time from sending to the first reply,
+        and reply_ids, the ids of the replies if received has an id column
+    """
+    sent = sent.sort_values('at', kind='stable').reset_index(drop=True)
+    if event not in sent.columns or event not in received.columns:
+        event = None
+
+    paired = received.assign(_sent=reply_targets(sent, received, window, by=by, event=event))
+    paired = paired.dropna(subset=['_sent']).sort_values('at', kind='stable')
+    aggregations = dict(at_rec=('at', 'first'), content_rec=('content', 'first'), replies=('at', 'size'))
+    if 'id' in paired.columns:
+        aggregations['reply_ids'] = ('id', join_ids)
+    first_replies = paired.groupby(paired['_sent'].astype(int)).agg(**aggregations)
+
+    merged = sent.rename(columns={'at': 'at_sent', 'content': 'content_sent', 'title': 'title_sent',
+                                  'id': 'message_id'})
+    merged = merged.join(first_replies)
+    merged['replies'] = merged['replies'].fillna(0).astype(int)
+    merged['reply_latency'] = merged['at_rec'] - merged['at_sent']
+    return merged
+
+
+def split_conversations(merged: pd.DataFrame):
+    """
+    Split attributed conversations into intervention messages and cigarette messages.
+
+    :param merged: Output of attribute_replies
+    :return: Tuple of (sms, cig) DataFrames
+    """
+    sms = merged[(merged.title_sent.str.contains(SMS_TITLE, na=False)) & (~merged.UO_ID.isna())]
+    cig = merged[(merged.title_sent.str.contains(CIGS_TITLE, na=False)) &
+                 (merged.content_sent.str.startswith('UO', na=False))]
+    return sms, cig
+
+
+def response_counts(merged: pd.DataFrame) -> dict:
+    """
+    Count the intervention and cigarette messages sent, and those replied to.
+
+    :param merged: Output of attribute_replies
+    :return: dict of sms_sent, sms_rec, cig_sent, cig_rec
+    """
+    sms, cig = split_conversations(merged)
+    return dict(sms_sent=sms['event_id'].nunique(),
+                sms_rec=sms[~sms.content_rec.isnull()]['event_id'].nunique(),
+                cig_sent=cig['event_id'].nunique(),
+                cig_rec=cig[~cig.content_rec.isnull()]['event_id'].nunique())
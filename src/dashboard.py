@@ -0,0 +1,166 @@
+import json
+import os
+import threading
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+from src.constants import STORE_DIR
+
+COUNTS = ('sms_sent', 'sms_rec', 'cig_sent', 'cig_rec')
+
+
+def _hour(start_time) -> str:
+    """UTC hour of an apptoto start time, e.g. '2022-01-01T18'."""
+    if isinstance(start_time, str):
+        start_time = datetime.fromisoformat(start_time)
+    if start_time.tzinfo is None:
+        start_time = start_time.replace(tzinfo=timezone.utc)
+    return start_time.astimezone(timezone.utc).strftime('%Y-%m-%dT%H')
+
+
+class Dashboard:
+    # jobs for different participants update the aggregates from several threads
+    _lock = threading.Lock()
+
+    def __init__(self, path=Path(STORE_DIR) / 'dashboard.json'):
+        """
+        Create a Dashboard.
+
+        A Dashboard keeps cohort aggregates that are updated as events are posted
+        or deleted and as conversations are retrieved, so they can be shown
+        without asking apptoto or REDCap.
+        For each participant it keeps the number of scheduled sends in each hour
+        and the sent and replied message counts of the last conversation retrieval.
+
+        :param path: JSON file containing the aggregates
+        """
+        self.path = Path(path)
+
+    def _load(self):
+        if not self.path.exists():
+            return {}
+        with open(self.path, 'r') as f:
+            return json.load(f)
+
+    def _save(self, data):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.with_suffix('.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(data, f)
+        os.replace(tmp, self.path)
+
+    def _update(self, participant_id, update):
+        with self._lock:
+            data = self._load()
+            participant = data.setdefault(participant_id, {'sends': {}, 'responses': {}})
+            update(participant)
+            participant['updated'] = datetime.now(timezone.utc).isoformat(timespec='seconds')
+            self._save(data)
+
+    def events_posted(self, participant_id, start_times):
+        """
+        :param participant_id: Participant id
+        :param start_times: Start times of the posted events
+        """
+        def update(participant):
+            for start_time in start_times:
+                hour = _hour(start_time)
+                participant['sends'][hour] = participant['sends'].get(hour, 0) + 1
+
+        self._update(participant_id, update)
+
+    def events_deleted(self, participant_id, start_times):
+        """
+        :param participant_id: Participant id
+        :param start_times: Start times of the deleted events
+        """
+        def update(participant):
+            for start_time in start_times:
+                hour = _hour(start_time)
+                remaining = participant['sends'].get(hour, 0) - 1
+                if remaining > 0:
+                    participant['sends'][hour] = remaining
+                else:
+                    participant['sends'].pop(hour, None)
+
+        self._update(participant_id, update)
+
+    def conversations_synced(self, participant_id, counts: dict):
+        """
+        :param participant_id: Participant id
+        :param counts: Number of messages sent and replied to, keyed by sms_sent, sms_rec, cig_sent, cig_rec
+        """
+        def update(participant):
+            participant['responses'] = {k: int(counts[k]) for k in COUNTS}
+
+        self._update(participant_id, update)
+
+    def rebuild(self, store):
+        """
+        Replace the aggregates with ones rebuilt from the store: the sends of the stored schedules
+        and the counts of the stored conversations. Use it once for participants whose events
+        were posted before the dashboard was kept.
+
+        :param store: Store to read the schedules and conversations from
+        :return: Number of participants in the rebuilt aggregates
+        """
+        # imported here rather than at the top, so the dashboard page does not load pandas
+        from src.conversation import response_counts
+
+        updated = datetime.now(timezone.utc).isoformat(timespec='seconds')
+        data = {}
+        schedules = store.read('schedules')
+        if not schedules.empty:
+            for participant_id, schedule in schedules.groupby('participant_id'):
+                hours = schedule.start_time.dropna().map(_hour).value_counts()
+                participant = data.setdefault(participant_id, {'sends': {}, 'responses': {}, 'updated': updated})
+                participant['sends'] = {hour: int(n) for hour, n in sorted(hours.items())}
+        conversations = store.read('conversations')
+        if not conversations.empty:
+            for participant_id, merged in conversations.groupby('participant_id'):
+                participant = data.setdefault(participant_id, {'sends': {}, 'responses': {}, 'updated': updated})
+                participant['responses'] = {k: int(n) for k, n in response_counts(merged).items()}
+
+        with self._lock:
+            self._save(data)
+        return len(data)
+
+    def summary(self, now: datetime = None):
+        """
+        Summarize the cohort.
+
+        :param now: Time to count upcoming sends from (default = now)
+        :return: dict with cohort totals and a row for each participant
+        """
+        now = now or datetime.now(timezone.utc)
+        this_hour = _hour(now)
+        next_day = _hour(now + timedelta(days=1))
+
+        with self._lock:
+            data = self._load()
+
+        rows = []
+        for participant_id, participant in sorted(data.items()):
+            sends = participant['sends']
+            responses = participant['responses']
+            sent = responses.get('sms_sent', 0) + responses.get('cig_sent', 0)
+            replied = responses.get('sms_rec', 0) + responses.get('cig_rec', 0)
+            rows.append({'participant_id': participant_id,
+                         'upcoming': sum(n for hour, n in sends.items() if hour >= this_hour),
+                         'next_24_hours': sum(n for hour, n in sends.items() if this_hour <= hour < next_day),
+                         'last_send': max(sends) if sends else None,
+                         'sent': sent,
+                         'replied': replied,
+                         'response_rate': 100 * replied / sent if sent else None,
+                         'updated': participant.get('updated')})
+
+        sent = sum(r['sent'] for r in rows)
+        replied = sum(r['replied'] for r in rows)
+        return {'participants': len(rows),
+                'active': sum(1 for r in rows if r['upcoming']),
+                'upcoming': sum(r['upcoming'] for r in rows),
+                'next_24_hours': sum(r['next_24_hours'] for r in rows),
+                'sent': sent,
+                'replied': replied,
+                'response_rate': 100 * replied / sent if sent else None,
+                'rows': rows}
@@ -1,4 +1,4 @@
-from enum import Enum
+from enum import Enum, IntEnum
 
 
 class Condition(Enum):
@@ -17,3 +17,21 @@ class CodedValues(Enum):
     athletic = 7
     none = 8
 
+
+
+class EventType(Enum):
+    """Type of a scheduled event, stamped in its external id, see apptoto.make_external_id"""
+    DAY_BEFORE = 'day_before'
+    QUIT_DATE = 'quit_date'
+    CIGS = 'cigs'
+    BOOSTER = 'booster'
+    DIARY = 'diary'
+    SMS = 'sms'
+
+
+class Priority(IntEnum):
+    """Priority of apptoto requests, lower values are sent first, see apptoto.RateLimiter"""
+    DELETE = 0
+    CONTACT = 1
+    UPLOAD = 2
+    CRAWL = 3
@@ -1,10 +1,12 @@
+import hashlib
 import random
+import zipfile
 from collections import namedtuple
+from functools import lru_cache
 from datetime import datetime, timedelta, date, time, timezone
-import zoneinfo
 from pathlib import Path
-from typing import List
-import logging.config
+from typing import List, Dict
+import logging
 import pandas as pd
 import numpy as np
 import re
@@ -13,19 +15,24 @@ import time as tm
 import asyncio
 import re
 
-from src.mylogging import DEFAULT_LOGGING
-from src.apptoto import Apptoto, ApptotoEvent, ApptotoParticipant, ApptotoError
+from src.apptoto import Apptoto, ApptotoEvent, ApptotoParticipant, ApptotoError, make_external_id, parse_external_id
 from src.constants import DAYS_1, DAYS_2, MESSAGES_PER_DAY_1, MESSAGES_PER_DAY_2
-from src.enums import Condition, CodedValues
+from src.enums import Condition, CodedValues, EventType
 from src.participant import RedcapParticipant
-from src.message import Messages
-from src.constants import DOWNLOAD_DIR, ASH_CALENDAR_ID, TZ_CODES
+from src.message import Messages, message_index
+from src.conversation import conversation_rows, sent_message_ids, attribute_replies, split_conversations
+from src.conversation import response_counts, REPLY_WINDOW, STORE_COLUMNS, CSV_COLUMNS, CSV_HEADER
+from src.inbound import apply_notifications
+from src.store import Store
+from src.dashboard import Dashboard, COUNTS
+from src.metrics import JobTimer
+from src.schedule import Schedule, event_types
+from src.constants import DOWNLOAD_DIR, ASH_CALENDAR_ID, TZ_CODES, APPTOTO_TZ
+from src.constants import STUDY_DAYS_BEFORE_QUIT, STUDY_DAYS_AFTER_QUIT
+from src.constants import SMS_TITLE, CIGS_TITLE
 
-logging.config.dictConfig(DEFAULT_LOGGING)
 logger = logging.getLogger(__name__)
 
-SMS_TITLE = 'ASH SMS'
-CIGS_TITLE = 'ASH CIGS'
 TASK_MESSAGES = 20
 ITI = [
     0.0,
@@ -49,20 +56,77 @@ ITI = [
     2.1,
     1.0
 ]
+TASK_SESSIONS = 2
+TASK_RUNS = 4
+
+
+@lru_cache(maxsize=64)
+def _task_files(message_file, modified, participant_id, values) -> Dict[str, bytes]:
+    messages = Messages(message_file)
+    # seeded by the participant and values, so every worker draws the same files, also after a restart
+    seed = hashlib.sha256(f'{participant_id}:{",".join(map(str, values))}'.encode()).digest()
+    runs = messages.draw_sets(Condition.VALUES, [CodedValues(v) for v in values],
+                              TASK_SESSIONS * TASK_RUNS, TASK_MESSAGES, random_state=int.from_bytes(seed[:8], 'big'))
+    files = {}
+    for i, run in enumerate(runs):
+        session, run_no = divmod(i, TASK_RUNS)
+        run = run.assign(iti=ITI)
+        files[f'VAFF_{participant_id}_Session{session + 1}_Run{run_no + 1}.csv'] = \
+            run.to_csv(columns=['Message', 'iti'], header=['message', 'iti'], index=False).encode()
+    return files
+
+
+def task_files(message_file, participant_id, values) -> Dict[str, bytes]:
+    """
+    Get the contents of a participant's task files, one for each session and run.
+
+    The messages of all runs are drawn together, so they are not repeated across runs
+    while the participant's values have enough messages. The draw is seeded by the participant
+    and values, so the files are the same on every worker until the message file changes.
+    They are kept for each participant, values and version of the message file.
+
+    :param message_file: File containing messages
+    :param participant_id: Participant id
+    :param values: Participant's CodedValues numbers
+    :return: dict of file name to CSV contents
+    """
+    path = Path(message_file)
+    return _task_files(str(path), path.stat().st_mtime, participant_id, tuple(values))
+
 
+def local_times(iso_times: pd.Series, tz: str = None) -> pd.Series:
+    """
+    Get the local times of apptoto event times.
+
+    :param iso_times: ISO 8601 times, e.g. '2022-01-01T09:00:00-08:00'
+    :param tz: Time zone code, e.g. 'PT' (default = the local times as given, without their UTC offsets)
+    :return: Series of naive datetimes
+    """
+    if tz:
+        return pd.to_datetime(iso_times, utc=True).dt.tz_convert(TZ_CODES[tz]).dt.tz_localize(None)
+    # times in one study can have different offsets, so they are parsed without them
+    return pd.to_datetime(iso_times.str.slice(0, 19), format='%Y-%m-%dT%H:%M:%S')
 
-def change_tz(iso_dt: str, tz: str):
-    oldtime = datetime.fromisoformat(iso_dt)
 
+def change_tz(iso_times: pd.Series, tz: str) -> pd.Series:
+    """
+    Move apptoto event times to another time zone, keeping their local times.
+
+    :param iso_times: ISO 8601 times
+    :param tz: Time zone code, e.g. 'PT'
+    :return: Series of datetimes in the time zone
+    """
     if tz not in TZ_CODES:
         raise ValueError('time zone code not supported')
-    newtime = oldtime.replace(tzinfo=zoneinfo.ZoneInfo(TZ_CODES[tz]))
-
-    return newtime
+    # like datetime.replace, ambiguous times are daylight time and nonexistent times
+    # keep the offset from before the change
+    return local_times(iso_times).dt.tz_localize(TZ_CODES[tz],
+                                                 ambiguous=np.ones(len(iso_times), dtype=bool),
+                                                 nonexistent=pd.Timedelta(hours=1))
 
 
 # see stack overflow 51918580
-def random_times(start: datetime, end: datetime, n: int) -> List[datetime]:
+def random_times(start: datetime, end: datetime, n: int, rng=random) -> List[datetime]:
     """
     Create randomly spaced times between start and end time.
     :param n:
@@ -71,6 +135,7 @@ def random_times(start: datetime, end: datetime, n: int) -> List[datetime]:
     :param end: End time
     :type end: datetime
     :param n: Number of times to create
+    :param rng: Random number generator, e.g. random.Random(seed)
     :return: List of datetime
     """
     # minimum minutes between times
@@ -83,7 +148,7 @@ def random_times(start: datetime, end: datetime, n: int) -> List[datetime]:
     if int(delta.total_seconds() / 60) < 5:
         logger.info("Subject is only awake for 10 hours on average")
     range_max = int(delta.total_seconds() / 60) - ((min_interval - 1) * (n - 1))
-    r = [(min_interval - 1) * i + x for i, x in enumerate(sorted(random.sample(range(range_max), n)))]
+    r = [(min_interval - 1) * i + x for i, x in enumerate(sorted(rng.sample(range(range_max), n)))]
     times = [start + timedelta(minutes=x) for x in r]
     return times
 
@@ -126,15 +191,61 @@ def get_diary_dates(start_date: date, number_of_days=4):
     return dates
 
 
+# Get dates for daily diary round 3, which starts 6 weeks after the session 1 training end
+def get_diary_three_dates(training_end: str):
+    return get_diary_dates(date.fromisoformat(training_end) + timedelta(weeks=6))
+
+
+def study_window(subject: RedcapParticipant):
+    """
+    Get the time span in which study messages are scheduled for a participant,
+    from the day before the quit date until 60 days after it, or until the last
+    day of diary round 3 if that is later.
+
+    :param subject: Participant with a session 1 quit date
+    :return: Tuple of (begin, end) datetime, or None if there is no quit date
+    """
+    if 's1' not in subject.redcap or pd.isnull(subject.redcap.s1.quitdate):
+        return None
+    quit_date = date.fromisoformat(subject.redcap.s1.quitdate)
+    last_day = quit_date + timedelta(days=STUDY_DAYS_AFTER_QUIT)
+    # diary round 3 is scheduled from the training end, not the quit date
+    training_end = subject.redcap.s1.get('training_end')
+    if not pd.isnull(training_end):
+        last_day = max(last_day, get_diary_three_dates(training_end)[-1])
+    begin = datetime.combine(quit_date - timedelta(days=STUDY_DAYS_BEFORE_QUIT), time(0, 0, 0))
+    # the window has no time zone, so end it a day late to keep evening messages in US time zones
+    end = datetime.combine(last_day + timedelta(days=2), time(0, 0, 0))
+    return begin, end
+
+
+def assignment_rows(events: List[ApptotoEvent]) -> pd.DataFrame:
+    """
+    :param events: Events, with external ids made by make_external_id
+    :return: DataFrame of the slot, UO_ID, Message (without "UO: ") and UTC start_time of
+        the intervention messages, in slot order
+    """
+    external_ids = [parse_external_id(e.external_id) for e in events]
+    sms = [(x, e) for x, e in zip(external_ids, events) if x and x.event_type == EventType.SMS.value]
+    rows = pd.DataFrame({'slot': [x.slot for x, _ in sms],
+                         'UO_ID': [x.uo_id for x, _ in sms],
+                         'Message': [e.content.removeprefix('UO: ') for _, e in sms],
+                         'start_time': pd.to_datetime([e.start_time for _, e in sms], utc=True)})
+    return rows.sort_values('slot', ignore_index=True)
+
+
 class EventGenerator:
     def __init__(self, participant_id, config, instance_path):
         self.participant_id = participant_id
         self.config = config
         self.instance_path = Path(instance_path)
         self.apptoto = Apptoto(api_token=config['apptoto_api_token'],
-                               user=config['apptoto_user'])
+                               user=config['apptoto_user'],
+                               endpoint=config.get('apptoto_endpoint'))
         self.events_file = self.instance_path / 'events.json'
         self.message_file = self.instance_path / self.config['message_file']
+        self.store = Store()
+        self.dashboard = Dashboard()
 
     # this file is created, but I never implemented its usage.
     # This would replace searching all events by contact phone number
@@ -164,49 +275,173 @@ class EventGenerator:
         else:
             return None
 
-    def daily_diary_one(self):
+    def _record_posted_events(self, events):
+        self._update_events_file(events)
+
+        posted = pd.DataFrame({'event_id': [e['id'] for e in events],
+                               'external_id': [e.get('external_id') for e in events],
+                               'title': [e.get('title') for e in events],
+                               'start_time': pd.to_datetime([e.get('start_time') for e in events], utc=True)})
+        posted['posted_at'] = pd.Timestamp.now(tz='UTC')
+        self.store.write('posted_events', self.participant_id, posted)
+        self.dashboard.events_posted(self.participant_id, [e['start_time'] for e in events if e.get('start_time')])
+
+    def _delete_events(self, events):
         """
-        Generate events for the first round of daily diary messages,
-        which are sent after session 0, before session 1.
-        :return:
+        Delete events from apptoto, and from the dashboard counts and the stored schedules.
+
+        :param events: Events with id and start_time
         """
-        subject = RedcapParticipant(self.participant_id,
-                                    self.config['redcap_api_token'])
+        deleted = []
+        try:
+            for e in events:
+                self.apptoto.delete_event(e['id'])
+                deleted.append(e)
+                logger.info('Deleted event {}, {} of {}'.format(e['id'], len(deleted), len(events)))
+        finally:
+            self.dashboard.events_deleted(self.participant_id, [e['start_time'] for e in deleted if e.get('start_time')])
+            self.store.drop_rows('schedules', self.participant_id, 'event_id', [e['id'] for e in deleted])
+
+    def _record_schedule(self, events: List[ApptotoEvent], posted_events, name=None):
+        """
+        Keep the schedule of events posted by one job in the store.
 
-        # check that we have the required info from redcap
-        check_fields(subject, ['initials', 'phone', 'sleeptime', 'email'])
+        :param events: Events that were posted
+        :param posted_events: Events returned by apptoto, in the same order
+        :param name: Name of the job, e.g. 'messages', to replace its earlier schedule.
+            If not given, the schedule is added to the earlier ones.
+        """
+        external_ids = [parse_external_id(e.external_id) for e in events]
+        schedule = pd.DataFrame({'event_id': [e['id'] for e in posted_events],
+                                 'start_time': pd.to_datetime([e.start_time for e in events], utc=True),
+                                 'title': [e.title for e in events],
+                                 'content': [e.content for e in events],
+                                 'external_id': [e.external_id for e in events],
+                                 'slot': [x.slot if x else None for x in external_ids],
+                                 'UO_ID': [x.uo_id if x else None for x in external_ids]})
+        schedule['slot'] = schedule.slot.astype('Int64')
+        schedule['event_type'] = event_types(schedule.external_id, schedule.title)
+        self.store.write('schedules', self.participant_id, schedule, name=name)
+
+    def _record_assignment(self, events: List[ApptotoEvent], seed):
+        """
+        Keep the participant's intervention messages in the store, as drawn from the message bank:
+        the UO_ID and message of each slot, the time it is sent and the seed of the draw.
+        Updates, attribution and exports read this instead of the message bank.
 
-        # update the contact if needed
-        self.update_contact()
+        :param events: Events that were posted
+        :param seed: Seed the messages and their times were drawn with
+        """
+        assignment = assignment_rows(events)
+        assignment['seed'] = seed
+        self.store.write('assignments', self.participant_id, assignment, name='messages')
 
-        participants = [ApptotoParticipant(subject.redcap.s0.initials,
-                                           subject.redcap.s0.phone,
-                                           subject.redcap.s0.email)]
+    def _retime_assignment(self, assignment: pd.DataFrame, events: List[ApptotoEvent]) -> pd.DataFrame:
+        """
+        Change the times of the participant's intervention messages in their assignment.
 
-        events = []
+        :param assignment: Assignment read from the store, may be empty
+        :param events: Events that were posted with new times
+        :return: The assignment, or one made from the events if none was recorded
+        """
+        retimed = assignment_rows(events)
+        if assignment.empty:
+            # generated before assignments were kept
+            return retimed
+
+        start_times = retimed.set_index('slot').start_time
+        assignment['start_time'] = assignment.slot.map(start_times).fillna(assignment.start_time)
+        self.store.write('assignments', self.participant_id, assignment, name='messages')
+        return assignment
 
-        # Diary round 1
-        round1_start = date.fromisoformat(subject.redcap.s0.date_zs0) + timedelta(days=2)
-        round1_dates = get_diary_dates(round1_start)
-        sleep_time = time.fromisoformat(subject.redcap.s0.sleeptime)
-
-        for day, message_date in enumerate(round1_dates):
-            content = f'UO: Daily Diary #{day + 1}'
-            title = f'ASH Daily Diary #{day + 1}'
-            message_datetime = datetime.combine(message_date, sleep_time) - timedelta(hours=2)
-            print(message_datetime)
-            events.append(ApptotoEvent(calendar=self.config['apptoto_calendar'],
-                                       title=title,
-                                       start_time=message_datetime,
-                                       time_zone=subject.redcap.s0.timezone,
-                                       content=content,
-                                       participants=participants))
-
-        if len(events) > 0:
-            posted_events = self.apptoto.post_events(events)
-            self._update_events_file(posted_events)
-
-        return 'Diary round 1 created'
+    def export_files(self):
+        """
+        Write the CSV files for this participant from the store:
+        the intervention messages (_messages.csv) and the conversations
+        (_sms_conversations.csv, _cig_conversations.csv).
+        """
+        csv_path = Path(DOWNLOAD_DIR)
+        if not csv_path.exists():
+            csv_path.mkdir()
+
+        assignment = self.store.read('assignments', self.participant_id)
+        schedule = self.store.read('schedules', self.participant_id) if assignment.empty else None
+        if not assignment.empty:
+            assignment.to_csv(csv_path / f'{self.participant_id}_messages.csv', columns=['UO_ID', 'Message'],
+                              index=False)
+        elif 'title' in schedule.columns:
+            # generated before assignments were kept
+            sms = schedule[schedule.title == SMS_TITLE].sort_values('slot')
+            messages = pd.DataFrame({'UO_ID': sms.UO_ID, 'Message': sms.content.str.removeprefix('UO: ')})
+            messages.to_csv(csv_path / f'{self.participant_id}_messages.csv', index=False)
+
+        conversations = self.store.read('conversations', self.participant_id)
+        inbound = self.store.read('inbound', self.participant_id)
+        if not inbound.empty:
+            # messages pushed since the last time conversations were fetched
+            conversations = apply_notifications(conversations, inbound, lambda: message_index(self.message_file),
+                                                assignment=assignment, window=self.reply_window())
+        if 'title_sent' in conversations.columns:
+            conversations['reply_minutes'] = conversations.reply_latency.dt.total_seconds() / 60
+            sms_convos, cig_convos = split_conversations(conversations)
+            for kind, convos in (('sms', sms_convos), ('cig', cig_convos)):
+                convos.to_csv(csv_path / f'{self.participant_id}_{kind}_conversations.csv', date_format='%x %X',
+                              columns=CSV_COLUMNS, header=CSV_HEADER, index=False)
+
+        return f'Files exported for {self.participant_id}'
+
+    def daily_diary_one(self):
+        """
+        Generate events for the first round of daily diary messages,
+        which are sent after session 0, before session 1.
+        :return:
+        """
+        with JobTimer('daily_diary_one') as timer:
+            timer.phase('redcap')
+            subject = RedcapParticipant(self.participant_id,
+                                        self.config['redcap_api_token'])
+
+            # check that we have the required info from redcap
+            check_fields(subject, ['initials', 'phone', 'sleeptime', 'email'])
+
+            timer.phase('contact')
+            # update the contact if needed
+            self.update_contact()
+
+            timer.phase('schedule')
+            participants = [ApptotoParticipant(subject.redcap.s0.initials,
+                                               subject.redcap.s0.phone,
+                                               subject.redcap.s0.email)]
+
+            events = []
+
+            # Diary round 1
+            round1_start = date.fromisoformat(subject.redcap.s0.date_zs0) + timedelta(days=2)
+            round1_dates = get_diary_dates(round1_start)
+            sleep_time = time.fromisoformat(subject.redcap.s0.sleeptime)
+
+            diaries = pd.Series(EventType.DIARY.value, index=range(len(round1_dates)))
+            message_times = Schedule(sleep_time=sleep_time).times(diaries, round1_dates)
+            for day, message_datetime in enumerate(message_times):
+                content = f'UO: Daily Diary #{day + 1}'
+                title = f'ASH Daily Diary #{day + 1}'
+                events.append(ApptotoEvent(calendar=self.config['apptoto_calendar'],
+                                           title=title,
+                                           start_time=message_datetime.to_pydatetime(),
+                                           time_zone=subject.redcap.s0.timezone,
+                                           content=content,
+                                           participants=participants,
+                                           external_id=make_external_id(subject.id, EventType.DIARY.value,
+                                                                        day + 0)))
+
+            if len(events) > 0:
+                timer.phase('post')
+                posted_events = self.apptoto.post_events(events)
+                timer.phase('record')
+                self._record_posted_events(posted_events)
+                self._record_schedule(events, posted_events, name='diary1')
+
+            return 'Diary round 1 created'
 
     def daily_diary_three(self):
         """
@@ -214,46 +449,54 @@ class EventGenerator:
         which are sent after session 2.
         :return:
         """
-        subject = RedcapParticipant(self.participant_id,
-                                    self.config['redcap_api_token'])
-
-        # first check that we have the required info from redcap
-        check_fields(subject, ['initials', 'phone', 'sleeptime', 'email'])
-
-        if 's1' not in subject.redcap or pd.isnull(subject.redcap.s1.training_end):
-            return f'Missing session1 training end date for {subject.id}'
-
-        # update the contact if needed
-        self.update_contact()
-
-        participants = [ApptotoParticipant(subject.redcap.s0.initials,
-                                           subject.redcap.s0.phone,
-                                           subject.redcap.s0.email)]
-
-        events = []
-
-        # Diary round 3
-        round3_start = date.fromisoformat(subject.redcap.s1.training_end) + timedelta(weeks=6)
-        round3_dates = get_diary_dates(round3_start)
-        sleep_time = time.fromisoformat(subject.redcap.s0.sleeptime)
-
-        for day, message_date in enumerate(round3_dates):
-            content = f'UO: Daily Diary #{day + 9}'
-            title = f'ASH Daily Diary #{day + 9}'
-            message_datetime = datetime.combine(message_date, sleep_time) - timedelta(hours=2)
-            print(message_datetime)
-            events.append(ApptotoEvent(calendar=self.config['apptoto_calendar'],
-                                       title=title,
-                                       start_time=message_datetime,
-                                       time_zone=subject.redcap.s0.timezone,
-                                       content=content,
-                                       participants=participants))
-
-        if len(events) > 0:
-            posted_events = self.apptoto.post_events(events)
-            self._update_events_file(posted_events)
-
-        return 'Diary round 3 created'
+        with JobTimer('daily_diary_three') as timer:
+            timer.phase('redcap')
+            subject = RedcapParticipant(self.participant_id,
+                                        self.config['redcap_api_token'])
+
+            # first check that we have the required info from redcap
+            check_fields(subject, ['initials', 'phone', 'sleeptime', 'email'])
+
+            if 's1' not in subject.redcap or pd.isnull(subject.redcap.s1.training_end):
+                return f'Missing session1 training end date for {subject.id}'
+
+            timer.phase('contact')
+            # update the contact if needed
+            self.update_contact()
+
+            timer.phase('schedule')
+            participants = [ApptotoParticipant(subject.redcap.s0.initials,
+                                               subject.redcap.s0.phone,
+                                               subject.redcap.s0.email)]
+
+            events = []
+
+            # Diary round 3
+            round3_dates = get_diary_three_dates(subject.redcap.s1.training_end)
+            sleep_time = time.fromisoformat(subject.redcap.s0.sleeptime)
+
+            diaries = pd.Series(EventType.DIARY.value, index=range(len(round3_dates)))
+            message_times = Schedule(sleep_time=sleep_time).times(diaries, round3_dates)
+            for day, message_datetime in enumerate(message_times):
+                content = f'UO: Daily Diary #{day + 9}'
+                title = f'ASH Daily Diary #{day + 9}'
+                events.append(ApptotoEvent(calendar=self.config['apptoto_calendar'],
+                                           title=title,
+                                           start_time=message_datetime.to_pydatetime(),
+                                           time_zone=subject.redcap.s0.timezone,
+                                           content=content,
+                                           participants=participants,
+                                           external_id=make_external_id(subject.id, EventType.DIARY.value,
+                                                                        day + 8)))
+
+            if len(events) > 0:
+                timer.phase('post')
+                posted_events = self.apptoto.post_events(events)
+                timer.phase('record')
+                self._record_posted_events(posted_events)
+                self._record_schedule(events, posted_events, name='diary3')
+
+            return 'Diary round 3 created'
 
     def generate_messages(self, upload=True):
         """
@@ -261,289 +504,257 @@ class EventGenerator:
         messages for boosters, daily diary rounds 2, 3 and 4.
         :return:
         """
-        subject = RedcapParticipant(self.participant_id,
-                                    self.config['redcap_api_token'])
-
-        # first check that we have the required info from redcap
-        check_fields(subject, ['value1_s0', 'value2_s0', 'initials', 'phone',
-                               'sleeptime', 'waketime', 'email'])
-
-        if 's1' not in subject.redcap or pd.isnull(subject.redcap.s1.quitdate):
-            return f'Missing quit date for {subject.id}'
-
-        # update the contact if needed
-        self.update_contact()
-
-        participants = [ApptotoParticipant(subject.redcap.s0.initials,
-                                           subject.redcap.s0.phone,
-                                           subject.redcap.s0.email)]
-
-        events = []
-
-        messages = Messages(self.message_file)
-        num_required_messages = 28 * (MESSAGES_PER_DAY_1 + MESSAGES_PER_DAY_2)
-        condition = Condition(int(subject.redcap.s1.condition))
-        message_values = [CodedValues(int(subject.redcap.s0.value1_s0)),
-                          CodedValues(int(subject.redcap.s0.value2_s0))]
-
-        messages.filter_by_condition(condition,
-                                     message_values,
-                                     num_required_messages)
-
-        quit_date = date.fromisoformat(subject.redcap.s1.quitdate)
-        wake_time = time.fromisoformat(subject.redcap.s0.waketime)
-        sleep_time = time.fromisoformat(subject.redcap.s0.sleeptime)
-
-        Event = namedtuple('Event', ['time', 'title', 'content'])
-
-        # Add quit_message_date date boosters 3 hrs after wake time
-        message_datetime = datetime.combine(quit_date - timedelta(days=1),
-                                            wake_time) + timedelta(hours=3)
-        events.append(Event(time=message_datetime, title='UO: Day Before', content='UO: Day Before Quitting'))
-        message_datetime = datetime.combine(quit_date, wake_time) + timedelta(hours=3)
-        events.append(Event(time=message_datetime, title='UO: Quit Date', content='UO: Quit Date'))
-
-        # Add one message per day asking for a reply with the number of cigarettes smoked, 1 hr before bedtime
-        for days in range(DAYS_1 + DAYS_2):
-            message_date = quit_date + timedelta(days=days)
-            message_datetime = datetime.combine(message_date, sleep_time) - timedelta(hours=1)
+        with JobTimer('generate_messages') as timer:
+            timer.phase('redcap')
+            subject = RedcapParticipant(self.participant_id,
+                                        self.config['redcap_api_token'])
+
+            # first check that we have the required info from redcap
+            check_fields(subject, ['value1_s0', 'value2_s0', 'initials', 'phone',
+                                   'sleeptime', 'waketime', 'email'])
+
+            if 's1' not in subject.redcap or pd.isnull(subject.redcap.s1.quitdate):
+                return f'Missing quit date for {subject.id}'
+
+            # update the contact if needed
+            timer.phase('contact')
+            self.update_contact()
+
+            timer.phase('schedule')
+            participants = [ApptotoParticipant(subject.redcap.s0.initials,
+                                               subject.redcap.s0.phone,
+                                               subject.redcap.s0.email)]
+
+            events = []
+
+            messages = Messages(self.message_file)
+            num_required_messages = 28 * (MESSAGES_PER_DAY_1 + MESSAGES_PER_DAY_2)
+            condition = Condition(int(subject.redcap.s1.condition))
+            message_values = [CodedValues(int(subject.redcap.s0.value1_s0)),
+                              CodedValues(int(subject.redcap.s0.value2_s0))]
+
+            # the seed is kept with the participant's assignment, so the draw can be repeated
+            seed = random.randrange(2 ** 32)
+            rng = random.Random(seed)
+            messages.filter_by_condition(condition,
+                                         message_values,
+                                         num_required_messages,
+                                         random_state=seed)
+
+            quit_date = date.fromisoformat(subject.redcap.s1.quitdate)
+            wake_time = time.fromisoformat(subject.redcap.s0.waketime)
+            sleep_time = time.fromisoformat(subject.redcap.s0.sleeptime)
+
+            Event = namedtuple('Event', ['time', 'title', 'content', 'external_id'], defaults=[None])
+            schedule = Schedule(wake_time, sleep_time, quit_date)
+            study_dates = [quit_date + timedelta(days=day) for day in range(DAYS_1 + DAYS_2)]
+
+            # Messages timed by the schedule rules, as (type, date, slot, title, content)
+            fixed = [(EventType.DAY_BEFORE, quit_date - timedelta(days=1), 0, 'UO: Day Before', 'UO: Day Before Quitting'),
+                     (EventType.QUIT_DATE, quit_date, 0, 'UO: Quit Date', 'UO: Quit Date')]
+
+            # Add one message per day asking for a reply with the number of cigarettes smoked
             content = "UO: Good evening! Please respond with the number of cigarettes you have smoked today. " \
                       "If you have not smoked any cigarettes, please respond with a 0. Thank you!"
-            events.append(Event(time=message_datetime, title=CIGS_TITLE, content=content))
-
-        # Add booster messages, 3 hrs before bedtime
-        n = 1
-        booster_dates = []
-        for days in range(1, 51, 7):
-            message_date = quit_date + timedelta(days=days)
-            booster_dates.append(message_date)
-            message_datetime = datetime.combine(message_date, sleep_time) - timedelta(hours=3)
-
-            title = f'{condition_abbrev(condition)} Booster {n}'
-            content = "UO: Booster session"
-            events.append(Event(time=message_datetime, title=title, content=content))
-            n = n + 1
-
-            message_date = quit_date + timedelta(days=(days + 3))
-            booster_dates.append(message_date)
-            message_datetime = datetime.combine(message_date, sleep_time) - timedelta(hours=3)
-            title = f'{condition_abbrev(condition)} Booster {n}'
-            content = "UO: Booster session"
-            events.append(Event(time=message_datetime, title=title, content=content))
-            n = n + 1
-
-        # Add daily diary round 2 messages, 2 hrs before bedtime
-        round2_start = quit_date + timedelta(weeks=4)
-        round2_dates = get_diary_dates(round2_start)
-        for day, message_date in enumerate(round2_dates):
-            message_datetime = datetime.combine(message_date, sleep_time) - timedelta(hours=2)
-            content = f'UO: Daily Diary #{day + 5}'
-            title = f'ASH Daily Diary #{day + 5}'
-            events.append(Event(time=message_datetime, title=title, content=content))
-
-        # Generate intervention messages
-        logger.info(f'Generating intervention messages for {subject.id}')
-        n = 0
-        for day in range(DAYS_1 + DAYS_2):
-            message_date = quit_date + timedelta(days=day)
-            # if message_date == quit_date:
-            #     start_time = datetime.combine(message_date, wake_time) + timedelta(hours=4)
-            # else:
-            #     start_time = datetime.combine(message_date, wake_time)
-
-            # if message_date in booster_dates:
-            #     end_time = datetime.combine(message_date, sleep_time) - timedelta(hours=4)
-            # elif message_date in round2_dates:
-            #     end_time = datetime.combine(message_date, sleep_time) - timedelta(hours=3)
-            # else:
-            #     end_time = datetime.combine(message_date, sleep_time) - timedelta(hours=2)
-
-            (start_time, end_time) = self.make_intervention_startend(message_date, subject, booster_dates, round2_dates)
-            
-            # Get times each day to send messages
-            # Send 5 messages a day for the first 28 days, 4 after
-            if day in range(DAYS_1):
-                n_messages = MESSAGES_PER_DAY_1
-            else:
-                n_messages = MESSAGES_PER_DAY_2
-
-            times_list = random_times(start_time, end_time, n_messages)
-            for t in times_list:
-                # Prepend each message with "UO: "
-                content = "UO: " + messages[n]
-                events.append(Event(time=t, title=SMS_TITLE, content=content))
-                n = n + 1
-
-        if len(events) > 0 and upload:
-            apptoto_events = []
-            for e in sorted(events):
-                apptoto_events.append(ApptotoEvent(calendar=self.config['apptoto_calendar'],
-                                                   title=e.title,
-                                                   start_time=e.time,
-                                                   content=e.content,
-                                                   participants=participants,
-                                                   time_zone=subject.redcap.s0.timezone))
-
-            posted_events = self.apptoto.post_events(apptoto_events)
-            self._update_events_file(posted_events)
-
-            csv_path = Path(DOWNLOAD_DIR)
-            if not csv_path.exists():
-                csv_path.mkdir()
-            f = csv_path / (subject.id + '_messages.csv')
-            messages.write_to_file(f, columns=['UO_ID', 'Message'])
-
-        return f'Messages written to {subject.id}_messages.csv'
-
-    def make_intervention_startend(self, message_date, subject, booster_dates, round2_dates):
-        # Get subject info
-        quit_date = date.fromisoformat(subject.redcap.s1.quitdate)
-        wake_time = time.fromisoformat(subject.redcap.s0.waketime)
-        sleep_time = time.fromisoformat(subject.redcap.s0.sleeptime)
-
-        if message_date == quit_date:
-            start_time = datetime.combine(message_date, wake_time) + timedelta(hours=4)
-        else:
-            start_time = datetime.combine(message_date, wake_time)
-
-        if message_date in booster_dates:
-            end_time = datetime.combine(message_date, sleep_time) - timedelta(hours=4)
-        elif message_date in round2_dates:
-            end_time = datetime.combine(message_date, sleep_time) - timedelta(hours=3)
-        else:
-            end_time = datetime.combine(message_date, sleep_time) - timedelta(hours=2)
+            for day, message_date in enumerate(study_dates):
+                fixed.append((EventType.CIGS, message_date, day, CIGS_TITLE, content))
+
+            # Add booster messages, twice a week
+            n = 1
+            for days in range(1, 51, 7):
+                for message_date in (quit_date + timedelta(days=days), quit_date + timedelta(days=days + 3)):
+                    title = f'{condition_abbrev(condition)} Booster {n}'
+                    fixed.append((EventType.BOOSTER, message_date, n - 1, title, "UO: Booster session"))
+                    n = n + 1
+
+            # Add daily diary round 2 messages
+            round2_start = quit_date + timedelta(weeks=4)
+            for day, message_date in enumerate(get_diary_dates(round2_start)):
+                fixed.append((EventType.DIARY, message_date, day + 4, f'ASH Daily Diary #{day + 5}',
+                              f'UO: Daily Diary #{day + 5}'))
+
+            fixed = pd.DataFrame(fixed, columns=['event_type', 'day', 'slot', 'title', 'content'])
+            fixed['event_type'] = [t.value for t in fixed.event_type]
+            fixed['time'] = schedule.times(fixed.event_type, fixed.day)
+            for e in fixed.itertuples():
+                events.append(Event(time=e.time.to_pydatetime(), title=e.title, content=e.content,
+                                    external_id=make_external_id(subject.id, e.event_type, e.slot)))
+
+            # Generate intervention messages
+            logger.info(f'Generating intervention messages for {subject.id}')
+            windows = schedule.intervention_windows(study_dates, fixed.assign(day=pd.to_datetime(fixed.day)))
+            n = 0
+            for day, window in enumerate(windows.itertuples()):
+                # Get times each day to send messages
+                # Send 5 messages a day for the first 28 days, 4 after
+                if day in range(DAYS_1):
+                    n_messages = MESSAGES_PER_DAY_1
+                else:
+                    n_messages = MESSAGES_PER_DAY_2
+
+                times_list = random_times(window.start.to_pydatetime(), window.end.to_pydatetime(), n_messages, rng)
+                for t in times_list:
+                    # Prepend each message with "UO: "
+                    content = "UO: " + messages[n]
+                    # the UO_ID is kept with the event, so replies can be attributed without matching content
+                    external_id = make_external_id(subject.id, EventType.SMS.value, n, messages.uo_id(n))
+                    events.append(Event(time=t, title=SMS_TITLE, content=content, external_id=external_id))
+                    n = n + 1
+
+            if len(events) > 0 and upload:
+                apptoto_events = []
+                for e in sorted(events):
+                    apptoto_events.append(ApptotoEvent(calendar=self.config['apptoto_calendar'],
+                                                       title=e.title,
+                                                       start_time=e.time,
+                                                       content=e.content,
+                                                       participants=participants,
+                                                       external_id=e.external_id,
+                                                       time_zone=subject.redcap.s0.timezone))
+
+                timer.phase('post')
+                posted_events = self.apptoto.post_events(apptoto_events)
+                timer.phase('record')
+                self._record_posted_events(posted_events)
+                self._record_schedule(apptoto_events, posted_events, name='messages')
+                self._record_assignment(apptoto_events, seed)
+
+        return f'Messages scheduled for {subject.id}, download {subject.id}_messages.csv with the files'
+
+    def generate_task_files(self, archive: zipfile.ZipFile = None):
+        """
+        Write the participant's task files, one for each session and run.
 
-        return (start_time, end_time)
+        :param archive: Zip file to write them to, instead of the download directory
+        :return: Status message
+        """
+        with JobTimer('generate_task_files') as timer:
+            timer.phase('redcap')
+            subject = RedcapParticipant(self.participant_id,
+                                        self.config['redcap_api_token'])
+            # first check that we have the required info from redcap
+            check_fields(subject, ['value1_s0', 'value7_s0'])
+
+            values = (int(subject.redcap.s0.value1_s0), int(subject.redcap.s0.value7_s0))
+            timer.phase('draw')
+            files = task_files(self.message_file, subject.id, values)
+
+            timer.phase('write')
+            if archive is not None:
+                for name, contents in files.items():
+                    archive.writestr(name, contents)
+            else:
+                csv_path = Path(DOWNLOAD_DIR)
+                csv_path.mkdir(parents=True, exist_ok=True)
+                for name, contents in files.items():
+                    (csv_path / name).write_bytes(contents)
+            logger.info(f'Wrote {len(files)} task files for {subject.id}')
 
-    def generate_task_files(self):
-        subject = RedcapParticipant(self.participant_id,
-                                    self.config['redcap_api_token'])
-        # first check that we have the required info from redcap
-        check_fields(subject, ['value1_s0', 'value7_s0'])
+            return f'Task files created for {subject.id}'
 
-        csv_path = Path(DOWNLOAD_DIR)
-        if not csv_path.exists():
-            csv_path.mkdir(parents=True)
-        task_values = [CodedValues(int(subject.redcap.s0.value1_s0)),
-                       CodedValues(int(subject.redcap.s0.value7_s0))]
-
-        for session in range(1, 3):
-            for run in range(1, 5):
-                messages = Messages(self.message_file)
-                messages.filter_by_condition(Condition.VALUES,
-                                             task_values,
-                                             TASK_MESSAGES)
-                messages.add_column('iti', ITI)
-                file_name = csv_path / f'VAFF_{subject.id}_Session{session}_Run{run}.csv'
-                messages.write_to_file(file_name, columns=['Message', 'iti'],
-                                       header=['message', 'iti'])
-                logger.info(f'Wrote {file_name.name}')
-
-        return f'Task files created for {subject.id}'
+    def reply_window(self):
+        """
+        :return: Longest time between a sent message and a reply to it,
+            `reply_window_hours` in the config (default = REPLY_WINDOW)
+        """
+        if 'reply_window_hours' in self.config:
+            return timedelta(hours=self.config['reply_window_hours'])
+        return REPLY_WINDOW
 
     def get_conversations(self):
         """Get timestamp and content of all message to and from participant."""
 
-        begin = datetime(year=2021, month=4, day=1)
-        events = self.apptoto.get_events_by_contact(begin,
-                                                    external_id=self.participant_id,
-                                                    calendar_id=ASH_CALENDAR_ID,
-                                                    include_conversations=True)
-
-        # potential "new" way, not currently possible
-        # event_ids = self._get_event_ids()
-        # logger.info(f'Searching {len(event_ids)} events')
-        # events = self.apptoto.get_events(event_ids, begin=begin, include_conversations=True)
-
-        conversations = pd.json_normalize(events, record_path=['participants',
-                                                               'conversations',
-                                                               'messages'],
-                                          meta=['title',
-                                                'start_time',
-                                                'calendar_id',
-                                                ['participants', 'event_id']])
-
-        csv_path = Path(DOWNLOAD_DIR)
-
-        #FOR TESTING ONLY, THIS MUST BE COMMENTED OUT IN RELEASE VERSIONS
-        # allevents = self.apptoto.get_events_by_contact(begin,
-        #                                                external_id=self.participant_id,
-        #                                                calendar_id=ASH_CALENDAR_ID)
-        # #allevents = pd.json_normalize(allevents, meta=['title', 'start_time', 'content', 'id'])
-        # with open(csv_path / f'{self.participant_id}_all_events_TESTING.txt', 'w') as f:
-        #     for e in allevents:
-        #         f.write(f'Event: {e["title"]}, {e["content"]}, {e["start_time"]}\n')
-        # logger.info(f'Events written to {self.participant_id}_all_events_TESTING.txt')
-        #END OF TEST BLOCK
-
-        if conversations.empty:
-            return f'No conversations found for {self.participant_id}.'
-
-        conversations = conversations[conversations.calendar_id == ASH_CALENDAR_ID]
-        conversations['start_time'] = pd.to_datetime(conversations['start_time'])
-
-        messages = pd.read_csv(self.message_file, dtype=str)
-        messages['content'] = 'UO: ' + messages.Message
-        conversations = conversations.merge(messages, on='content', how='left').set_index('id')
-
-        conversations['at'] = pd.to_datetime(conversations['at'])
-
-        # FOR DEBUGGING ONLY
-        # conversations.to_csv(csv_path / f'{self.participant_id}_all_conversations.csv', date_format='%x %X')
-
-        sent = conversations[conversations.event_type == 'sent'].dropna(axis=1, how='all')
-        received = conversations[conversations.event_type == 'replied'].dropna(axis=1, how='all')
-        if 'UO_ID' in received.columns:  # temporary fix
-            received = received.drop(columns=['UO_ID'])
-
-        if sent.empty:
-            return f'No messages sent for {self.participant_id}.'
-
-        elif received.empty:
-            merged = sent.rename(columns={'at': 'at_sent', 'content': 'content_sent', 'title': 'title_sent'})
-            merged['at_rec'] = pd.NaT
-            merged['content_rec'] = np.nan
-
-        else:
-            merged = sent.merge(received, on='participants.event_id', suffixes=('_sent', '_rec'), how='outer')
-
-        if 'UO_ID' not in merged.columns:
-            merged['UO_ID'] = np.nan
-
-        columns = ['at_sent', 'UO_ID', 'content_sent', 'at_rec', 'content_rec']
-        header = ['sent_at', 'UO_ID', 'message', 'replied_at', 'reply']
-
-        sms_convos = merged[(merged.title_sent.str.contains(SMS_TITLE)) & (~merged.UO_ID.isna())]
-
-        sms_name = csv_path / f'{self.participant_id}_sms_conversations.csv'
-
-        sms_convos.to_csv(sms_name, date_format='%x %X', columns=columns, header=header, index=False)
+        with JobTimer('get_conversations') as timer:
+            timer.phase('redcap')
+            subject = RedcapParticipant(self.participant_id,
+                                        self.config['redcap_api_token'])
+            window = study_window(subject)
+            if window:
+                begin, end = window
+            else:
+                begin, end = datetime(year=2021, month=4, day=1), None
 
-        cig_convos = merged[(merged.title_sent.str.contains(CIGS_TITLE)) & (merged.content_sent.str.startswith('UO'))]
-        cig_name = csv_path / f'{self.participant_id}_cig_conversations.csv'
-        cig_convos.to_csv(cig_name, date_format='%x %X', columns=columns, header=header, index=False)
+            events = self.apptoto.iter_events_by_contact(begin,
+                                                         external_id=self.participant_id,
+                                                         calendar_id=ASH_CALENDAR_ID,
+                                                         include_conversations=True,
+                                                         end=end)
 
-        sms_sent = len(sms_convos['participants.event_id'].unique())
-        sms_rec = len(sms_convos[~sms_convos.content_rec.isnull()]['participants.event_id'].unique())
-        cig_sent = len(cig_convos['participants.event_id'].unique())
-        cig_rec = len(cig_convos[~cig_convos.content_rec.isnull()]['participants.event_id'].unique())
+            # potential "new" way, not currently possible
+            # event_ids = self._get_event_ids()
+            # logger.info(f'Searching {len(event_ids)} events')
+            # events = self.apptoto.get_events(event_ids, begin=begin, include_conversations=True)
 
-        with np.errstate(divide='ignore', invalid='ignore'):
-            response_rate = 100 * np.divide((sms_rec + cig_rec), (sms_sent + cig_sent))
-            cig_rr = 100 * np.divide(cig_rec, cig_sent)
-            sms_rr = 100 * np.divide(sms_rec, sms_sent)
+            # events are flattened as they are retrieved, so the full event list is never held in memory
+            timer.phase('fetch')
+            conversations = pd.DataFrame.from_records(conversation_rows(events))
+            timer.phase('attribute')
 
-        with open(csv_path / f'{self.participant_id}_summary.txt', 'w') as f:
-            f.write(f'SMS messages sent: {sms_sent}\n')
-            f.write(f'SMS replies: {sms_rec}\n')
-            f.write(f'SMS response rate: {sms_rr:.02f}\n')
-            f.write(f'CIG messages sent: {cig_sent}\n')
-            f.write(f'CIG replies: {cig_rec}\n')
-            f.write(f'CIG response rate: {cig_rr:.02f}\n')
-            f.write(f'Overall response rate: {response_rate:.02f}\n')
+            csv_path = Path(DOWNLOAD_DIR)
 
-        logger.info(f'Conversations written to {sms_name.name} and {cig_name.name}.')
-        logger.info(f'Summary written to {self.participant_id}_summary.txt.')
+            #FOR TESTING ONLY, THIS MUST BE COMMENTED OUT IN RELEASE VERSIONS
+            # allevents = self.apptoto.get_events_by_contact(begin,
+            #                                                external_id=self.participant_id,
+            #                                                calendar_id=ASH_CALENDAR_ID)
+            # #allevents = pd.json_normalize(allevents, meta=['title', 'start_time', 'content', 'id'])
+            # with open(csv_path / f'{self.participant_id}_all_events_TESTING.txt', 'w') as f:
+            #     for e in allevents:
+            #         f.write(f'Event: {e["title"]}, {e["content"]}, {e["start_time"]}\n')
+            # logger.info(f'Events written to {self.participant_id}_all_events_TESTING.txt')
+            #END OF TEST BLOCK
+
+            if conversations.empty:
+                return f'No conversations found for {self.participant_id}.'
+
+            conversations = conversations[conversations.calendar_id == ASH_CALENDAR_ID]
+            # offsets change with daylight saving time, so times are parsed as UTC
+            start_times = pd.to_datetime(conversations['start_time'], utc=True)
+            conversations['start_time'] = start_times.dt.tz_convert(APPTOTO_TZ)
+
+            conversations['UO_ID'] = sent_message_ids(conversations, lambda: message_index(self.message_file),
+                                                         assignment=self.store.read('assignments', self.participant_id))
+
+            conversations['at'] = pd.to_datetime(conversations['at'], utc=True).dt.tz_convert(APPTOTO_TZ)
+
+            # FOR DEBUGGING ONLY
+            # conversations.to_csv(csv_path / f'{self.participant_id}_all_conversations.csv', date_format='%x %X')
+
+            sent = conversations[conversations.event_type == 'sent']
+            received = conversations[conversations.event_type == 'replied']
+
+            if sent.empty:
+                return f'No messages sent for {self.participant_id}.'
+
+            merged = attribute_replies(sent, received, window=self.reply_window())
+            merged = merged.rename(columns={'participants.event_id': 'event_id'})
+            timer.phase('record')
+            self.store.write('conversations', self.participant_id, merged[STORE_COLUMNS], name='apptoto')
+            # pushed messages that were fetched are in the conversations now, those pushed since are kept
+            inbound = self.store.read('inbound', self.participant_id)
+            if not inbound.empty:
+                self.store.drop_rows('inbound', self.participant_id, 'id', inbound.id[inbound.id.isin(conversations.id)])
+
+            counts = response_counts(merged)
+            sms_sent, sms_rec, cig_sent, cig_rec = (counts[k] for k in COUNTS)
+
+            self.dashboard.conversations_synced(self.participant_id, counts)
+
+            with np.errstate(divide='ignore', invalid='ignore'):
+                response_rate = 100 * np.divide((sms_rec + cig_rec), (sms_sent + cig_sent))
+                cig_rr = 100 * np.divide(cig_rec, cig_sent)
+                sms_rr = 100 * np.divide(sms_rec, sms_sent)
+
+            with open(csv_path / f'{self.participant_id}_summary.txt', 'w') as f:
+                f.write(f'SMS messages sent: {sms_sent}\n')
+                f.write(f'SMS replies: {sms_rec}\n')
+                f.write(f'SMS response rate: {sms_rr:.02f}\n')
+                f.write(f'CIG messages sent: {cig_sent}\n')
+                f.write(f'CIG replies: {cig_rec}\n')
+                f.write(f'CIG response rate: {cig_rr:.02f}\n')
+                f.write(f'Overall response rate: {response_rate:.02f}\n')
+
+            logger.info(f'Conversations saved for {self.participant_id}.')
+            logger.info(f'Summary written to {self.participant_id}_summary.txt.')
 
         if np.isnan(response_rate):
             message = f'No conversations started for {self.participant_id}.'
@@ -571,247 +782,203 @@ class EventGenerator:
         event_ids = [e['id'] for e in events if not e.get('is_deleted')
                      and e.get('calendar_id') == ASH_CALENDAR_ID]"""
 
-        events = self.apptoto.get_events_by_contact(begin,
-                                                    external_id=self.participant_id,
-                                                    calendar_id=ASH_CALENDAR_ID)
+        # participants who withdraw before session 1 have no quit date, so search without an end
+        with JobTimer('delete_messages') as timer:
+            timer.phase('redcap')
+            subject = RedcapParticipant(self.participant_id,
+                                        self.config['redcap_api_token'])
+            window = study_window(subject)
+            end = window[1] if window else None
 
-        event_ids = list({e['id'] for e in events})
-        logger.info(f'Found {len(event_ids)} events for {self.participant_id}')
+            timer.phase('fetch')
+            events = self.apptoto.iter_events_by_contact(begin,
+                                                         external_id=self.participant_id,
+                                                         calendar_id=ASH_CALENDAR_ID,
+                                                         end=end)
 
-        deleted = 0
+            events = [{'id': e['id'], 'start_time': e.get('start_time')} for e in events]
+            logger.info(f'Found {len(events)} events for {self.participant_id}')
 
-        for event_id in event_ids:
-            self.apptoto.delete_event(event_id)
-            deleted += 1
-            logger.info('Deleted event {}, {} of {}'.format(event_id, deleted, len(event_ids)))
+            timer.phase('delete')
+            self._delete_events(events)
 
-        return f'Deleted {len(event_ids)} messages for {self.participant_id}'
+        return f'Deleted {len(events)} messages for {self.participant_id}'
 
     def update_events(self):
         # get all future events for a subject
         # Add or change phone & email to match redcap information
-        subject = RedcapParticipant(self.participant_id,
-                                    self.config['redcap_api_token'])
-
-        begin = datetime.now(timezone.utc)
-        if self.participant_id == "ASH990":
-            begin = datetime(year=2021, month=4, day=1)
-
-        # this would be another way, never implemented
-        """event_ids = self._get_event_ids()
-          events = []
-        for e_id in event_ids:
-            events.append(self.apptoto.get_event(e_id))
-        events = [e for e in events if datetime.fromisoformat(e['start_time']) > begin]"""
+        with JobTimer('update_events') as timer:
+            timer.phase('redcap')
+            subject = RedcapParticipant(self.participant_id,
+                                        self.config['redcap_api_token'])
+
+            now = datetime.now(timezone.utc)
+            # the crawl starts at the start of the day, so concurrent updates make the same query and share it
+            begin = now.replace(hour=0, minute=0, second=0, microsecond=0)
+            if self.participant_id == "ASH990":
+                begin = now = datetime(year=2021, month=4, day=1, tzinfo=timezone.utc)
+
+            # this would be another way, never implemented
+            """event_ids = self._get_event_ids()
+              events = []
+            for e_id in event_ids:
+                events.append(self.apptoto.get_event(e_id))
+            events = [e for e in events if datetime.fromisoformat(e['start_time']) > begin]"""
+
+            window = study_window(subject)
+            timer.phase('fetch')
+            events = self.apptoto.get_events_by_contact(begin,
+                                                        external_id=self.participant_id,
+                                                        calendar_id=ASH_CALENDAR_ID,
+                                                        end=window[1] if window else None)
+            # events sent earlier in the day are left as they are
+            events = [e for e in events if datetime.fromisoformat(e['start_time']) >= now]
+
+            if not events:
+                logger.info(f"Could not find any events for subject {subject.id}")
+                return f'No future events for subject {subject.id}'
+
+            e_df = pd.DataFrame.from_records(events)
+
+            e_df.rename(columns={'calendar_name': 'calendar'}, inplace=True)
+            e_df.drop(columns='is_deleted', inplace=True)
 
-        events = self.apptoto.get_events_by_contact(begin,
-                                                    external_id=self.participant_id,
-                                                    calendar_id=ASH_CALENDAR_ID)
-
-        if not events:
-            logger.info(f"Could not find any events for subject {subject.id}")
-            return f'No future events for subject {subject.id}'
-
-        e_df = pd.DataFrame.from_records(events)
-        e_df.drop_duplicates(subset='id', inplace=True)
-
-        e_df.rename(columns={'calendar_name': 'calendar'}, inplace=True)
-        e_df.drop(columns='is_deleted', inplace=True)
-
-        phone = normalize_phone(subject.redcap.s0.phone)
-        email = subject.redcap.s0.email
-        initials = subject.redcap.s0.initials
-
-        #TESTING
-        #subject.redcap.s0.timezone = 'ET'
-        #e_df['title'] = 'test update'
-        #print(e_df.start_time)
-        #e_df.start_time = [datetime.fromisoformat(x) - timedelta(hours=5) for x in e_df.start_time]
+            phone = normalize_phone(subject.redcap.s0.phone)
+            email = subject.redcap.s0.email
+            initials = subject.redcap.s0.initials
 
-        # As far as I can tell, apptoto will NOT actually change the times when you put the events
-        # So this currently does not do anything
-        e_df.start_time = [change_tz(x, subject.redcap.s0.timezone) for x in e_df.start_time]
-        e_df.end_time = [change_tz(x, subject.redcap.s0.timezone) for x in e_df.end_time]
+            #TESTING
+            #subject.redcap.s0.timezone = 'ET'
+            #e_df['title'] = 'test update'
+            #print(e_df.start_time)
+            #e_df.start_time = [datetime.fromisoformat(x) - timedelta(hours=5) for x in e_df.start_time]
 
-        # check email, phone against new values
-        e_df['phone'] = [p[0]['normalized_phone'] for p in e_df.participants]
-        e_df['email'] = [p[0]['email'] for p in e_df.participants]
+            # As far as I can tell, apptoto will NOT actually change the times when you put the events
+            # So this currently does not do anything
+            e_df['start_time'] = change_tz(e_df.start_time, subject.redcap.s0.timezone)
+            e_df['end_time'] = change_tz(e_df.end_time, subject.redcap.s0.timezone)
 
-        # originally we only changed if the phone/email changed, but we need to change the name too
-        # and time zone so just update all of them
-        # e_df = e_df[(e_df.phone != phone) | (e_df.email != email)]
-        e_df.drop(columns=['phone', 'email'], inplace=True)
-        new_participant = {'name': initials, 'phone': phone, 'email': email, 'contact_external_id': subject.id}
-        e_df['participants'] = [[new_participant] for i in range(0, len(e_df))]
-        updated_events = e_df.to_dict(orient='records')
+            # originally we only changed if the phone/email changed, but we need to change the name too
+            # and time zone so just update all of them
+            new_participant = {'name': initials, 'phone': phone, 'email': email, 'contact_external_id': subject.id}
+            e_df['participants'] = [[new_participant] for i in range(0, len(e_df))]
+            updated_events = e_df.to_dict(orient='records')
 
-        self.apptoto.put_events(updated_events)
+            timer.phase('put')
+            self.apptoto.put_events(updated_events)
 
         asyncio.run(self.update_times())
 
         return f'Updated {len(updated_events)} events for subject {subject.id}'
     
     async def update_times(self):
-        subject = RedcapParticipant(self.participant_id,
-                                    self.config['redcap_api_token'])
-
-        participants = [ApptotoParticipant(subject.redcap.s0.initials,
-                                           subject.redcap.s0.phone,
-                                           subject.redcap.s0.email)]
-
-        quit_date = date.fromisoformat(subject.redcap.s1.quitdate)
-        wake_time = time.fromisoformat(subject.redcap.s0.waketime)
-        sleep_time = time.fromisoformat(subject.redcap.s0.sleeptime)
+        with JobTimer('update_times') as timer:
+            timer.phase('redcap')
+            subject = RedcapParticipant(self.participant_id,
+                                        self.config['redcap_api_token'])
+
+            participants = [ApptotoParticipant(subject.redcap.s0.initials,
+                                               subject.redcap.s0.phone,
+                                               subject.redcap.s0.email)]
+
+            quit_date = date.fromisoformat(subject.redcap.s1.quitdate)
+            wake_time = time.fromisoformat(subject.redcap.s0.waketime)
+            sleep_time = time.fromisoformat(subject.redcap.s0.sleeptime)
+
+            begin = datetime.combine(date.today() + timedelta(days=1), time(0, 0, 0))
+            if self.participant_id == "ASH990":
+                begin = datetime(year=2021, month=4, day=1)
+
+            # Unprocessed list of events
+            timer.phase('fetch')
+            eRaw = self.apptoto.get_events_by_contact(begin,
+                                                      external_id=self.participant_id,
+                                                      calendar_id=ASH_CALENDAR_ID,
+                                                      end=study_window(subject)[1])
+            if not eRaw:
+                logger.info(f'No future events for subject {subject.id}')
+                return f'No future events for subject {subject.id}'
+
+            schedule = Schedule(wake_time, sleep_time, quit_date)
+            e_df = pd.DataFrame.from_records(eRaw)
+            e_df['event_type'] = event_types(e_df.external_id, e_df.title)
+            e_df['local_time'] = local_times(e_df.start_time, subject.redcap.s0.timezone)
+            e_df['day'] = schedule.scheduled_days(e_df.event_type, e_df.local_time)
+            e_df['time'] = schedule.times(e_df.event_type, e_df.day)
+            fixed = e_df[e_df.time.notna()]
+
+            # Checks if the times need to be updated or not
+            if (fixed.time == fixed.local_time).all():
+                logger.info(f"Subject {subject.id}'s wake and sleep times are unchanged")
+                return f"Subject {subject.id}'s wake and sleep times are unchanged"
+
+            timer.phase('schedule')
+            # the new times are drawn with the seed the messages were drawn with
+            assignment = self.store.read('assignments', self.participant_id)
+            rng = random.Random(int(assignment.seed.iloc[0])) if not assignment.empty else random
+
+            # events of other types keep their times
+            e_df['time'] = e_df.time.fillna(e_df.local_time)
+
+            intervention = e_df.event_type == EventType.SMS.value
+            if intervention.any():
+                intervention_df = e_df[intervention].sort_values('local_time', kind='stable')
+                days = intervention_df.day.to_numpy()
+                firsts = np.flatnonzero(np.r_[True, days[1:] != days[:-1]])
+                windows = schedule.intervention_windows(days[firsts], fixed)
+
+                # the day's messages are given new times in the order they were sent
+                times = []
+                for first, last, window in zip(firsts, [*firsts[1:], len(days)], windows.itertuples()):
+                    times.extend(random_times(window.start.to_pydatetime(), window.end.to_pydatetime(),
+                                              last - first, rng))
+                e_df.loc[intervention_df.index, 'time'] = times
+
+            # events posted before every event had a type in its external id get one
+            missing = e_df.external_id.isna() & e_df.event_type.notna()
+            if missing.any():
+                slots = e_df.sort_values('time', kind='stable').groupby('event_type').cumcount()
+                e_df['external_id'] = e_df.external_id.astype(object)
+                e_df.loc[missing, 'external_id'] = [make_external_id(subject.id, event_type, slot) for event_type, slot
+                                                    in zip(e_df.event_type[missing], slots[missing])]
 
-        begin = datetime.combine(date.today() + timedelta(days=1), time(0, 0, 0))
-        if self.participant_id == "ASH990":
-            begin = datetime(year=2021, month=4, day=1)
+            apptoto_events = []
 
-        # Unprocessed list of events
-        eRaw = self.apptoto.get_events_by_contact(begin,
-                                                    external_id=self.participant_id,
-                                                    calendar_id=ASH_CALENDAR_ID)
-        if not eRaw:
-            logger.info(f'No future events for subject {subject.id}')
-            return f'No future events for subject {subject.id}'
-        # Checks if the times need to be updated or not (currently only quit date and daily diary)
-        sleepUnchanged = False
-        anySleep = False
-        wakeUnchanged = False
-        anyWake = False
-        oldSleepTime = datetime.now()
-
-        for e in eRaw:
-            msgDTime = datetime.fromisoformat(e["start_time"])
-            if re.search("ASH Daily Diary", e["title"]):
-                anySleep = True
-                oldSleepTime = msgDTime + timedelta(hours=2)
-                sleepUnchanged = (msgDTime == datetime.combine(msgDTime.date(), sleep_time, msgDTime.tzinfo) - timedelta(hours=2))
-            elif (re.search("UO: Quit Date", e["title"])):
-                anyWake = True
-                wakeUnchanged = (msgDTime == datetime.combine(msgDTime.date(), wake_time, msgDTime.tzinfo) + timedelta(hours=3))
-        if not anyWake:
-            wakeUnchanged = True
-        if not anySleep:
-            sleepUnchanged = True
-        if sleepUnchanged and wakeUnchanged:
-            logger.info(f"Subject {subject.id}'s wake and sleep times are unchanged")
-            return f"Subject {subject.id}'s wake and sleep times are unchanged"
-
-        e_df = pd.DataFrame.from_records(eRaw)
-        #e_df.drop_duplicates(subset='id', inplace=True)
-        e_df.drop(columns='is_deleted', inplace=True)
-        e_df.drop(columns="end_time", inplace=True)
-        e_df.drop(columns="id", inplace=True)
-        events = []
+            for e in e_df.itertuples():
+                apptoto_events.append(ApptotoEvent(calendar=self.config['apptoto_calendar'],
+                                                   title=e.title,
+                                                   start_time=e.time.to_pydatetime(),
+                                                   content=e.content,
+                                                   participants=participants,
+                                                   external_id=e.external_id,
+                                                   time_zone=subject.redcap.s0.timezone))
 
-        intervention_df = e_df[e_df["title"] == "ASH SMS"]
-        nonintervention_df = e_df[e_df["title"] != "ASH SMS"]
-        nonintervention_df["start_time"] = nonintervention_df.apply(lambda row: self.get_new_time(title=row['title'], start=row['start_time'],
-                                                                                                  quit_date=quit_date, wake_time=wake_time, sleep_time=sleep_time),
-                                                                    axis=1)
-        events.extend(self.make_event_list_from_df(nonintervention_df))
-
-        if (not intervention_df.empty):
-            booster_dates = e_df[e_df["title"].str.contains("Booster")].apply(lambda row: self.get_date(row['start_time']), axis=1).to_list()
-            round2_dates = e_df[e_df["title"] == "ASH Daily Diary"].apply(lambda row: self.get_date(row['start_time']), axis=1)['start_time'].to_list()
-            # intervention_df["start_time"] = intervention_df.apply(lambda row: self.get_date(row['start_time']), axis=1)
-            intervention_df["start_time"] = intervention_df.apply(lambda row: datetime.fromisoformat(row['start_time']), axis=1)
-            intervention_list = self.make_event_list_from_df(intervention_df)
-            intervention_list = sorted(intervention_list, key=lambda e: e.time)
-            intervention_list_list = []
-
-            firstTime = intervention_list[0].time
-            currentSleep = datetime.combine(date=firstTime.date(), time=oldSleepTime.time(), tzinfo=oldSleepTime.tzinfo)
-            currentGroup = []
-            #Iterates through events and groups them by day
-            for event in intervention_list:
-                if event.time > currentSleep:
-                    if len(currentGroup) > 0:
-                        intervention_list_list.append(currentGroup.copy())
-                    currentGroup.clear()
-                    currentSleep = currentSleep + timedelta(days=1)
-                currentGroup.append(event)
-            intervention_list_list.append(currentGroup.copy())
-
-            for dayGroup in intervention_list_list:
-                group = self.get_intervention_time(dayGroup, subject, booster_dates, round2_dates)
-                events.extend(group)
-
-        apptoto_events = []
-
-        for e in events:
-            apptoto_events.append(ApptotoEvent(calendar=self.config['apptoto_calendar'],
-                                               title=e.title,
-                                               start_time=e.time,
-                                               content=e.content,
-                                               participants=participants,
-                                               time_zone=subject.redcap.s0.timezone))
-
-        self.cleanup_old_messages(eRaw) # COMMENT OUT DURING TESTING
-
-        # with open(Path(DOWNLOAD_DIR) / f'{self.participant_id}_TestLog2.txt', 'w') as f:
-        #     for a_e in apptoto_events:
-        #         f.write(f'Event: {a_e.title}, {a_e.start_time}, {a_e.content}\n')
-        posted_events = self.apptoto.post_events(apptoto_events) # COMMENT OUT DURING TESTING
-        self._update_events_file(posted_events) # COMMENT OUT DURING TESTING
-        messages = Messages(self.message_file)
-        csv_path = Path(DOWNLOAD_DIR)
-        if not csv_path.exists():
-            csv_path.mkdir()
-        f = csv_path / (subject.id + '_updated_messages.csv')
-        messages.write_to_file(f, columns=['UO_ID', 'Message'])
-        logger.info(f'Updated messages written to {subject.id}_updated_messages.csv')
+            timer.phase('delete')
+            self.cleanup_old_messages(eRaw) # COMMENT OUT DURING TESTING
+
+            # with open(Path(DOWNLOAD_DIR) / f'{self.participant_id}_TestLog2.txt', 'w') as f:
+            #     for a_e in apptoto_events:
+            #         f.write(f'Event: {a_e.title}, {a_e.start_time}, {a_e.content}\n')
+            timer.phase('post')
+            posted_events = self.apptoto.post_events(apptoto_events) # COMMENT OUT DURING TESTING
+            timer.phase('record')
+            self._record_posted_events(posted_events) # COMMENT OUT DURING TESTING
+            self._record_schedule(apptoto_events, posted_events)
+            assignment = self._retime_assignment(assignment, apptoto_events)
+            csv_path = Path(DOWNLOAD_DIR)
+            if not csv_path.exists():
+                csv_path.mkdir()
+            f = csv_path / (subject.id + '_updated_messages.csv')
+            assignment.to_csv(f, columns=['UO_ID', 'Message', 'start_time'], index=False)
+            logger.info(f'Updated messages written to {subject.id}_updated_messages.csv')
 
         return f'Updated timing of {len(apptoto_events)} events for subject {subject.id}'
 
     def cleanup_old_messages(self, events):
         logger.info("Beginning cleanup")
-        for e in events:
-            logger.info(f'Deleting event {e["id"]}')
-            self.apptoto.delete_event(e["id"])
+        self._delete_events(events)
         logger.info("Finished cleanup")
 
-    def get_new_time(self, title, start, quit_date, wake_time, sleep_time):
-        message_date = self.get_date(start)
-
-        if (re.search("UO: Day Before", title)): 
-            return datetime.combine(quit_date - timedelta(days=1), wake_time) + timedelta(hours=3)
-        elif (re.search("UO: Quit Date", title)):
-            return datetime.combine(quit_date, wake_time) + timedelta(hours=3)
-        elif (re.search("ASH CIGS", title)):
-            return datetime.combine(message_date, sleep_time) - timedelta(hours=1)
-        elif (re.search("Booster \d+$", title)):
-            return datetime.combine(message_date, sleep_time) - timedelta(hours=3)
-        elif (re.search("ASH Daily Diary", title)):
-            return datetime.combine(message_date, sleep_time) - timedelta(hours=2)
-        
-    def get_intervention_time(self, events, subject, booster_dates, round2_dates):
-        (start_time, end_time) = self.make_intervention_startend(events[0].time,
-                                                                 subject, booster_dates, round2_dates)
-        if start_time > end_time:
-            end_time = end_time + timedelta(days=1)
-        times_list = random_times(start_time, end_time, len(events))
-        n = 0
-        Event = namedtuple('Event', ['time', 'title', 'content'])
-        newEvents = []
-        for t in times_list:
-            newEvents.append(Event(time=t, title=events[n].title, content=events[n].content))
-            n = n + 1
-        return newEvents
-
-    def get_date(self, inStr):
-        #gets the date portion of the string for the datetime of an apptoto event
-        return datetime.strptime(re.split('-\d+:\d+$', re.sub('T', ' ', inStr[2:]))[0], '%y-%m-%d %H:%M:%S').date()
-
-    def make_event_list_from_df(self, df):
-        edict = df.to_dict('records')
-        Event = namedtuple('Event', ['time', 'title', 'content'])
-        elist = []
-        for e in edict:
-            elist.append(Event(time=e['start_time'], title=e['title'], content=e['content']))
-        return elist
-
     # do we need to check primary phone/email?
     def update_contact(self, update_events=False):
 
@@ -1,6 +1,7 @@
 import secrets
 from flask import Flask
 from src.executor import executor
+from src.mylogging import configure_logging
 from .blueprints import bp
 from flask_sqlalchemy import SQLAlchemy
 from flask_security import Security, SQLAlchemyUserDatastore, hash_password
@@ -11,6 +12,7 @@ from dotenv import load_dotenv, dotenv_values
 def create_app(test_config=None):
     # create and configure the app
     app = Flask(__name__, instance_relative_config=True)
+    configure_logging()
 
     executor.init_app(app)
     #app.secret_key = secrets.token_urlsafe(64)
@@ -33,8 +35,9 @@ def create_app(test_config=None):
     app.config["REMEMBER_COOKIE_SAMESITE"] = "strict"
     app.config["SESSION_COOKIE_SAMESITE"] = "strict"
 
-    # in-memory database setup
-    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+    # user database, in memory unless USER_DB_URI is set (e.g. sqlite:////home/users.db)
+    # so that workers can share a user created once
+    app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv("USER_DB_URI", 'sqlite://')
     app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
         "pool_pre_ping": True,
     }
@@ -59,12 +62,27 @@ def create_app(test_config=None):
     # one time setup of user login info
     with app.app_context():
         db.create_all()
-        # creates user if it doesn't exist
+        # creates user if it doesn't exist. Hashing the password takes a noticeable part of
+        # a worker's startup, so use LOGIN_PASS_HASH (from `flask hash-password`) when it is set
         if not app.security.datastore.find_user(email=os.getenv("LOGIN_EMAIL")):
+            password = os.getenv("LOGIN_PASS_HASH") or hash_password(os.getenv("LOGIN_PASS"))
             app.security.datastore.create_user(email=os.getenv("LOGIN_EMAIL"),
-                                               password=hash_password(os.getenv("LOGIN_PASS")))
+                                               password=password)
         db.session.commit()
 
+    @app.cli.command('hash-password')
+    def print_password_hash():
+        """Print the hash of LOGIN_PASS, to set as LOGIN_PASS_HASH."""
+        print(hash_password(os.getenv("LOGIN_PASS")))
+
+    @app.cli.command('rebuild-dashboard')
+    def rebuild_dashboard():
+        """Rebuild the dashboard counts from the stored schedules and conversations."""
+        from src.dashboard import Dashboard
+        from src.store import Store
+
+        print(f'Rebuilt the dashboard for {Dashboard().rebuild(Store())} participants')
+
     app.config['EXECUTOR_TYPE'] = 'thread'
     app.config['EXECUTOR_PROPAGATE_EXCEPTIONS'] = True
     app.register_blueprint(bp)
@@ -0,0 +1,122 @@
+import re
+from typing import Iterable
+import numpy as np
+import pandas as pd
+
+from src.apptoto import parse_external_id
+from src.constants import APPTOTO_TZ
+from src.conversation import conversation_rows, sent_message_ids, reply_targets, join_ids, split_ids
+from src.conversation import REPLY_WINDOW, STORE_COLUMNS
+from src.store import Store
+
+PARTICIPANT_ID = re.compile(r'ASH\d{3}')  # form of participant ids, which name store partitions
+
+# columns of the inbound table: the conversation message, its event and when it was received
+INBOUND_COLUMNS = ['id', 'at', 'event_type', 'content', 'title', 'start_time', 'calendar_id', 'external_id',
+                   'event_id', 'received_at']
+
+
+def _participant_id(event: dict):
+    # the id names the participant's store partition, so only ids in the participant format are used
+    external_id = parse_external_id(event.get('external_id'))
+    if external_id:
+        return external_id.participant_id if PARTICIPANT_ID.fullmatch(external_id.participant_id) else None
+    for participant in event.get('participants') or []:
+        if participant.get('contact_external_id'):
+            contact_id = str(participant['contact_external_id'])
+            return contact_id if PARTICIPANT_ID.fullmatch(contact_id) else None
+    return None
+
+
+def record_notifications(events: Iterable[dict], store: Store = None) -> dict:
+    """
+    Keep the conversation messages of pushed notifications in the inbound table.
+
+    Notifications are events in the form apptoto returns with include_conversations=True,
+    holding only the new messages. Each message is kept with the participant event id it was
+    sent or replied on, so it can be attributed without fetching the event.
+
+    :param events: Events with conversation messages
+    :param store: Store (default = Store())
+    :return: dict of participant id to number of messages kept, including None for messages
+        of events that are not a participant's or have a participant id not in the form ASHnnn
+    """
+    store = store or Store()
+    received_at = pd.Timestamp.now(tz='UTC')
+
+    by_participant = {}
+    for event in events:
+        by_participant.setdefault(_participant_id(event), []).append(event)
+
+    counts = {}
+    for participant_id, participant_events in by_participant.items():
+        rows = pd.DataFrame.from_records(conversation_rows(participant_events))
+        counts[participant_id] = len(rows)
+        if participant_id is None or rows.empty:
+            continue
+        rows = rows.rename(columns={'participants.event_id': 'event_id'}).reindex(columns=INBOUND_COLUMNS)
+        rows['received_at'] = received_at
+        store.write('inbound', participant_id, rows.astype({'at': 'str', 'start_time': 'str'}))
+    return counts
+
+
+def apply_notifications(conversations: pd.DataFrame, inbound: pd.DataFrame, index, assignment: pd.DataFrame = None,
+                        window=REPLY_WINDOW) -> pd.DataFrame:
+    """
+    Add the messages of notifications received since the last crawl to stored conversations.
+
+    Messages whose ids are in the conversations were fetched already, and are skipped.
+    Other sent messages become new conversations. Replies are attributed as they are when
+    conversations are fetched, see conversation.reply_targets.
+
+    :param conversations: Stored conversations, with STORE_COLUMNS
+    :param inbound: Rows of the inbound table
+    :param index: Message bank index, or a function returning one, see conversation.sent_message_ids
+    :param assignment: Participant's message assignment
+    :param window: Longest time between a sent message and a reply to it
+    :return: Conversations with STORE_COLUMNS
+    """
+    conversations = conversations.reindex(columns=STORE_COLUMNS)
+    if inbound.empty:
+        return conversations
+
+    inbound = inbound.dropna(subset=['event_id']).drop_duplicates('id').astype({'event_id': 'int64'})
+    fetched = set(conversations.message_id.dropna().astype('int64')) | split_ids(conversations.reply_ids)
+    inbound = inbound[~inbound.id.isin(fetched)]
+    if inbound.empty:
+        return conversations
+    # times are kept in the account's time zone, as they are when conversations are fetched
+    tz = getattr(conversations.at_sent.dtype, 'tz', None) or APPTOTO_TZ
+    inbound['at'] = pd.to_datetime(inbound['at'], utc=True).dt.tz_convert(tz)
+
+    sent = inbound[inbound.event_type == 'sent']
+    known = pd.MultiIndex.from_frame(conversations[['event_id', 'at_sent']].astype({'at_sent': inbound['at'].dtype}))
+    sent = sent[~pd.MultiIndex.from_frame(sent[['event_id', 'at']]).isin(known)]
+    if not sent.empty:
+        new = pd.DataFrame({'event_id': sent.event_id, 'title_sent': sent.title, 'at_sent': sent['at'],
+                            'UO_ID': sent_message_ids(sent, index, assignment), 'content_sent': sent.content,
+                            'replies': 0, 'message_id': sent.id})
+        conversations = pd.concat([conversations, new.reindex(columns=STORE_COLUMNS)], ignore_index=True)
+    for column in ('at_sent', 'at_rec'):
+        conversations[column] = pd.to_datetime(conversations[column], utc=True).dt.tz_convert(tz)
+
+    replied = inbound[inbound.event_type == 'replied']
+    sent = conversations[['at_sent', 'event_id']].rename(columns={'at_sent': 'at'})
+    replied = replied.assign(_sent=reply_targets(sent, replied, window, event='event_id'))
+    replied = replied.dropna(subset=['_sent']).sort_values('at', kind='stable')
+    if replied.empty:
+        return conversations
+
+    first = replied.groupby(replied._sent.astype(int)).agg(at=('at', 'first'), content=('content', 'first'),
+                                                           replies=('at', 'size'), ids=('id', join_ids))
+    position = pd.Series(np.arange(len(conversations)), index=conversations.index)
+    at_new = position.map(first['at'])
+    earlier = at_new.notna() & (conversations.at_rec.isna() | (at_new < conversations.at_rec))
+
+    conversations['at_rec'] = at_new.where(earlier, conversations.at_rec)
+    conversations['content_rec'] = position.map(first.content).where(earlier, conversations.content_rec)
+    conversations['replies'] = (conversations.replies.fillna(0) + position.map(first.replies).fillna(0)).astype(int)
+    reply_ids = (conversations.reply_ids.fillna('').astype(str) + ' ' + position.map(first.ids).fillna('')).str.strip()
+    conversations['reply_ids'] = reply_ids.where(reply_ids != '')
+    conversations['reply_latency'] = conversations.at_rec - conversations.at_sent
+    return conversations
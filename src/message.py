@@ -1,4 +1,8 @@
+from functools import lru_cache
+from pathlib import Path
 from typing import List
+import unicodedata
+import numpy as np
 import pandas as pd
 
 from src.enums import Condition, CodedValues
@@ -16,10 +20,13 @@ class Messages:
     def __getitem__(self, key):
         return self._messages.loc[key].Message
 
+    def uo_id(self, key):
+        return self._messages.loc[key].UO_ID
+
     def __len__(self):
         return len(self._messages)
 
-    def filter_by_condition(self, condition: Condition, values: List[CodedValues], num_messages):
+    def filter_by_condition(self, condition: Condition, values: List[CodedValues], num_messages, random_state=None):
         if condition is Condition.VALUES and values:
             value_names = [v.name for v in values]
             indices = self._messages.Value1.isin(value_names)
@@ -28,7 +35,7 @@ class Messages:
 
         sample_size = min(len(self._messages[indices]), num_messages)
 
-        self._messages = self._messages[indices].sample(sample_size, ignore_index=True)
+        self._messages = self._messages[indices].sample(sample_size, ignore_index=True, random_state=random_state)
 
         if self._messages.empty:
             raise Exception('No messages generated.')
@@ -38,8 +45,80 @@ class Messages:
             diff = num_messages - len(self._messages)
             self._messages = pd.concat([self._messages, self._messages[:diff]], ignore_index=True)
 
+    def draw_sets(self, condition: Condition, values: List[CodedValues], num_sets, num_messages,
+                  random_state=None) -> List[pd.DataFrame]:
+        """
+        Draw several sets of messages at once, e.g. one for each task run.
+
+        The messages matching the condition are shuffled once and the sets take consecutive
+        messages from that order, going round it again only if it runs out. So no message is
+        repeated across sets while there are enough messages for all of them, and none is repeated
+        within a set while there are enough for one.
+
+        :param condition: Condition, as in filter_by_condition
+        :param values: Participant's values, for Condition.VALUES
+        :param num_sets: Number of sets
+        :param num_messages: Number of messages in each set
+        :param random_state: Seed or numpy Generator for the shuffle
+        :return: List of num_sets DataFrames of num_messages messages
+        """
+        if condition is Condition.VALUES and values:
+            indices = self._messages.Value1.isin([v.name for v in values])
+        else:
+            indices = self._messages.ConditionNo == condition.value
+
+        pool = self._messages[indices]
+        if pool.empty:
+            raise Exception('No messages generated.')
+
+        order = np.random.default_rng(random_state).permutation(len(pool))
+        drawn = order[np.arange(num_sets * num_messages) % len(pool)]
+        messages = pool.iloc[drawn].reset_index(drop=True)
+        return [messages[i:i + num_messages].reset_index(drop=True)
+                for i in range(0, len(messages), num_messages)]
+
     def write_to_file(self, filename, columns=None, header=True):
         self._messages.to_csv(filename, columns=columns, index=False, header=header)
 
     def add_column(self, column_name, column_data):
         self._messages[column_name] = column_data
+
+
+def normalize_message(text):
+    """
+    Normalize message text for matching sent messages to the message bank.
+
+    Unicode is NFKC normalized, runs of whitespace are collapsed,
+    the "UO: " prefix is removed and case is ignored.
+
+    :param text: Message text
+    :return: Normalized text, or None if text is not a string
+    """
+    if not isinstance(text, str):
+        return None
+    text = ' '.join(unicodedata.normalize('NFKC', text).split())
+    if text.startswith('UO:'):
+        text = text[3:].lstrip()
+    return text.casefold()
+
+
+@lru_cache(maxsize=4)
+def _message_index(path, modified):
+    messages = pd.read_csv(path, dtype=str)
+    index = {}
+    for uo_id, message in zip(messages.UO_ID, messages.Message):
+        index.setdefault(normalize_message(message), uo_id)
+    return index
+
+
+def message_index(path):
+    """
+    Get an index from normalized message text to UO_ID for a message bank file.
+
+    The index is built once per version of the file.
+
+    :param path: File containing messages
+    :return: dict of normalized message text to UO_ID
+    """
+    path = Path(path)
+    return _message_index(str(path), path.stat().st_mtime)
@@ -0,0 +1,229 @@
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+from src import mylogging
+
+# upper bounds in seconds, for single requests and for whole job phases
+REQUEST_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 240)
+PHASE_BUCKETS = (0.1, 0.5, 1, 5, 10, 30, 60, 120, 300, 600, 1200)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    def __init__(self, name, documentation, labels=()):
+        """
+        Create a Counter.
+
+        A Counter keeps a total for each combination of label values.
+
+        :param name: Metric name
+        :param documentation: Help text
+        :param labels: Label names
+        """
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def get(self, *label_values):
+        return self._values.get(label_values, 0)
+
+    def collect(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} counter']
+        with self._lock:
+            for label_values, value in sorted(self._values.items()):
+                lines.append(f'{self.name}{_format_labels(self.labels, label_values)} {_format_value(value)}')
+        return lines
+
+
+class Gauge:
+    def __init__(self, name, documentation, labels=()):
+        """
+        Create a Gauge.
+
+        A Gauge keeps a current value, which can go up and down, for each combination of label values.
+
+        :param name: Metric name
+        :param documentation: Help text
+        :param labels: Label names
+        """
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def set(self, value, *label_values):
+        with self._lock:
+            self._values[label_values] = value
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def dec(self, *label_values, amount=1):
+        self.inc(*label_values, amount=-amount)
+
+    def get(self, *label_values):
+        return self._values.get(label_values, 0)
+
+    def collect(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} gauge']
+        with self._lock:
+            for label_values, value in sorted(self._values.items()):
+                lines.append(f'{self.name}{_format_labels(self.labels, label_values)} {_format_value(value)}')
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, documentation, labels=(), buckets=REQUEST_BUCKETS):
+        """
+        Create a Histogram.
+
+        A Histogram counts observations (e.g. seconds) in cumulative buckets,
+        with their count and sum, for each combination of label values.
+
+        :param name: Metric name
+        :param documentation: Help text
+        :param labels: Label names
+        :param buckets: Upper bounds of the buckets, in increasing order
+        """
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets) + (float('inf'),)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def observe(self, value, *label_values):
+        with self._lock:
+            counts, total = self._values.get(label_values, ([0] * len(self.buckets), 0.0))
+            counts[bisect_left(self.buckets, value)] += 1
+            self._values[label_values] = (counts, total + value)
+
+    def count(self, *label_values):
+        return sum(self._values.get(label_values, ([], 0.0))[0])
+
+    def sum(self, *label_values):
+        return self._values.get(label_values, ([], 0.0))[1]
+
+    @contextmanager
+    def time(self, *label_values):
+        """Observe the seconds spent in the context."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *label_values)
+
+    def collect(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            for label_values, (counts, total) in sorted(self._values.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets, counts):
+                    cumulative += count
+                    labels = _format_labels(self.labels, label_values, [('le', _format_value(bound))])
+                    lines.append(f'{self.name}_bucket{labels} {cumulative}')
+                labels = _format_labels(self.labels, label_values)
+                lines.append(f'{self.name}_sum{labels} {_format_value(total)}')
+                lines.append(f'{self.name}_count{labels} {cumulative}')
+        return lines
+
+
+APPTOTO_REQUEST_SECONDS = Histogram('apptoto_request_seconds', 'Time to get a response from apptoto.',
+                                    ['method', 'endpoint'])
+APPTOTO_RESPONSES = Counter('apptoto_responses_total', 'Apptoto responses by status code, or "error" if none.',
+                            ['method', 'endpoint', 'status'])
+APPTOTO_RETRIES = Counter('apptoto_retries_total', 'Apptoto requests sent again after a failure.',
+                          ['method', 'endpoint'])
+APPTOTO_LIMITER_WAIT_SECONDS = Histogram('apptoto_limiter_wait_seconds',
+                                         'Time requests waited for the apptoto burst rate limit.', ['priority'])
+APPTOTO_LIMITER_QUEUE = Gauge('apptoto_limiter_queue', 'Requests waiting for the apptoto burst rate limit.',
+                              ['priority'])
+REDCAP_EXPORT_SECONDS = Histogram('redcap_export_seconds', 'Time to export records from REDCap.')
+REDCAP_EXPORT_ERRORS = Counter('redcap_export_errors_total', 'REDCap exports that failed.')
+CIRCUIT_STATE = Gauge('circuit_state', 'State of the circuit of each backend: 0 closed, 1 half open, 2 open.',
+                      ['backend'])
+CIRCUIT_OPENED = Counter('circuit_opened_total', 'Times the circuit of each backend opened.', ['backend'])
+SINGLEFLIGHT_CALLS = Counter('singleflight_calls_total',
+                             'Calls made, or shared with an identical call in flight.', ['call', 'outcome'])
+JOB_PHASE_SECONDS = Histogram('job_phase_seconds', 'Time spent in each phase of a job.',
+                              ['job', 'phase'], buckets=PHASE_BUCKETS)
+
+REGISTRY = [APPTOTO_REQUEST_SECONDS, APPTOTO_RESPONSES, APPTOTO_RETRIES, APPTOTO_LIMITER_WAIT_SECONDS,
+            APPTOTO_LIMITER_QUEUE, REDCAP_EXPORT_SECONDS, REDCAP_EXPORT_ERRORS, CIRCUIT_STATE, CIRCUIT_OPENED,
+            SINGLEFLIGHT_CALLS, JOB_PHASE_SECONDS]
+
+
+class JobTimer:
+    def __init__(self, job):
+        """
+        Create a JobTimer.
+
+        A JobTimer records the time spent in consecutive phases of a job in JOB_PHASE_SECONDS,
+        and sets the phase of log records made during each phase.
+        Starting a phase ends the one before it, and leaving the context ends the last one,
+        also when the job returns early or raises:
+            with JobTimer('generate_messages') as timer:
+                timer.phase('redcap')
+                ...
+                timer.phase('post')
+                ...
+
+        :param job: Job name, usually the EventGenerator method
+        """
+        self.job = job
+        self._phase = None
+        self._start = None
+
+    def phase(self, name):
+        self.done()
+        self._phase = name
+        self._token = mylogging.phase.set(name)
+        self._start = time.perf_counter()
+
+    def done(self):
+        if self._phase is not None:
+            JOB_PHASE_SECONDS.observe(time.perf_counter() - self._start, self.job, self._phase)
+            mylogging.phase.reset(self._token)
+            self._phase = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.done()
+
+
+def render():
+    """
+    :return: All metrics in the Prometheus text exposition format
+    """
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.collect())
+    return '\n'.join(lines) + '\n'
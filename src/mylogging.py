@@ -1,10 +1,21 @@
+import atexit
+import contextvars
+import json
+import logging
+import logging.config
+import logging.handlers
+import queue
+import threading
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
 DEFAULT_LOGGING = {
     'version': 1,
     'disable_existing_loggers': True,
     'loggers': {
         '': {
             'level': 'INFO',
-            'handlers': ['rotating_file'],
+            'handlers': ['rotating_file', 'json_file'],
         },
         'console': {
             'level': 'INFO',
@@ -24,6 +35,7 @@ DEFAULT_LOGGING = {
             'class': 'logging.StreamHandler',
             'stream': 'ext://sys.stdout',
         },
+        # free text lines shown on the progress page
         'rotating_file': {
             'class': 'logging.handlers.RotatingFileHandler',
             'formatter': 'timestamped',
@@ -32,10 +44,110 @@ DEFAULT_LOGGING = {
             'maxBytes': 100000,
             'backupCount': 1
         },
+        # one JSON object per line, with the participant, job and phase of each record
+        'json_file': {
+            'class': 'logging.handlers.RotatingFileHandler',
+            'formatter': 'json',
+            'filename': '/home/LogFiles/message_app.jsonl',
+            'mode': 'a',
+            'maxBytes': 10000000,
+            'backupCount': 1
+        },
     },
     'formatters': {
         'timestamped': {
             'format': '%(asctime)s  %(message)s'
         },
+        'json': {
+            '()': 'src.mylogging.JsonFormatter'
+        },
     },
 }
+
+participant_id = contextvars.ContextVar('participant_id', default=None)
+job = contextvars.ContextVar('job', default=None)
+job_id = contextvars.ContextVar('job_id', default=None)
+phase = contextvars.ContextVar('phase', default=None)
+CONTEXT = {'participant_id': participant_id, 'job': job, 'job_id': job_id, 'phase': phase}
+
+_lock = threading.Lock()
+_listeners = []
+
+
+@contextmanager
+def log_context(**values):
+    """
+    Add context to the log records made in the context, e.g.
+    `with log_context(participant_id='ASH001', job='generate_messages', job_id='1a2b3c4d'):`
+
+    :param values: Values of participant_id, job, job_id or phase
+    """
+    tokens = [(CONTEXT[name], CONTEXT[name].set(value)) for name, value in values.items()]
+    try:
+        yield
+    finally:
+        for var, token in reversed(tokens):
+            var.reset(token)
+
+
+class ContextFilter(logging.Filter):
+    """Stamp records with the logging context of the thread that made them."""
+
+    def filter(self, record):
+        for name, var in CONTEXT.items():
+            setattr(record, name, var.get())
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        data = {'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+                'level': record.levelname,
+                'logger': record.name,
+                'message': record.getMessage()}
+        for name in CONTEXT:
+            data[name] = getattr(record, name, None)
+        if record.exc_info:
+            data['exception'] = self.formatException(record.exc_info)
+        return json.dumps(data, default=str)
+
+
+def configure_logging(config=DEFAULT_LOGGING):
+    """
+    Configure logging, once per process. create_app calls this, modules only get their loggers.
+
+    The handlers in `config` are run by background QueueListener threads, so writing
+    log files never blocks the job that logs. Each configured logger only puts records
+    on a queue, stamped with the participant, job and phase of the logging thread.
+
+    :param config: logging.config.dictConfig configuration
+    """
+    with _lock:
+        if _listeners:
+            return
+        logging.config.dictConfig(config)
+        # modules import before logging is configured, so keep their loggers enabled
+        for name, logger in logging.root.manager.loggerDict.items():
+            if name.startswith('src.') and isinstance(logger, logging.Logger):
+                logger.disabled = False
+
+        for name in config['loggers']:
+            logger = logging.getLogger(name or None)
+            if not logger.handlers:
+                continue
+            records = queue.SimpleQueue()
+            listener = logging.handlers.QueueListener(records, *logger.handlers, respect_handler_level=True)
+            handler = logging.handlers.QueueHandler(records)
+            handler.addFilter(ContextFilter())
+            logger.handlers = [handler]
+            listener.start()
+            _listeners.append(listener)
+
+    atexit.register(stop_logging)
+
+
+def stop_logging():
+    """Write any queued records and stop the listener threads."""
+    with _lock:
+        while _listeners:
+            _listeners.pop().stop()
@@ -1,15 +1,67 @@
-# this is pycap, not the redcap class originally written for this project
-import redcap
+from src.breaker import CircuitBreaker
+from src.metrics import REDCAP_EXPORT_SECONDS, REDCAP_EXPORT_ERRORS
+from src.singleflight import SingleFlight
+
+REDCAP_URL = 'https://redcap.uoregon.edu/api/'
+REDCAP_EVENTS = dict(session_0_arm_1='s0',
+                     session_1_arm_1='s1')
+REDCAP_TIMEOUT = (5, 120)  # seconds to connect and to wait for the export
+REDCAP_PROBE_TIMEOUT = (5, 10)
+
+# after 3 exports in a row get no response, exports fail fast (or wait, see breaker.parked)
+# until REDCap answers a version request
+breaker = CircuitBreaker('redcap', failures=3)
+
+# jobs starting together share one export, which nobody changes
+_exports = SingleFlight('redcap_export', copy_result=None)
+
+
+def export_records(redcap_token):
+    """
+    Export session 0 and session 1 records of all participants from REDCap.
+    Concurrent exports with the same token share one request.
+
+    :param redcap_token: REDCap API token
+    :return: DataFrame indexed by participant id and REDCap event name, not to be changed
+    """
+    return _exports.do(redcap_token, breaker.call, _export_records, redcap_token,
+                       probe=lambda: _export_version(redcap_token), is_failure=_redcap_down)
+
+
+def _redcap_down(err):
+    import requests
+
+    # pycap raises RequestException for bad requests too, those mean REDCap answered
+    return isinstance(err, (requests.ConnectionError, requests.Timeout))
+
+
+def _export_version(redcap_token):
+    import redcap
+
+    project = redcap.Project(url=REDCAP_URL, token=redcap_token, verify_ssl=False, timeout=REDCAP_PROBE_TIMEOUT)
+    return bool(project.export_version())
+
+
+def _export_records(redcap_token):
+    # this is pycap, not the redcap class originally written for this project.
+    # It is imported here so that it, and pandas, load with the first export rather than at startup
+    import redcap
+
+    with REDCAP_EXPORT_SECONDS.time():
+        try:
+            project = redcap.Project(url=REDCAP_URL,
+                                     token=redcap_token, verify_ssl=False, timeout=REDCAP_TIMEOUT)
+            return project.export_records(events=list(REDCAP_EVENTS),
+                                          format_type='df')
+        except Exception:
+            REDCAP_EXPORT_ERRORS.inc()
+            raise
+
 
 class RedcapParticipant:
     def __init__(self, subject_id, redcap_token):
-        project = redcap.Project(url='https://redcap.uoregon.edu/api/',
-                                 token=redcap_token, verify_ssl=False)
-        data = project.export_records(events=['session_0_arm_1',
-                                              'session_1_arm_1'],
-                                      format_type='df')
-
-        self.redcap = data.loc[subject_id].rename(index=dict(session_0_arm_1='s0',
-                                                             session_1_arm_1='s1')).transpose()
+        data = export_records(redcap_token)
+
+        self.redcap = data.loc[subject_id].rename(index=REDCAP_EVENTS).transpose()
 
         self.id = subject_id
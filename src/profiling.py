@@ -0,0 +1,69 @@
+import cProfile
+import functools
+import io
+import logging
+import pstats
+import time
+import tracemalloc
+from pathlib import Path
+
+from src.constants import DOWNLOAD_DIR
+
+logger = logging.getLogger(__name__)
+
+TOP_FUNCTIONS = 60  # number of functions listed in the profile report
+
+
+def profiled(fn, participant_id=None, job=None, csv_path=DOWNLOAD_DIR):
+    """
+    Wrap a job so that running it also profiles it.
+
+    The job is run under cProfile with tracemalloc tracing memory. When it finishes,
+    <participant>_<job>_profile.txt (wall time, peak traced memory and the functions
+    with the most cumulative time) and <participant>_<job>.prof (the cProfile data, for
+    pstats or snakeviz) are written to `csv_path`, so they are downloaded with the participant's files.
+    Only the job's own thread is profiled, time spent waiting on other threads shows up where it waits.
+
+    :param fn: Job, e.g. eg.generate_messages
+    :param participant_id: Participant id used in the file names (default = 'cohort')
+    :param job: Job name used in the file names (default = name of fn)
+    :param csv_path: Directory for the profile files
+    :return: Function taking the same arguments as fn
+    """
+    job = job or fn.__name__
+    prefix = f'{participant_id or "cohort"}_{job}'
+
+    @functools.wraps(fn)
+    def run(*args, **kwargs):
+        started_tracing = not tracemalloc.is_tracing()
+        if started_tracing:
+            tracemalloc.start()
+        else:
+            # another job is being profiled, so the peak includes its memory too
+            tracemalloc.reset_peak()
+
+        profile = cProfile.Profile()
+        start = time.perf_counter()
+        try:
+            return profile.runcall(fn, *args, **kwargs)
+        finally:
+            wall = time.perf_counter() - start
+            _, peak = tracemalloc.get_traced_memory()
+            if started_tracing:
+                tracemalloc.stop()
+            _write_profile(profile, Path(csv_path), prefix, wall, peak, shared=not started_tracing)
+
+    return run
+
+
+def _write_profile(profile, csv_path, prefix, wall, peak, shared):
+    csv_path.mkdir(parents=True, exist_ok=True)
+    profile.dump_stats(csv_path / f'{prefix}.prof')
+
+    report = io.StringIO()
+    report.write(f'Wall time: {wall:.1f} s\n')
+    report.write(f'Peak traced memory: {peak / 2 ** 20:.1f} MB')
+    report.write(' (shared with another profiled job)\n\n' if shared else '\n\n')
+    pstats.Stats(profile, stream=report).sort_stats('cumulative').print_stats(TOP_FUNCTIONS)
+    (csv_path / f'{prefix}_profile.txt').write_text(report.getvalue())
+    logger.info(f'Profile written to {prefix}_profile.txt')
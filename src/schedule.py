@@ -0,0 +1,152 @@
+from collections import namedtuple
+from datetime import date, time, timedelta
+
+import numpy as np
+import pandas as pd
+
+from src.constants import SMS_TITLE, CIGS_TITLE
+from src.enums import EventType
+
+Rule = namedtuple('Rule', ['anchor', 'offset', 'quit_day'], defaults=[None])
+
+# When each type of message is sent: an offset from the participant's wake or sleep time on its day.
+# Messages with a quit_day are sent that many days from the quit date, whichever day they were on before.
+RULES = {
+    EventType.DAY_BEFORE: Rule('wake', timedelta(hours=3), quit_day=-1),
+    EventType.QUIT_DATE: Rule('wake', timedelta(hours=3), quit_day=0),
+    EventType.CIGS: Rule('sleep', timedelta(hours=-1)),
+    EventType.BOOSTER: Rule('sleep', timedelta(hours=-3)),
+    EventType.DIARY: Rule('sleep', timedelta(hours=-2)),
+}
+# Intervention messages are sent at random times from wake time until 2 hours before sleep time,
+# starting an hour after the day's wake time messages and ending an hour before its sleep time messages
+INTERVENTION_WINDOW = (Rule('wake', timedelta(0)), Rule('sleep', timedelta(hours=-2)))
+INTERVENTION_GAP = timedelta(hours=1)
+
+# events posted before every event had a type in its external id are recognized by title
+TITLES = {EventType.DAY_BEFORE: 'UO: Day Before',
+          EventType.QUIT_DATE: 'UO: Quit Date',
+          EventType.CIGS: CIGS_TITLE,
+          EventType.BOOSTER: 'Booster',
+          EventType.DIARY: 'Daily Diary',
+          EventType.SMS: SMS_TITLE}
+EXTERNAL_ID_TYPE = r'^[^:]*:([a-z_]+):\d+(?::[^:]*)?$'
+
+
+def event_types(external_ids, titles: pd.Series) -> pd.Series:
+    """
+    Get the type of each event from its external id (see apptoto.make_external_id),
+    or from its title if the external id has no type.
+
+    :param external_ids: Event external ids, or None
+    :param titles: Event titles
+    :return: Series of EventType values, None for events of other types
+    """
+    titles = titles.fillna('').astype(str)
+    by_title = pd.Series(np.select([titles.str.contains(t, regex=False) for t in TITLES.values()],
+                                   [t.value for t in TITLES], default=None),
+                         index=titles.index, dtype=object)
+    if external_ids is None:
+        return by_title
+
+    types = pd.Series(external_ids, index=titles.index).astype('string').str.extract(EXTERNAL_ID_TYPE, expand=False)
+    types = types.astype(object).where(types.isin([t.value for t in EventType]), None)
+    return types.fillna(by_title)
+
+
+def _timedelta(t: time):
+    return pd.Timedelta(hours=t.hour, minutes=t.minute) if t else pd.NaT
+
+
+class Schedule:
+    def __init__(self, wake_time: time = None, sleep_time: time = None, quit_date: date = None, rules=RULES):
+        """
+        Create a Schedule.
+
+        A Schedule applies the timing rules to one participant's wake time, sleep time and quit date,
+        both to generate messages and to move them when those change.
+        The rules are compiled into arrays indexed by event type, so the times of any number of
+        events are found in one vectorized call.
+
+        :param wake_time: Participant's wake time
+        :param sleep_time: Participant's sleep time
+        :param quit_date: Participant's quit date, needed for messages with a quit_day
+        :param rules: Rule of each event type
+        """
+        self.wake = _timedelta(wake_time)
+        self.sleep = _timedelta(sleep_time)
+        self.quit_date = pd.Timestamp(quit_date) if quit_date else pd.NaT
+        anchors = {'wake': self.wake, 'sleep': self.sleep}
+
+        self._types = pd.CategoricalDtype([t.value for t in rules])
+        # one entry for each type, and a last one for other types (category code -1)
+        self._sleep_anchored = np.array([r.anchor == 'sleep' for r in rules.values()] + [False])
+        self._wake_anchored = np.array([r.anchor == 'wake' for r in rules.values()] + [False])
+        self._offset = pd.to_timedelta([r.offset for r in rules.values()] + [pd.NaT]).to_numpy()
+        self._time = pd.to_timedelta([anchors[r.anchor] + r.offset for r in rules.values()] + [pd.NaT]).to_numpy()
+        self._quit_day = pd.to_timedelta([pd.NaT if r.quit_day is None else timedelta(days=r.quit_day)
+                                          for r in rules.values()] + [pd.NaT]).to_numpy()
+        self._window = [anchors[r.anchor] + r.offset for r in INTERVENTION_WINDOW]
+
+    def _codes(self, event_types: pd.Series):
+        # types without a rule, e.g. intervention messages, are missing (category code -1)
+        event_types = pd.Series(event_types, dtype=object)
+        return pd.Categorical(event_types.where(event_types.isin(self._types.categories)), dtype=self._types).codes
+
+    def times(self, event_types: pd.Series, days: pd.Series) -> pd.Series:
+        """
+        Get the time each event is sent.
+
+        :param event_types: EventType values
+        :param days: Day of each event, ignored for types with a quit_day
+        :return: Series of local times, NaT for intervention messages and events of other types
+        """
+        codes = self._codes(event_types)
+        days = pd.Series(pd.to_datetime(np.asarray(days)), index=event_types.index).dt.normalize()
+        quit_days = pd.Series(self.quit_date + self._quit_day[codes], index=event_types.index)
+        return quit_days.fillna(days) + self._time[codes]
+
+    def scheduled_days(self, event_types: pd.Series, times: pd.Series) -> pd.Series:
+        """
+        Get the day each event was scheduled for, from its current time.
+
+        Messages with a rule were sent at its offset from the wake or sleep time of their day.
+        Intervention messages belong to the day ending at the next sleep time, which is taken from
+        the latest sleep time message (this schedule's sleep time if there is none).
+
+        :param event_types: EventType values
+        :param times: Current local times of the events
+        :return: Series of days, NaT for events of other types
+        """
+        codes = self._codes(event_types)
+        anchors = times - self._offset[codes]
+        days = anchors.dt.normalize()
+
+        sleep_anchors = anchors[self._sleep_anchored[codes]]
+        if sleep_anchors.empty:
+            sleep = self.sleep
+        else:
+            latest = sleep_anchors.max()
+            sleep = latest - latest.normalize()
+
+        intervention = (event_types == EventType.SMS.value).to_numpy()
+        days[intervention] = (times[intervention] - sleep).dt.ceil('D')
+        return days
+
+    def intervention_windows(self, days, events: pd.DataFrame) -> pd.DataFrame:
+        """
+        Get the times between which intervention messages are sent on each day.
+
+        :param days: Days with intervention messages
+        :param events: Other messages, with event_type, day and time columns
+        :return: DataFrame of start and end times, in the order of days
+        """
+        days = pd.Series(pd.to_datetime(np.asarray(days))).dt.normalize()
+        codes = self._codes(events.event_type)
+        wake, sleep = self._wake_anchored[codes], self._sleep_anchored[codes]
+        after = events.time[wake].groupby(events.day[wake].dt.normalize()).max() + INTERVENTION_GAP
+        before = events.time[sleep].groupby(events.day[sleep].dt.normalize()).min() - INTERVENTION_GAP
+
+        start = pd.concat([days + self._window[0], after.reindex(days).reset_index(drop=True)], axis=1).max(axis=1)
+        end = pd.concat([days + self._window[1], before.reindex(days).reset_index(drop=True)], axis=1).min(axis=1)
+        return pd.DataFrame({'start': start, 'end': end})
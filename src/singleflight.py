@@ -0,0 +1,88 @@
+import copy
+import threading
+
+from src.metrics import SINGLEFLIGHT_CALLS
+
+
+class _Call:
+    __slots__ = ('done', 'result', 'error', 'followers')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.followers = 0
+
+
+class SingleFlight:
+    def __init__(self, name, copy_result=copy.deepcopy):
+        """
+        Create a SingleFlight.
+
+        A SingleFlight runs one call at a time for each key. Callers asking for a key while
+        its call is in flight wait for that call and share its result (or its exception),
+        instead of making the same request again. Nothing is kept once the call returns,
+        so a call that starts later always makes its own request.
+
+        :param name: Name of the calls, the call label of SINGLEFLIGHT_CALLS
+        :param copy_result: Function copying a shared result, so callers can change
+            their own copy (None to share the result itself, for results nobody changes)
+        """
+        self.name = name
+        self.copy_result = copy_result
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, fn, *args, **kwargs):
+        """
+        Call fn(*args, **kwargs), or wait for the call in flight for `key`.
+
+        :param key: Hashable key of identical calls
+        :param fn: Function to call
+        :return: Result of the call
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+            else:
+                call.followers += 1
+
+        if not leader:
+            SINGLEFLIGHT_CALLS.inc(self.name, 'shared')
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return self._copy(call.result)
+
+        SINGLEFLIGHT_CALLS.inc(self.name, 'made')
+        try:
+            call.result = fn(*args, **kwargs)
+        except BaseException as err:
+            call.error = err
+            raise
+        finally:
+            with self._lock:
+                if self._calls.get(key) is call:
+                    del self._calls[key]
+            call.done.set()
+
+        # once the call is removed no one else can join, so the result is copied only if it was shared
+        return self._copy(call.result) if call.followers else call.result
+
+    def forget(self, key=None):
+        """
+        Make callers that come after this start a new call, e.g. after a write that makes the
+        result of a call in flight out of date. Callers already waiting still share it.
+
+        :param key: Key to forget (default = all keys)
+        """
+        with self._lock:
+            if key is None:
+                self._calls.clear()
+            else:
+                self._calls.pop(key, None)
+
+    def _copy(self, result):
+        return self.copy_result(result) if self.copy_result else result
@@ -0,0 +1,110 @@
+import os
+import time
+from pathlib import Path
+import pandas as pd
+
+from src.constants import STORE_DIR
+
+TABLES = ('schedules', 'posted_events', 'conversations', 'assignments', 'inbound')
+
+
+class Store:
+    def __init__(self, root=STORE_DIR):
+        """
+        Create a Store.
+
+        A Store keeps typed tables (schedules, posted events, conversations, message assignments)
+        as Parquet files, partitioned by participant: <root>/<table>/participant_id=<id>/<name>.parquet
+
+        :param root: Directory containing the tables
+        """
+        self.root = Path(root)
+
+    def _partition(self, table, participant_id):
+        if table not in TABLES:
+            raise ValueError(f'Unknown table {table}')
+        if Path(str(participant_id)).name != str(participant_id) or str(participant_id).startswith('.'):
+            raise ValueError(f'Invalid participant id {participant_id!r}')
+        return self.root / table / f'participant_id={participant_id}'
+
+    def write(self, table, participant_id, df: pd.DataFrame, name=None):
+        """
+        Write rows for one participant.
+
+        :param table: Table name
+        :param participant_id: Participant id
+        :param df: Rows to write
+        :param name: Name of the file to replace, e.g. the job that made the rows.
+            If not given, the rows are appended in a new file.
+        """
+        partition = self._partition(table, participant_id)
+        partition.mkdir(parents=True, exist_ok=True)
+
+        name = name or str(time.time_ns())
+        path = partition / f'{name}.parquet'
+        tmp = partition / f'.{name}.tmp'
+        df.drop(columns='participant_id', errors='ignore').to_parquet(tmp, index=False)
+        # replace in one step so readers never see a partly written file
+        os.replace(tmp, path)
+
+    def remove(self, table, participant_id, name):
+        """
+        Remove one file of rows written for a participant, if it exists.
+
+        :param table: Table name
+        :param participant_id: Participant id
+        :param name: Name the rows were written with
+        """
+        path = self._partition(table, participant_id) / f'{name}.parquet'
+        path.unlink(missing_ok=True)
+
+    def drop_rows(self, table, participant_id, column, values):
+        """
+        Remove rows for one participant whose `column` is in `values`.
+
+        :param table: Table name
+        :param participant_id: Participant id
+        :param column: Column to match
+        :param values: Values of rows to remove
+        """
+        values = set(values)
+        for f in self._partition(table, participant_id).glob('*.parquet'):
+            df = pd.read_parquet(f)
+            if column not in df.columns:
+                continue
+            keep = ~df[column].isin(values)
+            if not keep.any():
+                f.unlink()
+            elif not keep.all():
+                self.write(table, participant_id, df[keep], name=f.stem)
+
+    def participants(self, table):
+        """
+        :param table: Table name
+        :return: Ids of participants with rows in the table
+        """
+        table_path = self.root / table
+        if not table_path.exists():
+            return []
+        return sorted(p.name.split('=', 1)[1] for p in table_path.glob('participant_id=*') if p.is_dir())
+
+    def read(self, table, participant_id=None) -> pd.DataFrame:
+        """
+        Read a table.
+
+        :param table: Table name
+        :param participant_id: Only read rows for this participant (default = all participants)
+        :return: DataFrame with a participant_id column, empty if there are no rows
+        """
+        ids = [participant_id] if participant_id else self.participants(table)
+
+        frames = []
+        for pid in ids:
+            for f in sorted(self._partition(table, pid).glob('*.parquet')):
+                df = pd.read_parquet(f)
+                df.insert(0, 'participant_id', pid)
+                frames.append(df)
+
+        if not frames:
+            return pd.DataFrame(columns=['participant_id'])
+        return pd.concat(frames, ignore_index=True)
@@ -0,0 +1,87 @@
+import threading
+from datetime import datetime, timedelta, timezone
+import pandas as pd
+
+from src.store import Store
+
+COLUMNS = ['start_time', 'participant_id', 'event_type', 'title', 'content', 'event_id', 'UO_ID']
+
+
+def _utc(t) -> pd.Timestamp:
+    t = pd.Timestamp(t)
+    return t.tz_localize('UTC') if t.tzinfo is None else t.tz_convert('UTC')
+
+
+class ScheduleIndex:
+    # shared by request threads, so the cohort schedule is only loaded once per change
+    _lock = threading.Lock()
+    _cache = {}
+
+    def __init__(self, store: Store = None):
+        """
+        Create a ScheduleIndex.
+
+        A ScheduleIndex answers time range questions about the schedules recorded in the store
+        for the whole cohort, without asking apptoto.
+        The schedules are kept in memory sorted by start time, and reloaded when the store changes.
+
+        :param store: Store with a schedules table
+        """
+        self.store = store or Store()
+
+    def _version(self):
+        table = self.store.root / 'schedules'
+        return tuple(sorted((str(f), f.stat().st_mtime_ns) for f in table.glob('*/*.parquet')))
+
+    def _schedule(self) -> pd.DataFrame:
+        version = self._version()
+        with self._lock:
+            cached = self._cache.get(self.store.root)
+            if cached and cached[0] == version:
+                return cached[1]
+
+            schedule = self.store.read('schedules')
+            if schedule.empty:
+                schedule = pd.DataFrame({c: pd.Series(dtype=object) for c in COLUMNS})
+                schedule['start_time'] = pd.Series(dtype='datetime64[ns, UTC]')
+            schedule = schedule.sort_values('start_time', kind='stable').reset_index(drop=True)
+            self._cache[self.store.root] = (version, schedule)
+            return schedule
+
+    def sends(self, begin: datetime = None, end: datetime = None, participant_id=None, event_type=None):
+        """
+        Get the scheduled sends in a time range.
+
+        :param begin: Earliest start time (default = now)
+        :param end: Latest start time, exclusive (default = no limit)
+        :param participant_id: Only sends to this participant
+        :param event_type: Only sends of this type, an EventType value, e.g. 'sms' or 'diary'
+        :return: DataFrame of sends ordered by start time
+        """
+        schedule = self._schedule()
+        first = schedule.start_time.searchsorted(_utc(begin or datetime.now(timezone.utc)))
+        last = schedule.start_time.searchsorted(_utc(end)) if end is not None else len(schedule)
+
+        sends = schedule.iloc[first:last]
+        if participant_id:
+            sends = sends[sends.participant_id == participant_id]
+        if event_type:
+            sends = sends[sends.event_type == event_type]
+        return sends[[c for c in COLUMNS if c in sends.columns]]
+
+    def next_hours(self, hours, **kwargs):
+        """
+        Get the sends in the next `hours` hours, see sends.
+        """
+        now = datetime.now(timezone.utc)
+        return self.sends(now, now + timedelta(hours=hours), **kwargs)
+
+    def without_future_sends(self, now: datetime = None):
+        """
+        Get the participants with a recorded schedule but nothing left to send.
+
+        :param now: Time to look for sends after (default = now)
+        :return: List of participant ids
+        """
+        future = self.sends(now)
+        return sorted(set(self.store.participants('schedules')) - set(future.participant_id))
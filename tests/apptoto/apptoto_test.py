@@ -0,0 +1,144 @@
+import threading
+import time
+from datetime import datetime, timezone
+
+from src.apptoto import ApptotoEvent, ApptotoParticipant, RateLimiter
+from src.constants import ASH_CALENDAR_ID
+from src.enums import Priority
+from tests.apptoto_emulator import ApptotoEmulator, VirtualClock
+
+
+class GatedClock(VirtualClock):
+    """A VirtualClock whose sleeps wait for the gate to open, so requests can be queued first."""
+
+    def __init__(self):
+        super().__init__()
+        self.gate = threading.Event()
+
+    def sleep_until(self, t):
+        self.gate.wait()
+        super().sleep_until(t)
+
+
+def queue(limiter, clock, slots, name, level, arrival=0.0):
+    """Start a request of priority `level` arriving at `arrival`, and wait until it is queued."""
+    def request():
+        VirtualClock.sleep_until(clock, arrival)
+        limiter.wait(level)
+        slots.append((clock.monotonic(), name))
+
+    queued = sum(limiter.queue_depth().values())
+    thread = threading.Thread(target=request)
+    thread.start()
+    while sum(limiter.queue_depth().values()) == queued:
+        time.sleep(0.001)
+    return thread
+
+
+def run(limiter, clock, requests):
+    slots = []
+    # the first request takes the slot at once, the others queue behind it
+    limiter.wait(Priority.UPLOAD)
+    threads = [queue(limiter, clock, slots, *request) for request in requests]
+    clock.gate.set()
+    for thread in threads:
+        thread.join(timeout=5)
+    return [name for _, name in sorted(slots)]
+
+
+def test_delete_takes_next_slot():
+    clock = GatedClock()
+    limiter = RateLimiter(1.0, clock=clock)
+
+    order = run(limiter, clock, [('upload1', Priority.UPLOAD), ('upload2', Priority.UPLOAD),
+                                 ('upload3', Priority.UPLOAD), ('delete', Priority.DELETE)])
+
+    assert order == ['delete', 'upload1', 'upload2', 'upload3']
+    assert sum(limiter.queue_depth().values()) == 0
+
+
+def test_crawl_served_once_aged():
+    clock = GatedClock()
+    limiter = RateLimiter(10.0, clock=clock)
+
+    # the crawl waits behind uploads that arrived up to AGING seconds after it, and no later
+    order = run(limiter, clock, [('crawl', Priority.CRAWL, 0), ('upload0', Priority.UPLOAD, 0),
+                                 ('upload10', Priority.UPLOAD, 10), ('upload20', Priority.UPLOAD, 20),
+                                 ('upload40', Priority.UPLOAD, 40)])
+
+    assert order == ['upload0', 'upload10', 'upload20', 'crawl', 'upload40']
+    assert sum(limiter.queue_depth().values()) == 0
+
+
+def test_requests_spaced_by_interval():
+    clock = GatedClock()
+    limiter = RateLimiter(0.6, clock=clock)
+    slots = []
+
+    limiter.wait(Priority.UPLOAD)
+    threads = [queue(limiter, clock, slots, f'upload{i}', Priority.UPLOAD) for i in range(5)]
+    clock.gate.set()
+    for thread in threads:
+        thread.join(timeout=5)
+
+    times = sorted(t for t, _ in slots)
+    assert [round(b - a, 6) for a, b in zip([0.0] + times, times)] == [0.6] * 5
+    assert limiter.queue_depth() == {}
+
+
+def post(apptoto, participants, *days):
+    """Post an event at 9:00 on each day of April 2021 for `participants`, and return their ids."""
+    events = [ApptotoEvent('ASH Messages', 'ASH', datetime(2021, 4, day, 9), f'Day {day}', participants)
+              for day in days]
+    return [e['id'] for e in apptoto.post_events(events)]
+
+
+def test_events_by_contact_deduplicated_within_window():
+    emulator = ApptotoEmulator()
+    contact = emulator.add_contact('ASH001', 'P01', '541-000-0001')
+    contact['phone_numbers'].append({'number': '541-000-0002', 'normalized': '+15410000002'})
+    apptoto = emulator.client()
+    first = [ApptotoParticipant('P01', '541-000-0001')]
+    second = [ApptotoParticipant('P01', '541-000-0002')]
+    both = first + second
+    ids = post(apptoto, first, 1, 2) + post(apptoto, both, 3) + post(apptoto, second, 4, 20)
+
+    events = apptoto.get_events_by_contact(datetime(2021, 4, 1, tzinfo=timezone.utc), 'ASH001',
+                                           calendar_id=ASH_CALENDAR_ID, end=datetime(2021, 4, 10, tzinfo=timezone.utc))
+
+    # the event with both numbers is found by both queries, but returned once; day 20 is after the window
+    assert sorted(e['id'] for e in events) == ids[:4]
+    assert emulator.requests[('GET', '/events')] == 2
+
+
+def test_short_page_stops_prefetch():
+    emulator = ApptotoEmulator()
+    apptoto = emulator.client()
+    apptoto.MAX_EVENTS = 5
+    participants = [ApptotoParticipant('P01', '541-000-0001')]
+    ids = post(apptoto, participants, *range(1, 5))
+
+    # the first page is short, so no more pages are requested
+    assert [e['id'] for e in apptoto.get_events(phone_number='541-000-0001')] == ids
+    assert emulator.requests[('GET', '/events')] == 1
+
+    ids += post(apptoto, participants, *range(5, 13))
+    emulator.requests.clear()
+
+    # pages of 5, 5 and 2 events: the short third page ends the listing
+    assert [e['id'] for e in apptoto.get_events(phone_number='541-000-0001')] == ids
+    assert emulator.requests[('GET', '/events')] <= 1 + apptoto.PREFETCH
+
+
+def test_iterator_stops_listing_when_closed():
+    emulator = ApptotoEmulator()
+    apptoto = emulator.client()
+    apptoto.MAX_EVENTS = 5
+    ids = post(apptoto, [ApptotoParticipant('P01', '541-000-0001')], *range(1, 31))
+
+    events = apptoto.iter_events(phone_number='541-000-0001')
+    assert next(events)['id'] == ids[0]
+    events.close()
+
+    # six full pages, but only the first and those prefetched with it were requested
+    assert emulator.requests[('GET', '/events')] <= 1 + apptoto.PREFETCH
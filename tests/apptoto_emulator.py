@@ -0,0 +1,471 @@
+"""
+A local stand-in for the parts of the apptoto API used by src/apptoto.py.
+
+Emulates /v1/events, /v1/event, /v1/contacts, /v1/contact and /v1/address_books,
+including pagination, the 100 requests per minute burst rate limit,
+"bad gateway" errors for large batches and include_conversations payloads.
+Time is kept by a VirtualClock, so a job that would spend minutes waiting
+on the rate limit runs in a fraction of a second.
+
+In process:
+    emulator = ApptotoEmulator()
+    apptoto = emulator.client()  # an Apptoto instance connected to the emulator
+
+Replies are pushed to the app's /inbound endpoint with
+    emulator.push_notifications(requests.post, 'http://localhost:5000/inbound', token)
+
+As a server, for the app itself (set apptoto_endpoint = 'http://localhost:5001/v1' in the config):
+    python -m tests.apptoto_emulator --port 5001
+"""
+import argparse
+import bisect
+import json
+import random
+import re
+import threading
+import zoneinfo
+from collections import Counter, defaultdict
+from datetime import datetime, timedelta, timezone
+from urllib.parse import urlsplit, parse_qs
+
+import requests
+from requests.adapters import BaseAdapter
+
+from src.apptoto import Apptoto, Clock, RateLimiter
+from src.breaker import CircuitBreaker
+from src.constants import ASH_CALENDAR_ID
+
+
+class VirtualClock(Clock):
+    def __init__(self, start=0.0):
+        """
+        A clock that only moves when someone sleeps on it.
+
+        Each thread keeps its own time, so a thread that sleeps until an earlier time
+        than another thread wakes at that time, as it would on a wall clock.
+        A thread that has not slept yet starts at the latest time any thread has reached.
+
+        :param start: Starting time in seconds
+        """
+        self._latest = start
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def monotonic(self):
+        return getattr(self._local, 'now', self._latest)
+
+    def sleep_until(self, t):
+        self._local.now = max(self.monotonic(), t)
+        with self._lock:
+            self._latest = max(self._latest, t)
+
+
+def normalize_phone(phone):
+    digits = re.sub(r'\D', '', str(phone or ''))
+    return f'+1{digits[-10:]}' if digits else None
+
+
+def parse_time(value):
+    t = datetime.fromisoformat(str(value).replace('Z', '+00:00'))
+    return t if t.tzinfo else t.replace(tzinfo=timezone.utc)
+
+
+def _flag(value):
+    return str(value).lower() in ('true', '1')
+
+
+class ApptotoEmulator:
+    BURST_LIMIT = 100  # requests per BURST_WINDOW seconds
+    BURST_WINDOW = 60
+    MAX_BATCH = 25  # posting or putting more events than this at once returns 502
+
+    def __init__(self, clock: VirtualClock = None, latency=0.0, failure_rate=0.0, seed=0,
+                 calendars=None, time_zone='US/Pacific'):
+        """
+        Create an ApptotoEmulator.
+
+        :param clock: Clock for rate limiting and conversation timestamps (default = new VirtualClock)
+        :param latency: Virtual seconds each request takes
+        :param failure_rate: Fraction of requests that fail with 502
+        :param seed: Seed for failures and simulated replies
+        :param calendars: dict of calendar name to id
+        :param time_zone: Time zone of the apptoto account
+        """
+        self.clock = clock or VirtualClock()
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.outage = False  # while True, every request fails with 503
+        self.random = random.Random(seed)
+        self.calendars = calendars or {'ASH Messages': ASH_CALENDAR_ID}
+        self.time_zone = zoneinfo.ZoneInfo(time_zone)
+        self.events = {}
+        self._by_phone = defaultdict(set)  # event ids by participant phone, to keep large cohorts fast
+        self.contacts = {}
+        self.address_books = [{'id': 1, 'name': 'ASH'}]
+        self.requests = Counter()
+        self.statuses = Counter()
+        self._recent = []
+        self._ids = iter(range(1, 10 ** 12))
+        self._notified = 0  # id of the last conversation message pushed
+        self._lock = threading.Lock()
+
+    # Connecting clients
+
+    def client(self, api_token='token', user='user') -> Apptoto:
+        """
+        Get an Apptoto instance that sends its requests to this emulator
+        and waits on the emulator's clock, with its own circuit breaker.
+        """
+        apptoto = Apptoto(api_token=api_token, user=user)
+        apptoto.limiter = RateLimiter(Apptoto.REQUEST_LIMIT, clock=self.clock)
+        apptoto.breaker = CircuitBreaker('apptoto', clock=self.clock)
+        self.connect(apptoto._session, Apptoto.ENDPOINT)
+        return apptoto
+
+    def connect(self, session: requests.Session, endpoint=Apptoto.ENDPOINT):
+        session.mount(endpoint, EmulatorAdapter(self))
+
+    # Test data
+
+    def add_contact(self, external_id, name, phone, email=None, address_book='ASH'):
+        with self._lock:
+            return self._store_contact({'external_id': external_id, 'name': name, 'phone': phone,
+                                        'email': email, 'address_book': address_book})
+
+    def simulate_conversations(self, until: datetime = None, reply_rate=0.5, max_replies=2,
+                               reply_delay=timedelta(hours=3)):
+        """
+        Add a sent message to every event that started before `until`,
+        and random replies to some of them.
+
+        :param until: Events up to this time have been sent (default = all events)
+        :param reply_rate: Chance that a participant replies to a message
+        :param max_replies: Most replies to one message
+        :param reply_delay: Longest time until a reply
+        :return: Number of conversation messages added
+        """
+        added = 0
+        with self._lock:
+            for event in self.events.values():
+                start = parse_time(event['start_time'])
+                if until and start > until:
+                    continue
+                for participant in event['participants']:
+                    messages = [{'id': next(self._ids), 'at': self._local_time(event['start_time']),
+                                 'event_type': 'sent', 'content': event['content']}]
+                    if self.random.random() < reply_rate:
+                        for _ in range(self.random.randint(1, max_replies)):
+                            at = start + timedelta(seconds=int(reply_delay.total_seconds() * self.random.random()))
+                            messages.append({'id': next(self._ids), 'at': self._local_time(at.isoformat()),
+                                             'event_type': 'replied',
+                                             'content': str(self.random.randint(0, 20))})
+                    participant['conversations'].append({'id': next(self._ids), 'messages': messages})
+                    added += len(messages)
+        return added
+
+    def notifications(self):
+        """
+        Get the conversation messages added since the last call, as apptoto pushes them:
+        events holding only their new messages.
+
+        :return: List of events
+        """
+        notified = self._notified
+        events = []
+        with self._lock:
+            for event in self.events.values():
+                participants = []
+                for p in event['participants']:
+                    conversations = []
+                    for c in p['conversations']:
+                        messages = [m for m in c['messages'] if m['id'] > notified]
+                        if messages:
+                            conversations.append({'id': c['id'], 'messages': messages})
+                            self._notified = max(self._notified, *(m['id'] for m in messages))
+                    if conversations:
+                        participants.append({'event_id': p['event_id'], 'name': p['name'], 'phone': p['phone'],
+                                             'contact_external_id': p['contact_external_id'],
+                                             'conversations': conversations})
+                if participants:
+                    data = {k: event[k] for k in ('id', 'calendar_id', 'title', 'start_time', 'content', 'external_id')}
+                    events.append(dict(data, participants=participants))
+        return events
+
+    def push_notifications(self, post, url, token, batch_size=25):
+        """
+        Send the new conversation messages to the app's inbound endpoint, standing in for apptoto.
+
+        :param post: requests.post, or the post of a Flask test client
+        :param url: URL of the endpoint, e.g. 'http://localhost:5000/inbound' or '/inbound'
+        :param token: The app's inbound_token
+        :param batch_size: Most events sent in one request
+        :return: Number of messages the app received
+        """
+        events = self.notifications()
+        received = 0
+        for i in range(0, len(events), batch_size):
+            response = post(url, json={'events': events[i:i + batch_size]},
+                            headers={'Authorization': f'Bearer {token}'})
+            if response.status_code != 202:
+                raise RuntimeError(f'{url} returned {response.status_code}')
+            received += json.loads(response.text)['received']
+        return received
+
+    # Request handling
+
+    def handle(self, method, path, params, body):
+        """
+        Handle one API request.
+
+        :param method: HTTP method
+        :param path: Path after /v1, e.g. '/events'
+        :param params: dict of query parameters
+        :param body: Decoded JSON body, or None
+        :return: Tuple of (status code, response data)
+        """
+        if self.latency:
+            self.clock.sleep_until(self.clock.monotonic() + self.latency)
+        now = self.clock.monotonic()
+
+        with self._lock:
+            self.requests[(method, path)] += 1
+
+            # threads on a virtual clock can arrive slightly out of order, so keep the times sorted
+            bisect.insort(self._recent, now)
+            while self._recent[0] < self._recent[-1] - 2 * self.BURST_WINDOW:
+                self._recent.pop(0)
+            # allow for rounding in clients that space requests exactly BURST_WINDOW / BURST_LIMIT apart
+            in_window = (bisect.bisect_right(self._recent, now)
+                         - bisect.bisect_right(self._recent, now - self.BURST_WINDOW + 1e-6))
+            if self.outage:
+                status, data = 503, {'error': 'service unavailable'}
+            elif in_window > self.BURST_LIMIT:
+                status, data = 429, {'error': 'burst rate limit exceeded'}
+            elif self.failure_rate and self.random.random() < self.failure_rate:
+                status, data = 502, {'error': 'bad gateway'}
+            else:
+                handler = getattr(self, f'_{method.lower()}_{path.strip("/")}', None)
+                status, data = handler(params, body) if handler else (404, {'error': 'not found'})
+
+            self.statuses[status] += 1
+            return status, data
+
+    def _post_events(self, params, body):
+        events = body['events']
+        if len(events) > self.MAX_BATCH:
+            return 502, {'error': 'bad gateway'}
+
+        posted = []
+        for e in events:
+            event = {'id': next(self._ids),
+                     'calendar_id': self.calendars.get(e.get('calendar'), next(iter(self.calendars.values()))),
+                     'calendar_name': e.get('calendar'),
+                     'title': e.get('title'),
+                     'start_time': self._local_time(e.get('start_time')),
+                     'end_time': self._local_time(e.get('end_time') or e.get('start_time')),
+                     'content': e.get('content'),
+                     'external_id': e.get('external_id'),
+                     'is_deleted': False,
+                     'participants': [self._participant(p) for p in e.get('participants', [])]}
+            for p in event['participants']:
+                p['event_id'] = next(self._ids)
+            self.events[event['id']] = event
+            self._index(event)
+            posted.append(self._event_data(event, include_conversations=False))
+        return 200, {'events': posted}
+
+    def _put_events(self, params, body):
+        if len(body['events']) > self.MAX_BATCH:
+            return 502, {'error': 'bad gateway'}
+
+        for e in body['events']:
+            event = self.events.get(e.get('id'))
+            if event is None:
+                return 404, {'error': f'event {e.get("id")} not found'}
+            for key in ('title', 'content', 'external_id'):
+                if key in e:
+                    event[key] = e[key]
+            for key in ('start_time', 'end_time'):
+                if e.get(key):
+                    event[key] = self._local_time(e[key])
+            if 'participants' in e:
+                self._unindex(event)
+                event['participants'] = [dict(self._participant(p), event_id=next(self._ids))
+                                         for p in e['participants']]
+                self._index(event)
+        return 200, {'events': [self._event_data(self.events[e['id']], False) for e in body['events']]}
+
+    def _delete_events(self, params, body):
+        event = self.events.pop(int(params.get('id', 0)), None)
+        if event is None:
+            return 404, {'error': 'event not found'}
+        self._unindex(event)
+        return 200, {}
+
+    def _get_event(self, params, body):
+        event = self.events.get(int(params.get('id', 0)))
+        if event is None:
+            return 404, {'error': 'event not found'}
+        return 200, self._event_data(event, _flag(params.get('include_conversations')))
+
+    def _get_events(self, params, body):
+        if 'phone_number' in params:
+            events = [self.events[i] for i in self._by_phone.get(normalize_phone(params['phone_number']), ())]
+        else:
+            events = self.events.values()
+        events = sorted(events, key=lambda e: (parse_time(e['start_time']), e['id']))
+        if 'begin' in params:
+            events = [e for e in events if parse_time(e['start_time']) >= parse_time(params['begin'])]
+        if 'end' in params:
+            events = [e for e in events if parse_time(e['start_time']) <= parse_time(params['end'])]
+        if 'calendar_id' in params:
+            events = [e for e in events if e['calendar_id'] == int(params['calendar_id'])]
+        if 'email_address' in params:
+            events = [e for e in events if any(p['email'] == params['email_address'] for p in e['participants'])]
+
+        page = self._page(events, params)
+        include_conversations = _flag(params.get('include_conversations'))
+        return 200, {'events': [self._event_data(e, include_conversations) for e in page]}
+
+    def _get_contact(self, params, body):
+        contact = next((c for c in self.contacts.values()
+                        if ('external_id' in params and c['external_id'] == params['external_id'])
+                        or ('id' in params and c['id'] == int(params['id']))), None)
+        if contact is None:
+            return 404, {'error': 'contact not found'}
+        return 200, contact
+
+    def _get_contacts(self, params, body):
+        contacts = sorted(self.contacts.values(), key=lambda c: c['id'])
+        return 200, {'contacts': self._page(contacts, params)}
+
+    def _post_contacts(self, params, body):
+        return 200, {'contacts': [self._store_contact(c) for c in body['contacts']]}
+
+    def _put_contacts(self, params, body):
+        updated = []
+        for c in body['contacts']:
+            contact = self.contacts.get(c.get('id')) or next(
+                (x for x in self.contacts.values() if x['external_id'] == c.get('external_id')), None)
+            if contact is None:
+                updated.append(self._store_contact(c))
+                continue
+            contact['name'] = c.get('name', contact['name'])
+            if 'phone_numbers' in c:
+                contact['phone_numbers'] = [dict(p, normalized=normalize_phone(p.get('number')))
+                                            for p in c['phone_numbers']]
+            if 'email_addresses' in c:
+                contact['email_addresses'] = list(c['email_addresses'])
+            updated.append(contact)
+        return 200, {'contacts': updated}
+
+    def _delete_contacts(self, params, body):
+        if self.contacts.pop((body or {}).get('id'), None) is None:
+            return 404, {'error': 'contact not found'}
+        return 200, {}
+
+    def _get_address_books(self, params, body):
+        return 200, {'address_books': self.address_books}
+
+    # Helpers, called with the lock held
+
+    def _store_contact(self, c):
+        book = next((b for b in self.address_books if b['name'] == c.get('address_book')), self.address_books[0])
+        contact = {'id': next(self._ids), 'external_id': c.get('external_id'), 'name': c.get('name'),
+                   'address_book_id': book['id'],
+                   'phone_numbers': [{'number': c['phone'], 'normalized': normalize_phone(c['phone']),
+                                      'is_mobile': True, 'is_primary': True}] if c.get('phone') else [],
+                   'email_addresses': [{'address': c['email'], 'is_primary': True}] if c.get('email') else []}
+        self.contacts[contact['id']] = contact
+        return contact
+
+    def _local_time(self, value):
+        # apptoto reports times in the account's time zone, whatever offset they were posted with
+        return parse_time(value).astimezone(self.time_zone).isoformat() if value else value
+
+    def _index(self, event):
+        for p in event['participants']:
+            self._by_phone[p['normalized_phone']].add(event['id'])
+
+    def _unindex(self, event):
+        for p in event['participants']:
+            self._by_phone[p['normalized_phone']].discard(event['id'])
+
+    def _participant(self, p):
+        return {'name': p.get('name'), 'phone': p.get('phone'), 'email': p.get('email'),
+                'normalized_phone': normalize_phone(p.get('phone')),
+                'contact_external_id': p.get('contact_external_id'), 'conversations': []}
+
+    @staticmethod
+    def _page(records, params):
+        page_size = int(params.get('page_size', 100))
+        page = int(params.get('page', 1))
+        return records[(page - 1) * page_size:page * page_size]
+
+    @staticmethod
+    def _event_data(event, include_conversations):
+        data = dict(event)
+        data['participants'] = [dict(p) for p in event['participants']]
+        for p in data['participants']:
+            if include_conversations:
+                p['conversations'] = [dict(c, messages=list(c['messages'])) for c in p['conversations']]
+            else:
+                p.pop('conversations')
+        return data
+
+
+class EmulatorAdapter(BaseAdapter):
+    def __init__(self, emulator: ApptotoEmulator):
+        """
+        A requests transport adapter that sends requests to an ApptotoEmulator instead of the network.
+        """
+        super().__init__()
+        self.emulator = emulator
+
+    def send(self, request, **kwargs):
+        url = urlsplit(request.url)
+        path = url.path.split('/v1', 1)[-1]
+        params = {k: v[-1] for k, v in parse_qs(url.query).items()}
+        body = json.loads(request.body) if request.body else None
+
+        status, data = self.emulator.handle(request.method, path, params, body)
+
+        response = requests.Response()
+        response.status_code = status
+        response._content = json.dumps(data).encode('utf-8')
+        response.headers['Content-Type'] = 'application/json'
+        response.url = request.url
+        response.request = request
+        response.encoding = 'utf-8'
+        return response
+
+    def close(self):
+        pass
+
+
+def make_app(emulator: ApptotoEmulator = None):
+    """
+    Serve an ApptotoEmulator over HTTP, for running the app against it.
+    """
+    import flask
+
+    emulator = emulator or ApptotoEmulator()
+    app = flask.Flask(__name__)
+
+    @app.route('/v1/<path:path>', methods=['GET', 'POST', 'PUT', 'DELETE'])
+    def api(path):
+        body = flask.request.get_json(force=True, silent=True)
+        status, data = emulator.handle(flask.request.method, f'/{path}', flask.request.args.to_dict(), body)
+        return flask.jsonify(data), status
+
+    app.emulator = emulator
+    return app
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run an apptoto stand-in server')
+    parser.add_argument('--port', type=int, default=5001)
+    parser.add_argument('--failure-rate', type=float, default=0.0)
+    args = parser.parse_args()
+    # a served emulator runs on wall clock time, so the burst limit applies as it would in apptoto
+    make_app(ApptotoEmulator(clock=Clock(), failure_rate=args.failure_rate)).run(port=args.port)
@@ -0,0 +1,61 @@
+from datetime import datetime
+
+import pytest
+
+from src.apptoto import ApptotoEvent, ApptotoParticipant, make_external_id
+from src.flask_app import create_app
+from src.store import Store
+from tests.apptoto_emulator import ApptotoEmulator
+
+TOKEN = 'inbound-token'
+
+
+def client(tmp_path, monkeypatch, **config):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv('LOGIN_EMAIL', 'user@example.com')
+    monkeypatch.setenv('LOGIN_PASS', 'password')
+    return create_app({'AUTOMATIONCONFIG': config}).test_client()
+
+
+@pytest.fixture
+def inbound(tmp_path, monkeypatch):
+    return client(tmp_path, monkeypatch, inbound_token=TOKEN)
+
+
+def test_inbound_not_found_without_token(tmp_path, monkeypatch):
+    response = client(tmp_path, monkeypatch).post('/inbound', json={'events': []},
+                                                  headers={'Authorization': f'Bearer {TOKEN}'})
+
+    assert response.status_code == 404
+
+
+@pytest.mark.parametrize('headers', [{}, {'Authorization': 'Bearer wrong'}, {'Authorization': TOKEN + 'x'}])
+def test_inbound_rejects_bad_token(inbound, headers):
+    response = inbound.post('/inbound', json={'events': []}, headers=headers)
+
+    assert response.status_code == 401
+
+
+@pytest.mark.parametrize('body', [None, [], {'events': {}}, {'events': ['event']}, {'other': []}])
+def test_inbound_rejects_bad_body(inbound, body):
+    response = inbound.post('/inbound', json=body, headers={'Authorization': f'Bearer {TOKEN}'})
+
+    assert response.status_code == 400
+
+
+def test_inbound_keeps_participant_messages(inbound):
+    emulator = ApptotoEmulator()
+    apptoto = emulator.client()
+    participants = [ApptotoParticipant('P01', '541-000-0001', external_id='ASH001')]
+    apptoto.post_events([ApptotoEvent('ASH Messages', 'ASH SMS', datetime(2021, 4, 1, 9), 'UO: one', participants,
+                                      external_id=make_external_id('ASH001', 'sms', 0)),
+                         # not a participant id, so it does not name a store partition
+                         ApptotoEvent('ASH Messages', 'ASH SMS', datetime(2021, 4, 1, 9), 'UO: two', participants,
+                                      external_id=make_external_id('../ASH001', 'sms', 0))])
+    emulator.simulate_conversations(reply_rate=1.0, max_replies=1)
+
+    received = emulator.push_notifications(inbound.post, '/inbound', TOKEN)
+
+    assert received == 2
+    assert len(Store().read('inbound', 'ASH001')) == 2
+    assert Store().participants('inbound') == ['ASH001']
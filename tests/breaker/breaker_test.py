@@ -0,0 +1,84 @@
+from datetime import datetime
+
+import pytest
+
+from src.apptoto import ApptotoError, ApptotoEvent, ApptotoParticipant
+from src.breaker import CircuitBreaker, CircuitOpenError, parked, CLOSED, OPEN
+from tests.apptoto_emulator import ApptotoEmulator, VirtualClock
+
+
+def test_fails_fast_after_failures():
+    emulator = ApptotoEmulator()
+    apptoto = emulator.client()
+    emulator.outage = True
+
+    for _ in range(5):
+        with pytest.raises(ApptotoError):
+            apptoto.get_contact(external_id='ASH001')
+    assert apptoto.breaker.state == OPEN
+
+    # the circuit is open, so the request is not sent
+    with pytest.raises(CircuitOpenError):
+        apptoto.get_contact(external_id='ASH001')
+    assert sum(emulator.requests.values()) == 5
+
+
+def test_rejected_batch_is_split():
+    emulator = ApptotoEmulator()
+    emulator.MAX_BATCH = 4
+    apptoto = emulator.client()
+    participants = [ApptotoParticipant('P01', '541-000-0001', external_id='ASH001')]
+    events = [ApptotoEvent('ASH Messages', 'ASH', datetime(2021, 4, 1, 9, minute), f'Message {minute}', participants)
+              for minute in range(apptoto.MAX_POST)]
+
+    posted = apptoto.post_events(events)
+
+    assert [e['content'] for e in posted] == [e.content for e in events]
+    assert len(emulator.events) == apptoto.MAX_POST
+    # a batch apptoto rejects as too large is not an outage
+    assert emulator.statuses[502] > 0
+    assert apptoto.breaker.state == CLOSED
+
+
+def test_parked_call_resumes_after_recovery():
+    emulator = ApptotoEmulator()
+    emulator.add_contact('ASH001', 'P01', '541-000-0001')
+    apptoto = emulator.client()
+    emulator.outage = True
+    for _ in range(5):
+        with pytest.raises(ApptotoError):
+            apptoto.get_contact(external_id='ASH001')
+    opened = emulator.clock.monotonic()
+    emulator.outage = False
+
+    with parked(600):
+        contact = apptoto.get_contact(external_id='ASH001')
+
+    assert contact['external_id'] == 'ASH001'
+    assert apptoto.breaker.state == CLOSED
+    # the call waited for the probe at the end of the open period
+    assert emulator.clock.monotonic() - opened >= apptoto.breaker.reset_timeout
+    assert emulator.requests[('GET', '/address_books')] == 1
+
+
+def test_open_period_doubles():
+    clock = VirtualClock()
+    breaker = CircuitBreaker('test', failures=1, reset_timeout=30, max_reset_timeout=300, clock=clock)
+    probes = []
+
+    def probe():
+        probes.append(clock.monotonic())
+        return False
+
+    def down():
+        raise ConnectionError('apptoto is down')
+
+    with pytest.raises(ConnectionError):
+        breaker.call(down)
+    with parked(1000), pytest.raises(CircuitOpenError):
+        breaker.call(lambda: None, probe=probe)
+
+    # open for 30 seconds, then twice as long after each failed probe, up to 300
+    assert probes == [30, 90, 210, 450, 750]
+    assert clock.monotonic() == 1000
+    assert breaker.state == OPEN
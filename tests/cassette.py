@@ -0,0 +1,338 @@
+"""
+Record apptoto requests and REDCap exports made by a real job, and replay them without a network.
+
+Phone numbers, email addresses and names are replaced before anything is written,
+consistently, so a scrubbed phone number in a REDCap export still finds the events
+recorded for it. Message content is kept.
+
+Record a job with the app's settings (MESSAGE_AUTOMATION_SETTINGS), then replay it:
+    python -m tests.cassette record get_conversations ASH001 ash001.json.gz
+    python -m tests.cassette replay get_conversations ASH001 ash001.json.gz [--timing original]
+
+In Python:
+    eg = EventGenerator(...)
+    with Cassette('ash001.json.gz').replaying(eg.apptoto):
+        eg.get_conversations()
+
+Replayed apptoto responses are matched by method, path and query parameters (other than
+the begin and end times, which depend on the day the job runs), in the order they were recorded.
+With timing='original' each response takes as long as it did when recorded and the rate limit
+applies as usual; with timing='compressed' responses return at once and the rate limit
+is kept on a virtual clock.
+"""
+import argparse
+import gzip
+import hashlib
+import json
+import re
+import threading
+import time
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from pathlib import Path
+from urllib.parse import urlsplit, parse_qsl
+
+import pandas as pd
+import requests
+from requests.adapters import BaseAdapter, HTTPAdapter
+
+import src.participant
+from src.apptoto import Apptoto, RateLimiter
+from tests.apptoto_emulator import VirtualClock
+
+TIMINGS = ('original', 'compressed')
+JOBS = ('get_conversations', 'delete_messages', 'update_events', 'generate_messages')
+PHONE_KEYS = {'phone', 'normalized_phone', 'number', 'normalized', 'phone_number'}
+EMAIL_KEYS = {'email', 'address', 'email_address'}
+PERSON_KEYS = {'phone', 'email', 'normalized_phone', 'phone_numbers', 'email_addresses'}
+IGNORED_PARAMS = {'begin', 'end'}
+
+
+class CassetteError(Exception):
+    pass
+
+
+def _digest(value):
+    return hashlib.sha256(str(value).encode('utf-8')).hexdigest()
+
+
+def fake_phone(phone):
+    """Replace the last 10 digits of a phone number with a 555 number, keeping its format."""
+    if not isinstance(phone, str):
+        return phone
+    digits = re.sub(r'\D', '', phone)[-10:]
+    if not digits:
+        return phone
+    fake = iter('555' + str(int(_digest(digits)[:12], 16))[-7:].zfill(7))
+    positions = [m.start() for m in re.finditer(r'\d', phone)][-len(digits):]
+    chars = list(phone)
+    for i in positions[-10:]:
+        chars[i] = next(fake)
+    return ''.join(chars)
+
+
+def fake_email(email):
+    if not isinstance(email, str) or not email:
+        return email
+    return f'p{_digest(email.strip().casefold())[:10]}@example.com'
+
+
+def fake_name(name):
+    if not isinstance(name, str) or not name:
+        return name
+    digest = _digest(name)
+    return chr(ord('A') + int(digest[:4], 16) % 26) + chr(ord('A') + int(digest[4:8], 16) % 26)
+
+
+REDCAP_FIELDS = {'phone': fake_phone, 'email': fake_email, 'initials': fake_name}
+
+
+def scrub(data):
+    """
+    Replace phone numbers, email addresses and participant names in apptoto request or response data.
+
+    :param data: Decoded JSON data
+    :return: Scrubbed copy
+    """
+    if isinstance(data, list):
+        return [scrub(x) for x in data]
+    if not isinstance(data, dict):
+        return data
+
+    person = bool(PERSON_KEYS & data.keys())
+    scrubbed = {}
+    for key, value in data.items():
+        if key in PHONE_KEYS:
+            scrubbed[key] = fake_phone(value)
+        elif key in EMAIL_KEYS:
+            scrubbed[key] = fake_email(value)
+        elif key == 'name' and person:
+            scrubbed[key] = fake_name(value)
+        else:
+            scrubbed[key] = scrub(value)
+    return scrubbed
+
+
+def scrub_records(records: pd.DataFrame) -> pd.DataFrame:
+    """Replace phone numbers, email addresses and initials in a REDCap export."""
+    records = records.copy()
+    for field, fake in REDCAP_FIELDS.items():
+        if field in records.columns:
+            records[field] = records[field].map(fake)
+    return records
+
+
+def _request_key(method, path, params):
+    return method, path, tuple(sorted((k, str(v)) for k, v in params.items() if k not in IGNORED_PARAMS))
+
+
+def _decode(content):
+    try:
+        return json.loads(content) if content else None
+    except ValueError:
+        return content.decode('utf-8', errors='replace')
+
+
+def _split_url(url):
+    url = urlsplit(url)
+    return url.path.split('/v1', 1)[-1], dict(parse_qsl(url.query))
+
+
+def _records_to_dict(records: pd.DataFrame):
+    flat = records.reset_index()
+    return {'index': list(records.index.names), 'columns': list(flat.columns),
+            'data': flat.astype(object).where(flat.notna(), None).values.tolist()}
+
+
+def _records_from_dict(data) -> pd.DataFrame:
+    return pd.DataFrame(data['data'], columns=data['columns']).set_index(data['index'])
+
+
+class RecordingAdapter(HTTPAdapter):
+    def __init__(self, cassette):
+        """A transport adapter that sends requests to apptoto and records them in a cassette."""
+        super().__init__()
+        self.cassette = cassette
+
+    def send(self, request, **kwargs):
+        start = time.perf_counter()
+        response = super().send(request, **kwargs)
+        path, params = _split_url(request.url)
+        self.cassette.add_request(method=request.method, path=path, params=scrub(params),
+                                  body=scrub(_decode(request.body)), status=response.status_code,
+                                  response=scrub(_decode(response.content)),
+                                  elapsed=time.perf_counter() - start)
+        return response
+
+
+class ReplayAdapter(BaseAdapter):
+    def __init__(self, cassette, timing='compressed'):
+        """A transport adapter that answers requests from a cassette."""
+        super().__init__()
+        self.timing = timing
+        self._lock = threading.Lock()
+        self._queues = defaultdict(deque)
+        for entry in cassette.requests:
+            self._queues[_request_key(entry['method'], entry['path'], entry['params'])].append(entry)
+
+    def send(self, request, **kwargs):
+        path, params = _split_url(request.url)
+        key = _request_key(request.method, path, params)
+        with self._lock:
+            if not self._queues[key]:
+                raise CassetteError(f'No recorded response for {request.method} {path} {params}')
+            entry = self._queues[key].popleft()
+
+        if self.timing == 'original':
+            time.sleep(entry['elapsed'])
+
+        response = requests.Response()
+        response.status_code = entry['status']
+        response._content = json.dumps(entry['response']).encode('utf-8')
+        response.headers['Content-Type'] = 'application/json'
+        response.url = request.url
+        response.request = request
+        response.encoding = 'utf-8'
+        return response
+
+    def close(self):
+        pass
+
+
+class Cassette:
+    def __init__(self, path):
+        """
+        Create a Cassette.
+
+        A Cassette holds scrubbed apptoto requests and responses and REDCap exports,
+        with the time each took. Files ending in .gz are compressed.
+
+        :param path: Cassette file, read if it exists
+        """
+        self.path = Path(path)
+        self.requests = []
+        self.exports = []
+        self._lock = threading.Lock()
+        if self.path.exists():
+            self.load()
+
+    def _open(self, mode):
+        if self.path.suffix == '.gz':
+            return gzip.open(self.path, mode + 't', encoding='utf-8')
+        return open(self.path, mode, encoding='utf-8')
+
+    def load(self):
+        with self._open('r') as f:
+            data = json.load(f)
+        self.requests = data['requests']
+        self.exports = data['exports']
+
+    def save(self):
+        with self._open('w') as f:
+            json.dump({'requests': self.requests, 'exports': self.exports}, f)
+
+    def add_request(self, **entry):
+        with self._lock:
+            self.requests.append(entry)
+
+    @contextmanager
+    def recording(self, apptoto: Apptoto):
+        """
+        Record the requests `apptoto` makes and all REDCap exports while in the context,
+        then save the cassette.
+        """
+        export_records = src.participant._export_records
+
+        def recording_export(redcap_token):
+            start = time.perf_counter()
+            records = export_records(redcap_token)
+            with self._lock:
+                self.exports.append({'records': _records_to_dict(scrub_records(records)),
+                                     'elapsed': time.perf_counter() - start})
+            return records
+
+        apptoto._session.mount(apptoto.ENDPOINT, RecordingAdapter(self))
+        src.participant._export_records = recording_export
+        try:
+            yield self
+        finally:
+            src.participant._export_records = export_records
+            self.save()
+
+    @contextmanager
+    def replaying(self, apptoto: Apptoto, timing='compressed'):
+        """
+        Answer the requests `apptoto` makes and all REDCap exports from the cassette while in the context.
+
+        :param apptoto: Apptoto instance used by the job
+        :param timing: 'original' to take as long as the recorded requests, or 'compressed'
+        """
+        if timing not in TIMINGS:
+            raise ValueError(f'timing must be one of {TIMINGS}')
+        if not self.exports:
+            raise CassetteError(f'No REDCap exports recorded in {self.path}')
+        export_records = src.participant._export_records
+        exports = deque(self.exports)
+
+        def replay_export(redcap_token):
+            # jobs export the same records several times, keep serving the last one
+            export = exports.popleft() if len(exports) > 1 else exports[0]
+            if timing == 'original':
+                time.sleep(export['elapsed'])
+            return _records_from_dict(export['records'])
+
+        apptoto._session.mount(apptoto.ENDPOINT, ReplayAdapter(self, timing))
+        if timing == 'compressed':
+            apptoto.limiter = RateLimiter(Apptoto.REQUEST_LIMIT, clock=VirtualClock())
+        src.participant._export_records = replay_export
+        try:
+            yield self
+        finally:
+            src.participant._export_records = export_records
+
+
+def run_job(eg, job):
+    import asyncio
+
+    result = getattr(eg, job)()
+    if asyncio.iscoroutine(result):
+        result = asyncio.run(result)
+    return result
+
+
+def main():
+    import flask
+    from src.event_generator import EventGenerator
+    from src.mylogging import configure_logging
+
+    parser = argparse.ArgumentParser(description='Record or replay the apptoto and REDCap traffic of a job')
+    parser.add_argument('mode', choices=['record', 'replay'])
+    parser.add_argument('job', choices=JOBS)
+    parser.add_argument('participant')
+    parser.add_argument('cassette')
+    parser.add_argument('--timing', choices=TIMINGS, default='compressed', help='replay timing')
+    parser.add_argument('--instance', default='instance', help='instance folder containing the message file')
+    args = parser.parse_args()
+
+    configure_logging()
+    config = flask.Config(Path(args.instance).resolve())
+    config.from_envvar('MESSAGE_AUTOMATION_SETTINGS')
+    eg = EventGenerator(args.participant, config['AUTOMATIONCONFIG'], Path(args.instance))
+
+    cassette = Cassette(args.cassette)
+    start = time.perf_counter()
+    if args.mode == 'record':
+        cassette.requests, cassette.exports = [], []
+        with cassette.recording(eg.apptoto):
+            result = run_job(eg, args.job)
+    else:
+        with cassette.replaying(eg.apptoto, timing=args.timing):
+            result = run_job(eg, args.job)
+
+    print(result)
+    print(f'{args.mode}: {len(cassette.requests)} requests, {len(cassette.exports)} REDCap exports, '
+          f'{time.perf_counter() - start:.1f} s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,158 @@
+from datetime import datetime, timedelta
+
+import pandas as pd
+
+from src.apptoto import ApptotoEvent, ApptotoParticipant
+from src.conversation import attribute_replies, conversation_rows, sent_message_ids
+from src.message import normalize_message
+from src.inbound import apply_notifications, INBOUND_COLUMNS
+from tests.apptoto_emulator import ApptotoEmulator
+
+EVENT = 'participants.event_id'
+
+
+def at(time):
+    return pd.Timestamp(f'2026-12-01 {time}', tz='America/Los_Angeles')
+
+
+def sent_rows(*rows):
+    return pd.DataFrame([{'at': at(t), 'content': content, 'title': title, EVENT: event}
+                         for t, event, title, content in rows])
+
+
+def reply_rows(*rows):
+    return pd.DataFrame([{'at': at(t), 'content': content, EVENT: event} for t, event, content in rows],
+                        columns=['at', 'content', EVENT])
+
+
+def test_attribute_replies_first_of_several():
+    sent = sent_rows(('20:00', 1, 'ASH SMS', 'UO: one'))
+    received = reply_rows(('20:10', 1, 'yes'), ('20:20', 1, 'again'))
+
+    merged = attribute_replies(sent, received)
+
+    assert merged.replies.tolist() == [2]
+    assert merged.content_rec.tolist() == ['yes']
+    assert merged.reply_latency.tolist() == [timedelta(minutes=10)]
+
+
+def test_attribute_replies_late_reply():
+    sent = sent_rows(('08:00', 1, 'ASH SMS', 'UO: one'))
+    received = reply_rows(('09:00', 1, 'late'))
+
+    merged = attribute_replies(sent, received, window=timedelta(minutes=30))
+
+    assert merged.replies.tolist() == [0]
+    assert merged.at_rec.isna().all()
+
+
+def test_attribute_replies_on_own_event():
+    sent = sent_rows(('20:00', 1, 'ASH CIGS', 'UO: How many cigarettes?'),
+                     ('20:30', 2, 'ASH SMS', 'UO: one'))
+    received = reply_rows(('21:00', 1, '3'))
+
+    merged = attribute_replies(sent, received)
+
+    assert merged.replies.tolist() == [1, 0]
+    assert merged.content_rec.tolist()[0] == '3'
+
+
+def test_attribute_replies_across_events():
+    # a reply on an event with no sent message answers the latest message sent on any event
+    sent = sent_rows(('20:00', 1, 'ASH CIGS', 'UO: How many cigarettes?'),
+                     ('20:30', 2, 'ASH SMS', 'UO: one'))
+    received = reply_rows(('21:00', 3, 'ok'), ('21:05', None, 'ok again'))
+
+    merged = attribute_replies(sent, received)
+
+    assert merged.replies.tolist() == [0, 2]
+
+
+def test_attribute_replies_by_time_without_events():
+    sent = sent_rows(('20:00', 1, 'ASH CIGS', 'UO: How many cigarettes?'),
+                     ('20:30', 2, 'ASH SMS', 'UO: one')).drop(columns=EVENT)
+    received = reply_rows(('21:00', 1, '3')).drop(columns=EVENT)
+
+    merged = attribute_replies(sent, received)
+
+    assert merged.replies.tolist() == [0, 1]
+
+
+def test_apply_notifications_matches_attribute_replies():
+    sent = sent_rows(('20:00', 1, 'ASH CIGS', 'UO: How many cigarettes?'),
+                     ('20:30', 2, 'ASH SMS', 'UO: one'),
+                     ('21:30', 4, 'ASH SMS', 'UO: two'))
+    received = reply_rows(('21:00', 1, '3'), ('21:10', 3, 'ok'), ('21:40', 4, 'yes'), ('21:45', 4, 'yes!'))
+    inbound = pd.concat([sent.assign(event_type='sent'), received.assign(event_type='replied')], ignore_index=True)
+    inbound = inbound.rename(columns={EVENT: 'event_id'}).assign(id=range(len(inbound)), external_id=None)
+    inbound = inbound.reindex(columns=INBOUND_COLUMNS)
+
+    pushed = apply_notifications(pd.DataFrame(), inbound, index={})
+    fetched = attribute_replies(sent, received)
+
+    assert pushed.replies.tolist() == fetched.replies.tolist() == [1, 1, 2]
+    assert pushed.content_rec.tolist() == fetched.content_rec.tolist()
+
+
+def test_apply_notifications_skips_fetched_messages():
+    sent = sent_rows(('20:00', 1, 'ASH SMS', 'UO: one')).assign(id=[10])
+    received = reply_rows(('20:10', 1, 'yes'), ('20:20', 1, 'again')).assign(id=[11, 12])
+    stored = attribute_replies(sent, received).rename(columns={EVENT: 'event_id'})
+    # pushed while the conversations were fetched: one reply was fetched, the other came later
+    pushed = pd.concat([received, reply_rows(('20:30', 1, 'late')).assign(id=[13])], ignore_index=True)
+    inbound = pushed.rename(columns={EVENT: 'event_id'}).assign(event_type='replied', external_id=None)
+    inbound = inbound.reindex(columns=INBOUND_COLUMNS)
+
+    conversations = apply_notifications(stored, inbound, index={})
+
+    assert conversations.replies.tolist() == [3]
+    assert conversations.reply_ids.tolist() == ['11 12 13']
+    assert conversations.message_id.tolist() == [10]
+
+
+def test_conversation_rows_match_json_normalize():
+    emulator = ApptotoEmulator()
+    apptoto = emulator.client()
+    participants = [ApptotoParticipant('P01', '541-000-0001')]
+    apptoto.post_events([ApptotoEvent('ASH Messages', 'ASH SMS', datetime(2021, 4, day, 9), f'UO: {day}', participants)
+                         for day in range(1, 6)])
+    emulator.simulate_conversations(reply_rate=1.0)
+    events = apptoto.get_events(phone_number='541-000-0001', include_conversations=True)
+
+    rows = pd.DataFrame.from_records(conversation_rows(iter(events)))
+    expected = pd.json_normalize(events, record_path=['participants', 'conversations', 'messages'],
+                                 meta=['title', 'start_time', 'calendar_id', 'external_id', ['participants', 'event_id']])
+
+    assert len(rows) > 5
+    pd.testing.assert_frame_equal(rows[expected.columns], expected, check_dtype=False)
+
+
+def test_sent_message_ids_by_external_id_then_assignment_then_content():
+    conversations = pd.DataFrame({
+        'event_type': ['sent', 'sent', 'sent', 'sent', 'replied'],
+        'content': ['UO: one', 'UO: two', 'UO: how many cigarettes?', 'UO: three', 'UO: three'],
+        'external_id': ['ASH001:sms:0:345', 'ASH001:sms:1', 'ASH001:cigs:0', None, None]})
+    assignment = pd.DataFrame({'slot': [0, 1], 'UO_ID': ['111', '222']})
+    lookups = []
+
+    def index():
+        lookups.append(1)
+        return {normalize_message('UO: three'): '333', normalize_message('UO: how many cigarettes?'): '999'}
+
+    uo_ids = sent_message_ids(conversations, index, assignment=assignment)
+
+    # the external id wins over the assignment, and cigarette messages are not looked up
+    assert uo_ids.fillna('').tolist() == ['345', '222', '', '333', '']
+    assert lookups == [1]
+
+
+def test_sent_message_ids_without_lookup():
+    conversations = pd.DataFrame({'event_type': ['sent', 'sent'], 'content': ['UO: one', 'UO: two'],
+                                  'external_id': ['ASH001:sms:0:345', 'ASH001:sms:1']})
+
+    def index():
+        raise AssertionError('every message has a UO_ID without the message bank')
+
+    uo_ids = sent_message_ids(conversations, index, assignment=pd.DataFrame({'slot': [1], 'UO_ID': ['222']}))
+
+    assert uo_ids.tolist() == ['345', '222']
@@ -0,0 +1,29 @@
+import pandas as pd
+
+from src.constants import SMS_TITLE, CIGS_TITLE
+from src.dashboard import Dashboard
+from src.store import Store
+
+
+def test_rebuild_from_store(tmp_path):
+    store = Store(tmp_path / 'store')
+    store.write('schedules', 'ASH001', pd.DataFrame({
+        'event_id': [1, 2, 3],
+        'start_time': pd.to_datetime(['2026-12-01 18:00', '2026-12-01 18:30', '2026-12-02 03:00'], utc=True)}),
+        name='messages')
+    store.write('conversations', 'ASH001', pd.DataFrame({
+        'event_id': [1, 2, 4],
+        'title_sent': [SMS_TITLE, SMS_TITLE, CIGS_TITLE],
+        'UO_ID': ['UO001', 'UO002', None],
+        'content_sent': ['UO: one', 'UO: two', 'UO: cigs'],
+        'content_rec': ['yes', None, '3']}), name='apptoto')
+    dashboard = Dashboard(tmp_path / 'dashboard.json')
+    # counts kept before the rebuild are replaced
+    dashboard.events_posted('ASH002', ['2026-12-01T10:00:00-08:00'])
+
+    assert dashboard.rebuild(store) == 1
+
+    summary = dashboard.summary(now=pd.Timestamp('2026-12-01 18:00', tz='UTC'))
+    assert summary['participants'] == 1
+    assert summary['upcoming'] == 3
+    assert (summary['sent'], summary['replied']) == (3, 2)
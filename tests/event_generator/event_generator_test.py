@@ -0,0 +1,107 @@
+import asyncio
+import shutil
+import zoneinfo
+from datetime import date, time, timedelta
+from pathlib import Path
+
+import pytest
+
+from src.apptoto import Apptoto, RateLimiter, parse_external_id
+from src.enums import EventType
+from src.event_generator import EventGenerator
+from src.store import Store
+from tests.apptoto_emulator import ApptotoEmulator, parse_time
+from tests.redcap_emulator import RedcapEmulator, synthetic_records
+
+INSTANCE_PATH = Path(__file__).resolve().parents[2] / 'instance'
+CONFIG = {'apptoto_api_token': 'token', 'apptoto_user': 'user', 'apptoto_calendar': 'ASH Messages',
+          'redcap_api_token': 'token', 'message_file': 'messages.csv'}
+
+
+@pytest.fixture
+def cohort(tmp_path, monkeypatch):
+    """One participant in Eastern time, in the REDCap and Apptoto emulators, with files written to tmp_path."""
+    shutil.copy(INSTANCE_PATH / 'messages.csv', tmp_path)
+    monkeypatch.chdir(tmp_path)
+    redcap = RedcapEmulator(synthetic_records(1))
+    redcap.set_field('ASH001', 'timezone', 'ET')
+    redcap.set_field('ASH001', 'waketime', '07:00')
+    redcap.set_field('ASH001', 'sleeptime', '22:00')
+    apptoto = ApptotoEmulator()
+    # one limiter for every generator, as Apptoto.limiter is shared in the app
+    limiter = RateLimiter(Apptoto.REQUEST_LIMIT, clock=apptoto.clock)
+
+    def generator():
+        eg = EventGenerator('ASH001', CONFIG, tmp_path)
+        eg.apptoto.limiter = limiter
+        apptoto.connect(eg.apptoto._session)
+        return eg
+
+    with redcap.installed():
+        yield redcap, apptoto, generator
+
+
+def local_events(apptoto, time_zone='US/Eastern'):
+    """Type and local time of each of the emulator's events, from the day after tomorrow on."""
+    tzinfo = zoneinfo.ZoneInfo(time_zone)
+    events = [(parse_external_id(e['external_id']).event_type, parse_time(e['start_time']).astimezone(tzinfo))
+              for e in apptoto.events.values()]
+    return [(event_type, t) for event_type, t in events if t.date() >= date.today() + timedelta(days=2)]
+
+
+def test_update_times_moves_events_to_new_sleep_and_wake_times(cohort):
+    redcap, apptoto, generator = cohort
+    generator().generate_messages()
+    before = local_events(apptoto)
+
+    redcap.set_field('ASH001', 'waketime', '08:00')
+    redcap.set_field('ASH001', 'sleeptime', '20:30')
+    asyncio.run(generator().update_times())
+    after = local_events(apptoto)
+
+    assert len(after) == len(before)
+    times = {}
+    for event_type, t in after:
+        times.setdefault(event_type, set()).add(t.time())
+    # sleep time messages are sent at their offset from the new sleep time, in the participant's time zone
+    assert times[EventType.DIARY.value] == {time(18, 30)}
+    assert times[EventType.CIGS.value] == {time(19, 30)}
+    # intervention messages are sent from the new wake time until 2 hours before the new sleep time
+    assert all(time(8) <= t <= time(18, 30) for t in times[EventType.SMS.value])
+    assert max(times[EventType.SMS.value]) > time(17)
+
+
+def sms_events(apptoto):
+    """Intervention message events by slot."""
+    events = {}
+    for e in apptoto.events.values():
+        external_id = parse_external_id(e['external_id'])
+        if external_id.event_type == EventType.SMS.value:
+            events[external_id.slot] = (external_id.uo_id, e['content'], parse_time(e['start_time']))
+    return events
+
+
+def test_assignment_kept_and_retimed(cohort):
+    redcap, apptoto, generator = cohort
+    generator().generate_messages()
+    store = Store()
+    assignment = store.read('assignments', 'ASH001').set_index('slot')
+    events = sms_events(apptoto)
+
+    assert sorted(assignment.index) == sorted(events)
+    assert assignment.seed.nunique() == 1
+    for slot, (uo_id, content, start_time) in events.items():
+        assert str(assignment.UO_ID[slot]) == uo_id
+        assert 'UO: ' + assignment.Message[slot] == content
+        assert assignment.start_time[slot] == start_time
+
+    redcap.set_field('ASH001', 'sleeptime', '20:30')
+    asyncio.run(generator().update_times())
+    retimed = store.read('assignments', 'ASH001').set_index('slot')
+    events = sms_events(apptoto)
+
+    # the messages are the ones drawn before, at their new times
+    assert retimed.UO_ID.tolist() == assignment.UO_ID.tolist()
+    assert retimed.seed.tolist() == assignment.seed.tolist()
+    assert all(retimed.start_time[slot] == start_time for slot, (_, _, start_time) in events.items())
+    assert (retimed.start_time != assignment.start_time).any()
@@ -0,0 +1,86 @@
+"""
+A local stand-in for the REDCap export used by src/participant.py, with synthetic cohorts.
+
+    redcap = RedcapEmulator(synthetic_records(50))
+    with redcap.installed():
+        subject = RedcapParticipant('ASH001', 'token')
+"""
+import random
+from contextlib import contextmanager
+from datetime import date, timedelta
+
+import numpy as np
+import pandas as pd
+
+import src.participant
+from src.enums import Condition, CodedValues
+from src.participant import REDCAP_EVENTS
+
+S0, S1 = list(REDCAP_EVENTS)
+VALUES = [v for v in CodedValues if v is not CodedValues.none]
+
+
+def participant_ids(n):
+    return [f'ASH{i:03d}' for i in range(1, n + 1)]
+
+
+def synthetic_records(n, quit_date: date = None, seed=0) -> pd.DataFrame:
+    """
+    Make a REDCap export for a synthetic cohort.
+
+    :param n: Number of participants
+    :param quit_date: Quit date of the first participant, the next 29 quit a day apart each
+        (default = a week from today)
+    :param seed: Random seed for conditions, values and wake and sleep times
+    :return: DataFrame in the form returned by participant.export_records
+    """
+    rng = random.Random(seed)
+    quit_date = quit_date or date.today() + timedelta(weeks=1)
+
+    rows = []
+    for i, pid in enumerate(participant_ids(n)):
+        values = rng.sample(VALUES, 3)
+        session0 = quit_date + timedelta(days=i % 30 - 14)
+        rows.append(dict(record_id=pid, redcap_event_name=S0,
+                         initials=f'P{i % 100:02d}', phone=f'541-{i // 10000:03d}-{i % 10000:04d}',
+                         email=f'{pid.lower()}@example.com', timezone=rng.choice(['PT', 'MT', 'CT', 'ET']),
+                         waketime=f'{rng.randint(6, 9):02d}:00', sleeptime=f'{rng.randint(21, 23):02d}:00',
+                         date_zs0=session0.isoformat(),
+                         value1_s0=values[0].value, value2_s0=values[1].value, value7_s0=values[2].value))
+        rows.append(dict(record_id=pid, redcap_event_name=S1,
+                         condition=rng.choice(list(Condition)).value,
+                         quitdate=(quit_date + timedelta(days=i % 30)).isoformat(),
+                         training_end=(session0 + timedelta(days=7)).isoformat()))
+
+    # pycap's DataFrame export leaves fields of other events empty
+    return pd.DataFrame(rows).set_index(['record_id', 'redcap_event_name']).replace({None: np.nan})
+
+
+class RedcapEmulator:
+    def __init__(self, records: pd.DataFrame):
+        """
+        Create a RedcapEmulator.
+
+        :param records: Records to export, e.g. from synthetic_records
+        """
+        self.records = records
+        self.exports = 0
+
+    def export_records(self, redcap_token):
+        self.exports += 1
+        return self.records.copy()
+
+    def set_field(self, participant_id, field, value, event='s0'):
+        """Change one participant's field, as if it was edited in REDCap."""
+        redcap_event = next(k for k, v in REDCAP_EVENTS.items() if v == event)
+        self.records.loc[(participant_id, redcap_event), field] = value
+
+    @contextmanager
+    def installed(self):
+        """Use this emulator for REDCap exports while in the context."""
+        export_records = src.participant._export_records
+        src.participant._export_records = self.export_records
+        try:
+            yield self
+        finally:
+            src.participant._export_records = export_records
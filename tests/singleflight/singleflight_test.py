@@ -0,0 +1,68 @@
+import threading
+import time
+
+from src.singleflight import SingleFlight
+
+
+def run_shared(flight, fn, followers=2):
+    """Call `fn` for one key from a leader and `followers` callers that join its call, and return their results."""
+    release = threading.Event()
+    calls = []
+    results = [None] * (followers + 1)
+
+    def leader_fn():
+        calls.append(1)
+        release.wait(timeout=5)
+        return fn()
+
+    def call(i):
+        try:
+            results[i] = flight.do('key', leader_fn)
+        except Exception as err:
+            results[i] = err
+
+    threads = [threading.Thread(target=call, args=(0,))]
+    threads[0].start()
+    while not calls:
+        time.sleep(0.001)
+    for i in range(1, followers + 1):
+        threads.append(threading.Thread(target=call, args=(i,)))
+        threads[-1].start()
+    # the followers wait for the leader's call, which is then released
+    while flight._calls['key'].followers < followers:
+        time.sleep(0.001)
+    release.set()
+    for thread in threads:
+        thread.join(timeout=5)
+    assert len(calls) == 1
+    return results
+
+
+def test_followers_get_independent_copies():
+    flight = SingleFlight('test')
+
+    results = run_shared(flight, lambda: [{'id': 1}])
+    results[1][0]['id'] = 2
+    results[2].append({'id': 3})
+
+    assert results[0] == [{'id': 1}]
+    assert len({id(r) for r in results}) == 3
+
+
+def test_followers_share_error():
+    flight = SingleFlight('test')
+
+    def fail():
+        raise ValueError('apptoto is down')
+
+    results = run_shared(flight, fail)
+
+    assert all(isinstance(r, ValueError) for r in results)
+
+
+def test_later_call_made_again():
+    flight = SingleFlight('test')
+    calls = []
+
+    assert flight.do('key', lambda: calls.append(1) or len(calls)) == 1
+    assert flight.do('key', lambda: calls.append(1) or len(calls)) == 2